@@ -14,4 +14,5 @@ setup(
         "pytest",
         "httpx",
     ],
+    extras_require={"export": ["pyarrow"], "brotli": ["brotli"]},
 )
@@ -1,174 +1,685 @@
+import asyncio
+import base64
 import datetime
-from typing import Any, Dict, List, Tuple, Union
+import json
+import logging
+import secrets
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Literal, Tuple, Union
 
 import numpy as np
 import pandas as pd
-from fastapi import FastAPI, HTTPException, Response
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
 
 from streetcardelay import config
+from streetcardelay.api import export
+from streetcardelay.api.cache import ResponseCache
+from streetcardelay.api.cube import time_window
+from streetcardelay.api.dataset import (
+    Dataset,
+    current_snapshot_hash,
+    dataset_version,
+    load_dataset,
+    source_signature,
+)
 from streetcardelay.api.model import (
     AggregateDetails,
+    BatchAggregateRequest,
+    CacheStatistics,
+    DelayFilter,
     MetaData,
+    ReloadStatus,
     StreetCarDelay,
     StreetCarDelayAggregate,
 )
-from streetcardelay.graphics.svg_generator import SVGGenerator
-from streetcardelay.processing import DataKraken
+from streetcardelay.api.serialization import (
+    columns_json,
+    csv_header,
+    csv_lines,
+    ndjson_lines,
+    records_json,
+)
+from streetcardelay.graphics.map_cache import RenderedMap
+
+logger = logging.getLogger(__name__)
+
+# number of incidents that are serialized at once when streaming
+STREAM_CHUNK_SIZE = 5000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+# query parameters that delay incidents are filtered by
+DELAY_FILTER_DEPENDENCY = Depends(DelayFilter)
+
+
+def _seconds_since_midnight(time: Union[datetime.time, None]) -> Union[int, None]:
+    """Convert a time of day to seconds since midnight, the representation of the Time column"""
+    if time is None:
+        return None
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+
+def _filters(delay_filter: DelayFilter) -> Dict[str, Any]:
+    """Keyword arguments of _filter_rows and the delay cube for the given filter criteria, with
+    times converted to seconds since midnight
+    """
+    return {
+        "date_from": delay_filter.dateFrom,
+        "date_until": delay_filter.dateUntil,
+        "time_from": _seconds_since_midnight(delay_filter.timeFrom),
+        "time_until": _seconds_since_midnight(delay_filter.timeUntil),
+        "weekday": delay_filter.weekday,
+    }
+
+
+def _filter_key(line: str, stop_before: Union[str, None], filters: Dict[str, Any]) -> Tuple:
+    """Normalized key for caching responses to delay data filtered by the given keyword arguments
+    of _filter_rows; time bounds that do not restrict the time of day are dropped
+    """
+    time_from = None if filters["time_from"] == 0 else filters["time_from"]
+    time_until = None if filters["time_until"] == 24 * 3600 - 1 else filters["time_until"]
+
+    return (
+        line,
+        stop_before,
+        filters["date_from"],
+        filters["date_until"],
+        time_from,
+        time_until,
+        filters["weekday"],
+    )
+
+
+def _encode_cursor(version: str, row: int) -> str:
+    """Opaque cursor for a page of delay data that starts at the given row position of the dataset
+    with the given version
+    """
+    return base64.urlsafe_b64encode(f"{version}:{row}".encode()).decode()
+
+
+def _decode_cursor(cursor: str, version: str) -> int:
+    """Row position of a cursor returned by _encode_cursor; a cursor of another version of the
+    dataset is rejected, since the rows of that version are at other positions
+    """
+    try:
+        cursor_version, row = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        position = int(row)
+    except ValueError:
+        raise HTTPException(400, detail="Invalid cursor") from None
+    if position < 0:
+        raise HTTPException(400, detail="Invalid cursor")
+    if cursor_version != version:
+        raise HTTPException(
+            410, detail="The delay data has changed since the cursor was returned, start over"
+        )
+
+    return position
+
+
+def _json_response(content: bytes) -> Response:
+    """Wrap serialized json in a response"""
+    return Response(content=content, media_type="application/json")
 
 
-def prepare_data() -> Tuple[Dict[str, Any], pd.DataFrame]:
-    """Read streetcar stop and delay data data from disk and preprocess"""
-    data_kraken = DataKraken()
-    data_kraken.read_delay_data(config.DELAY_DATA_FILE)
-    data_kraken.add_geocoded_delay_locations_from_file(config.DELAY_COORDINATES_FILE)
-    data_kraken.read_stops_data(config.STREETCAR_STOPS_DIRECTORY)
-    data_kraken.add_nearest_stop_locations()
+def _top_values(column: pd.Series, n: int) -> List[Tuple[Any, int]]:
+    """Returns the n most frequent values of a categorical column with their counts; ties are
+    ordered by first occurrence, like pd.Series.value_counts does for non-categorical columns
+    """
+    codes = column.cat.codes.to_numpy()
+    codes = codes[codes >= 0]
+    unique_codes, first_occurrences, counts = np.unique(
+        codes, return_index=True, return_counts=True
+    )
+    top = np.lexsort((first_occurrences, -counts))[:n]
 
-    if data_kraken.delay_data is None or data_kraken.stops is None:
-        raise ValueError
+    return [(column.cat.categories[unique_codes[i]], int(counts[i])) for i in top]
 
-    return data_kraken.stops, data_kraken.delay_data
 
+RESPONSE_CACHE = ResponseCache(
+    config.RESPONSE_CACHE_SIZE, config.RESPONSE_CACHE_TTL, config.RESPONSE_CACHE_BYTES
+)
+AGGREGATES_ADAPTER = TypeAdapter(List[StreetCarDelayAggregate])
+
+DATASET = load_dataset()
+RELOAD_LOCK = threading.Lock()
+
+
+def reload_dataset() -> bool:
+    """Build a dataset from the current source files and replace the served dataset with it,
+    unless its version is unchanged; invalidates all cached responses. Returns whether the
+    dataset was replaced. Requests that started before keep using the previous dataset.
+    """
+    global DATASET
 
-STREETCAR_STOPS, DELAY_DATA = prepare_data()
+    with RELOAD_LOCK:
+        snapshot_hash = current_snapshot_hash()
+        if dataset_version(snapshot_hash) == DATASET.version:
+            return False
+
+        logger.info("Reloading dataset")
+        DATASET = load_dataset(snapshot_hash)
+        RESPONSE_CACHE.clear()
+        return True
+
+
+async def _watch_sources(interval: float):
+    """Reload the dataset whenever the source files change, checking every interval seconds"""
+    signature = source_signature()
+    while True:
+        await asyncio.sleep(interval)
+        if (current_signature := source_signature()) == signature:
+            continue
+        signature = current_signature
+        try:
+            await asyncio.to_thread(reload_dataset)
+        except Exception:
+            logger.exception("Could not reload dataset")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    watcher = None
+    if config.RELOAD_INTERVAL is not None:
+        watcher = asyncio.create_task(_watch_sources(config.RELOAD_INTERVAL))
+    yield
+    if watcher is not None:
+        watcher.cancel()
+
+
+def current_dataset(request: Request) -> Dataset:
+    """The dataset that a request is answered from, which is fixed when the request starts"""
+    return getattr(request.state, "dataset", DATASET)
+
+
+DATASET_DEPENDENCY = Depends(current_dataset)
 
 app = FastAPI(
     title="Streetcar Delay Exploration API",
     description="REST API that serves TTC streetcar delay statistics.",
     contact={"name": "Sebastian Klein", "url": "https://sklein.me"},
+    lifespan=lifespan,
 )
 
+# paths whose responses do not only depend on the dataset version, or that tag them themselves
+UNVERSIONED_PATHS = {
+    "/cacheStatistics",
+    "/admin/reload",
+    "/maps",
+    "/maps/network",
+    app.docs_url,
+    app.redoc_url,
+    app.openapi_url,
+}
+
+
+def _etag_matches(if_none_match: Union[str, None], etag: str, wildcard: bool = True) -> bool:
+    """Weak comparison of an entity tag with the tags in an If-None-Match header; the wildcard
+    tag * only matches if wildcard is True, i.e. if the requested resource is known to exist
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return wildcard
+    return etag.removeprefix("W/") in {
+        tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+    }
+
+
+@app.middleware("http")
+async def conditional_get(request: Request, call_next):
+    """Tag responses with the dataset version and answer conditional requests for an unchanged
+    dataset with 304 Not Modified, without running the endpoint
+    """
+    dataset = request.state.dataset = DATASET
+    if request.method not in ("GET", "HEAD") or request.url.path in UNVERSIONED_PATHS:
+        return await call_next(request)
+
+    # the request is not routed and validated yet, so a wildcard cannot tell that it would
+    # succeed; a specific tag was only sent with a successful response to the same request
+    headers = {"ETag": f'"{dataset.version}"', "Cache-Control": config.CACHE_CONTROL}
+    if _etag_matches(request.headers.get("If-None-Match"), headers["ETag"], wildcard=False):
+        return Response(status_code=304, headers=headers)
+
+    response = await call_next(request)
+    if response.status_code == 200:
+        response.headers.update(headers)
+    return response
+
 
 @app.get("/metadata")
-async def metadata() -> MetaData:
+async def metadata(dataset: Dataset = DATASET_DEPENDENCY) -> MetaData:
     """Returns metadata about the delay dataset."""
-    min_date = DELAY_DATA.Date.min()
-    max_date = DELAY_DATA.Date.max()
+    min_date = dataset.delay_data.Date.min()
+    max_date = dataset.delay_data.Date.max()
 
     return MetaData(earliestDate=min_date, latestDate=max_date)
 
 
 @app.get("/streetcarLines")
-async def streetcar_lines() -> List[str]:
+async def streetcar_lines(dataset: Dataset = DATASET_DEPENDENCY) -> List[str]:
     "Returns a list of streetcar line names."
-    return list(STREETCAR_STOPS)
+    return list(dataset.streetcar_stops)
 
 
 @app.get("/streetcarStops")
-async def streetcar_stops(line: str) -> List[str]:
+async def streetcar_stops(line: str, dataset: Dataset = DATASET_DEPENDENCY) -> List[str]:
     """Returns a list of streetcar stop names for the given line."""
-    if line not in STREETCAR_STOPS:
+    if line not in dataset.streetcar_stops:
         raise HTTPException(400, detail=f"Streetcar line {line} not found")
 
-    return STREETCAR_STOPS[line]["stops"]
+    return dataset.streetcar_stops[line]["stops"]
 
 
-@app.get("/streetcarDelays/{line}", response_model_by_alias=False)
-async def streetcar_delays(line) -> List[StreetCarDelay]:
-    """Returns individual delay incident data for the given streetcar line."""
-    return DELAY_DATA[DELAY_DATA.Line == line].replace(float("nan"), None).to_dict("records")
-
-
-def _filter_delay_data(
+def _filter_rows(
+    dataset: Dataset,
     *,
     line: Union[str, None] = None,
     stop_before: Union[str, None] = None,
     date_from: Union[datetime.date, None] = None,
     date_until: Union[datetime.date, None] = None,
-    time_from: Union[datetime.time, None] = None,
-    time_until: Union[datetime.time, None] = None,
+    time_from: Union[int, None] = None,
+    time_until: Union[int, None] = None,
     weekday: Union[int, None] = None,
-) -> pd.DataFrame:
-    filtered_df = DELAY_DATA
-    if line is not None:
-        filtered_df = filtered_df[filtered_df["Line"] == line]
-    if stop_before is not None:
-        filtered_df = filtered_df[filtered_df["closest_stop_before"] == stop_before]
-    if date_from is not None:
-        filtered_df = filtered_df[filtered_df["Date"] >= np.datetime64(date_from)]
-    if date_until is not None:
-        filtered_df = filtered_df[filtered_df["Date"] <= np.datetime64(date_until)]
-    if time_from is not None:
-        filtered_df = filtered_df[filtered_df["Time"] >= time_from]
-    if time_until is not None:
-        filtered_df = filtered_df[filtered_df["Time"] <= time_until]
+) -> np.ndarray:
+    """Sorted positions of the rows of the delay data that match the given filters; times are
+    given as seconds since midnight
+    """
+    rows = dataset.index.rows(
+        line=line, stop_before=stop_before, date_from=date_from, date_until=date_until
+    )
+    mask = np.ones(len(rows), dtype=bool)
+    times = dataset.delay_data["Time"].to_numpy()[rows]
+    if time_from is not None or time_until is not None:
+        in_window = np.zeros(len(rows), dtype=bool)
+        for start, end in time_window(time_from, time_until):
+            in_window |= (times >= start) & (times <= end)
+        mask &= in_window
     if weekday is not None:
-        filtered_df = filtered_df[filtered_df["Date"].map(lambda date: date.weekday == weekday)]
+        mask &= dataset.delay_data["Weekday"].to_numpy()[rows] == weekday
+
+    return rows[mask]
+
+
+def _filter_delay_data(dataset: Dataset, **filters) -> pd.DataFrame:
+    return dataset.delay_data.take(_filter_rows(dataset, **filters))
+
+
+def _stream_rows(
+    dataset: Dataset,
+    rows: np.ndarray,
+    serialize: Callable[[pd.DataFrame], bytes],
+    header: bytes,
+):
+    """Serialize the delay data at the given positions chunk by chunk"""
+    if header:
+        yield header
+    for start in range(0, len(rows), STREAM_CHUNK_SIZE):
+        yield serialize(dataset.delay_data.take(rows[start : start + STREAM_CHUNK_SIZE]))
+
+
+@app.get(
+    "/streetcarDelays/{line}",
+    response_model=List[StreetCarDelay],
+    response_model_by_alias=False,
+    responses={
+        200: {
+            "description": "Delay incidents as list of objects, as object of lists, as newline "
+            "delimited json or as csv. If there are more incidents than the limit, the cursor "
+            f"for the next page is returned in the {NEXT_CURSOR_HEADER} header.",
+            "content": {"application/x-ndjson": {}, "text/csv": {}},
+        }
+    },
+)
+async def streetcar_delays(
+    line,
+    delay_filter: DelayFilter = DELAY_FILTER_DEPENDENCY,
+    limit: Union[int, None] = Query(
+        default=None, ge=1, description="Maximum number of incidents to return"
+    ),
+    cursor: Union[str, None] = Query(
+        default=None, description="Cursor returned with the previous page of incidents"
+    ),
+    layout: Literal["records", "columns"] = Query(
+        default="records",
+        description="Return a list of incidents, or an object that maps every field to a list "
+        "with the values of all incidents",
+    ),
+    format: Literal["json", "ndjson", "csv"] = Query(
+        default="json", description="Serialization format of the incidents"
+    ),
+    dataset: Dataset = DATASET_DEPENDENCY,
+):
+    """Returns individual delay incident data for the given streetcar line, filtered by the
+    specified criteria. Newline delimited json and csv are streamed.
+    """
+    filters = _filters(delay_filter)
+    serialize = records_json if layout == "records" else columns_json
+    if format == "json" and limit is None and cursor is None:
+        return _json_response(
+            RESPONSE_CACHE.get_or_compute(
+                (dataset.version, "delays", *_filter_key(line, None, filters), layout),
+                lambda: serialize(_filter_delay_data(dataset, line=line, **filters)),
+            )
+        )
+
+    # cursors hold row positions, so that a page starts right after the last row of the previous
+    rows = _filter_rows(dataset, line=line, **filters)
+    if cursor is not None:
+        rows = rows[np.searchsorted(rows, _decode_cursor(cursor, dataset.version)) :]
+    headers = {}
+    if limit is not None and len(rows) > limit:
+        headers[NEXT_CURSOR_HEADER] = _encode_cursor(dataset.version, int(rows[limit]))
+        rows = rows[:limit]
+
+    if format == "json":
+        return Response(
+            content=serialize(dataset.delay_data.take(rows)),
+            media_type="application/json",
+            headers=headers,
+        )
+    if format == "ndjson":
+        return StreamingResponse(
+            _stream_rows(dataset, rows, ndjson_lines, b""),
+            media_type="application/x-ndjson",
+            headers=headers,
+        )
+    return StreamingResponse(
+        _stream_rows(dataset, rows, csv_lines, csv_header()),
+        media_type="text/csv",
+        headers=headers,
+    )
+
+
+def _aggregate_json(dataset: Dataset, line: str, delay_filter: DelayFilter) -> bytes:
+    """Serialized aggregated delay incident statistics for the given streetcar line and filter
+    criteria, from the response cache if possible
+    """
+    filters = _filters(delay_filter)
+
+    def aggregate() -> bytes:
+        aggregates = dataset.cube.aggregate(line, **filters)
+        return AGGREGATES_ADAPTER.dump_json(AGGREGATES_ADAPTER.validate_python(aggregates))
 
-    return filtered_df
+    return RESPONSE_CACHE.get_or_compute(
+        (dataset.version, "aggregate", *_filter_key(line, None, filters)), aggregate
+    )
 
 
-@app.get("/streetcarDelays/{line}/aggregate", response_model_by_alias=False)
+@app.get(
+    "/streetcarDelays/{line}/aggregate",
+    response_model=List[StreetCarDelayAggregate],
+    response_model_by_alias=False,
+)
 async def streetcar_delay_aggregate(
     line: str,
-    dateFrom: Union[datetime.date, None] = None,
-    dateUntil: Union[datetime.date, None] = None,
-    timeFrom: Union[datetime.time, None] = None,
-    timeUntil: Union[datetime.time, None] = None,
-) -> List[StreetCarDelayAggregate]:
+    delay_filter: DelayFilter = DELAY_FILTER_DEPENDENCY,
+    dataset: Dataset = DATASET_DEPENDENCY,
+) -> Response:
     """Retrieves aggregated delay incident statistics for a given streecar line, filtered by the
     specified criteria.
     """
-    filtered_df = _filter_delay_data(
-        line=line,
-        date_from=dateFrom,
-        date_until=dateUntil,
-        time_from=timeFrom,
-        time_until=timeUntil,
-    )
+    return _json_response(_aggregate_json(dataset, line, delay_filter))
+
+
+@app.post(
+    "/streetcarDelays/aggregate:batch",
+    response_model=Dict[str, List[StreetCarDelayAggregate]],
+    response_model_by_alias=False,
+)
+async def streetcar_delay_aggregate_batch(
+    request: BatchAggregateRequest, dataset: Dataset = DATASET_DEPENDENCY
+) -> Response:
+    """Retrieves aggregated delay incident statistics for several streetcar lines at once, keyed
+    by line. Every line is filtered by its own criteria if given, and by the shared criteria
+    otherwise.
+    """
+    aggregates = []
+    for line in dict.fromkeys(request.lines):
+        aggregate_json = _aggregate_json(dataset, line, request.lineFilters.get(line, request))
+        aggregates.append(json.dumps(line).encode() + b":" + aggregate_json)
+
+    return _json_response(b"{" + b",".join(aggregates) + b"}")
+
+
+EXPORT_FORMAT_QUERY = Query(
+    default="arrow", description="Arrow IPC stream or Parquet file", alias="format"
+)
 
-    aggregated = (
-        filtered_df[["closest_stop_before", "closest_stop_after", "Min Delay"]]
-        .groupby(["closest_stop_before", "closest_stop_after"])
-        .agg(["sum", "count"])
+
+def _table_response(content: bytes, export_format: str) -> Response:
+    """Wrap a serialized table in a response"""
+    return Response(content=content, media_type=export.MEDIA_TYPES[export_format])
+
+
+def _require_export():
+    if not export.export_available():
+        raise HTTPException(501, detail="Table export requires pyarrow, which is not installed")
+
+
+@app.get(
+    "/export/streetcarDelays/{line}",
+    response_class=Response,
+    responses={200: {"content": {media_type: {} for media_type in export.MEDIA_TYPES.values()}}},
+)
+async def export_streetcar_delays(
+    line: str,
+    delay_filter: DelayFilter = DELAY_FILTER_DEPENDENCY,
+    export_format: Literal["arrow", "parquet"] = EXPORT_FORMAT_QUERY,
+    dataset: Dataset = DATASET_DEPENDENCY,
+) -> Response:
+    """Returns individual delay incident data for the given streetcar line, filtered by the
+    specified criteria, as table with the fields of /streetcarDelays/{line}.
+    """
+    _require_export()
+    filters = _filters(delay_filter)
+
+    def export_delays() -> bytes:
+        filtered_df = _filter_delay_data(dataset, line=line, **filters)
+        return export.table_bytes(export.delay_table(filtered_df), export_format)
+
+    return _table_response(
+        RESPONSE_CACHE.get_or_compute(
+            (dataset.version, "export", export_format, *_filter_key(line, None, filters)),
+            export_delays,
+        ),
+        export_format,
     )
-    aggregated.columns = ["_".join(col).rstrip("_") for col in aggregated.columns.values]
 
-    aggregated.reset_index(inplace=True)
 
-    return aggregated.to_dict("records")
+@app.get(
+    "/export/streetcarDelays/{line}/aggregate",
+    response_class=Response,
+    responses={200: {"content": {media_type: {} for media_type in export.MEDIA_TYPES.values()}}},
+)
+async def export_streetcar_delay_aggregate(
+    line: str,
+    delay_filter: DelayFilter = DELAY_FILTER_DEPENDENCY,
+    export_format: Literal["arrow", "parquet"] = EXPORT_FORMAT_QUERY,
+    dataset: Dataset = DATASET_DEPENDENCY,
+) -> Response:
+    """Returns aggregated delay incident statistics for the given streetcar line, filtered by the
+    specified criteria, as table with the fields of /streetcarDelays/{line}/aggregate.
+    """
+    _require_export()
+    filters = _filters(delay_filter)
+
+    def export_aggregate() -> bytes:
+        aggregates = dataset.cube.aggregate_columns(line, **filters)
+        return export.table_bytes(export.aggregate_table(aggregates), export_format)
+
+    return _table_response(
+        RESPONSE_CACHE.get_or_compute(
+            (
+                dataset.version,
+                "export aggregate",
+                export_format,
+                *_filter_key(line, None, filters),
+            ),
+            export_aggregate,
+        ),
+        export_format,
+    )
 
 
 @app.get(
     "/streetcarDelays/{line}/aggregate/{closestStopBefore:path}",
+    response_model=AggregateDetails,
     response_model_by_alias=False,
 )
 async def stop_aggregate_details(
     line: str,
     closestStopBefore: str,
-    dateFrom: Union[datetime.date, None] = None,
-    dateUntil: Union[datetime.date, None] = None,
-    timeFrom: Union[datetime.time, None] = None,
-    timeUntil: Union[datetime.time, None] = None,
-) -> AggregateDetails:
+    delay_filter: DelayFilter = DELAY_FILTER_DEPENDENCY,
+    dataset: Dataset = DATASET_DEPENDENCY,
+) -> Response:
     """Retrieves aggregate delay statistics for a streetcar line, for incidents that occur between
     the specified stop and the next one.
     """
-    filtered_df = _filter_delay_data(
-        line=line,
-        stop_before=closestStopBefore,
-        date_from=dateFrom,
-        date_until=dateUntil,
-        time_from=timeFrom,
-        time_until=timeUntil,
+    filters = _filters(delay_filter)
+    key = _filter_key(line, closestStopBefore, filters)
+
+    def aggregate_details() -> bytes:
+        filtered_df = _filter_delay_data(
+            dataset, line=line, stop_before=closestStopBefore, **filters
+        )
+
+        top_incidents = _top_values(filtered_df["Incident"], 3)
+
+        return (
+            AggregateDetails(
+                closestStopBefore=closestStopBefore,
+                topIncidentTypes=[f"{incident} ({count})" for incident, count in top_incidents],
+            )
+            .model_dump_json()
+            .encode()
+        )
+
+    return _json_response(
+        RESPONSE_CACHE.get_or_compute((dataset.version, "details", *key), aggregate_details)
     )
 
-    top_incidents = filtered_df["Incident"].value_counts()[:3]
 
-    return AggregateDetails(
-        closestStopBefore=closestStopBefore,
-        topIncidentTypes=[f"{incident} ({count})" for incident, count in top_incidents.items()],
-    )
+def _map_response(request: Request, rendered: RenderedMap) -> Response:
+    """Respond with the variant of a rendered map that matches the accepted content encodings"""
+    encoding = rendered.negotiate(request.headers.get("Accept-Encoding", ""))
+    content, etag = rendered.variants[encoding]
+    headers = {"ETag": etag, "Cache-Control": config.CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+
+    if _etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type="image/svg+xml", headers=headers)
 
 
 @app.get("/maps", response_class=Response)
-async def svg_map(line: str):
+async def svg_map(
+    request: Request,
+    line: str,
+    drawStopNames: bool = False,
+    dataset: Dataset = DATASET_DEPENDENCY,
+):
     """Retrieves a svg map of the stops of the specfied streetcar line."""
-    if line not in STREETCAR_STOPS:
+    if line not in dataset.streetcar_stops:
         raise HTTPException(400, detail=f"Streetcar line {line} not found")
 
-    generator = SVGGenerator(STREETCAR_STOPS[line])
-    return Response(content=bytes(str(generator.make_svg()), "utf-8"), media_type="image/svg+xml")
+    return _map_response(request, dataset.maps.get(line, drawStopNames))
+
+
+@app.get("/maps/network", response_class=Response)
+async def svg_network_map(
+    request: Request,
+    lines: Union[List[str], None] = Query(
+        default=None, description="Streetcar lines to draw; all lines if not given"
+    ),
+    drawStopNames: bool = False,
+    dataset: Dataset = DATASET_DEPENDENCY,
+):
+    """Retrieves a single svg map of the stops of several streetcar lines."""
+    lines = list(dataset.streetcar_stops) if lines is None else lines
+    for line in lines:
+        if line not in dataset.streetcar_stops:
+            raise HTTPException(400, detail=f"Streetcar line {line} not found")
+
+    return _map_response(request, dataset.maps.get_network(lines, drawStopNames))
+
+
+@app.get("/maps/heatmap", response_class=Response)
+async def svg_heatmap(
+    line: str,
+    stat: Literal["sum", "count", "mean"] = Query(
+        default="sum",
+        description="Statistic that the lines between stops are colored by: total delay "
+        "minutes, number of incidents or mean delay minutes per incident",
+    ),
+    delay_filter: DelayFilter = DELAY_FILTER_DEPENDENCY,
+    drawStopNames: bool = False,
+    dataset: Dataset = DATASET_DEPENDENCY,
+):
+    """Retrieves a svg map of the stops of the specified streetcar line, with the line from every
+    stop to the next one colored by the aggregated delay incident statistics of the incidents
+    between them, filtered by the specified criteria.
+    """
+    if line not in dataset.streetcar_stops:
+        raise HTTPException(400, detail=f"Streetcar line {line} not found")
+
+    filters = _filters(delay_filter)
+
+    def heatmap() -> bytes:
+        aggregates = dataset.cube.aggregate_columns(line, **filters)
+        sums = aggregates["Min Delay_sum"]
+        counts = aggregates["Min Delay_count"]
+        if stat == "sum":
+            values = sums
+        elif stat == "count":
+            values = counts.astype(np.float64)
+        else:
+            values = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+
+        # like the dashboard, color by the first aggregate for every stop before
+        stop_values: Dict[str, float] = {}
+        for stop, value in zip(aggregates["closest_stop_before"].tolist(), values.tolist()):
+            stop_values.setdefault(stop, value)
+
+        generator = dataset.maps.generator(line)
+        return str(generator.make_heatmap_svg(stop_values, drawStopNames)).encode("utf-8")
+
+    return Response(
+        content=RESPONSE_CACHE.get_or_compute(
+            (dataset.version, "heatmap", stat, drawStopNames, *_filter_key(line, None, filters)),
+            heatmap,
+        ),
+        media_type="image/svg+xml",
+    )
+
+
+@app.get("/cacheStatistics")
+async def cache_statistics() -> CacheStatistics:
+    """Returns statistics about the cache for serialized responses."""
+    return CacheStatistics(
+        hits=RESPONSE_CACHE.hits,
+        misses=RESPONSE_CACHE.misses,
+        size=len(RESPONSE_CACHE),
+        maxSize=RESPONSE_CACHE.max_size,
+        bytes=RESPONSE_CACHE.bytes,
+        maxBytes=RESPONSE_CACHE.max_bytes,
+    )
+
+
+@app.post("/admin/reload")
+async def reload(x_admin_token: Union[str, None] = Header(default=None)) -> ReloadStatus:
+    """Reloads the served dataset if its source files have changed. The new dataset is built in
+    the background and replaces the served one once it is complete. Requires the admin token.
+    """
+    if config.ADMIN_TOKEN is None or not secrets.compare_digest(
+        x_admin_token or "", config.ADMIN_TOKEN
+    ):
+        raise HTTPException(403, detail="Invalid admin token")
+
+    reloaded = await asyncio.to_thread(reload_dataset)
+    return ReloadStatus(reloaded=reloaded, version=DATASET.version)
 
 
 @app.get("/help")
@@ -0,0 +1,109 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Callable, Hashable, Tuple, Union
+
+
+class ResponseCache:
+    """In-process least recently used cache for serialized responses, with an optional time to live
+    for entries. The cache is bounded by the number of responses and by their total size, so that
+    a few large responses cannot take up an unbounded amount of memory. Keeps count of cache hits
+    and misses.
+
+    Attributes:
+        max_size: maximum number of cached responses
+        max_bytes: maximum total size of cached responses in bytes; None if it is not limited.
+                   Responses larger than this are not cached.
+        ttl: number of seconds after which cached responses expire; None if they never expire
+        hits: number of lookups that were answered from the cache
+        misses: number of lookups that were not answered from the cache
+    """
+
+    max_size: int
+    max_bytes: Union[int, None]
+    ttl: Union[float, None]
+    hits: int
+    misses: int
+    _entries: "OrderedDict[Hashable, Tuple[float, bytes]]"
+    _bytes: int
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: Union[float, None] = None,
+        max_bytes: Union[int, None] = None,
+    ):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def bytes(self) -> int:
+        """Total size of the cached responses in bytes"""
+        return self._bytes
+
+    def _remove(self, key: Hashable):
+        """Remove the cached response for the given key; the lock must be held"""
+        _, response = self._entries.pop(key)
+        self._bytes -= len(response)
+
+    def _full(self) -> bool:
+        """Whether the cache holds more responses or bytes than allowed"""
+        return len(self._entries) > self.max_size or (
+            self.max_bytes is not None and self._bytes > self.max_bytes
+        )
+
+    def get(self, key: Hashable) -> Union[bytes, None]:
+        """Returns the cached response for the given key, or None if there is no such response or
+        it has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and monotonic() - entry[0] > self.ttl:
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, response: bytes):
+        """Cache a response under the given key, evicting the least recently used responses while
+        the cache is full
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.max_bytes is not None and len(response) > self.max_bytes:
+                return
+
+            self._entries[key] = (monotonic(), response)
+            self._bytes += len(response)
+            while self._full():
+                self._remove(next(iter(self._entries)))
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], bytes]) -> bytes:
+        """Returns the cached response for the given key; computes and caches it if necessary"""
+        response = self.get(key)
+        if response is None:
+            response = compute()
+            self.put(key, response)
+        return response
+
+    def clear(self):
+        """Remove all cached responses, e.g. because the underlying data has changed"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
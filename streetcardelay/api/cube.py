@@ -0,0 +1,300 @@
+import datetime
+from bisect import bisect_left
+from typing import Any, Dict, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from streetcardelay.api.index import position_dtype
+
+SECONDS_PER_HOUR = 3600
+HOURS_PER_DAY = 24
+DAYS_PER_WEEK = 7
+
+# values whose running totals are stored by the cube
+CUMULATIVE_VALUES = ("rows", "count", "sum")
+
+
+def time_window(
+    time_from: Union[int, None], time_until: Union[int, None]
+) -> List[Tuple[int, int]]:
+    """Inclusive intervals of seconds since midnight that make up a time filter; if time_from
+    is later than time_until, the time filter wraps past midnight
+    """
+    start = 0 if time_from is None else time_from
+    end = HOURS_PER_DAY * SECONDS_PER_HOUR - 1 if time_until is None else time_until
+    if start <= end:
+        return [(start, end)]
+    return [(start, HOURS_PER_DAY * SECONDS_PER_HOUR - 1), (0, end)]
+
+
+class DelayCube:
+    """Pre-aggregated delay statistics of compact delay incident data, keyed by streetcar line,
+    pair of closest stops before and after, weekday, hour of day and date.
+
+    For every combination of stop pair, weekday and hour, the cube stores running totals of
+    incidents, delays and delay minutes over the dates with incidents. A date range is therefore
+    answered by differencing two running totals per combination. Hours that are only partly
+    covered by a time filter are aggregated from the rows of these hours in the delay data, whose
+    positions are sorted by line, hour and date to make them cheap to find.
+
+    The cube consists of plain arrays. They are built by build_arrays unless they are given, e.g.
+    memory-mapped from a snapshot, so that all worker processes share them like the delay data.
+    """
+
+    _lines: pd.Index
+    _stops_before: pd.Index
+    _stops_after: pd.Index
+    _n_before: int
+    _n_after: int
+    _delay_columns: Dict[str, np.ndarray]
+    _first_day: int
+    _n_days: int
+    _pair_keys: np.ndarray
+    _pair_lines: np.ndarray
+    _pair_stops_before: np.ndarray
+    _pair_stops_after: np.ndarray
+    _cell_keys: np.ndarray
+    _cumulative: Dict[str, np.ndarray]
+    _raw_order: np.ndarray
+    _raw_starts: np.ndarray
+
+    def __init__(
+        self, delay_data: pd.DataFrame, arrays: Union[Dict[str, np.ndarray], None] = None
+    ):
+        self._lines = delay_data["Line"].cat.categories
+        self._stops_before = delay_data["closest_stop_before"].cat.categories
+        self._stops_after = delay_data["closest_stop_after"].cat.categories
+        self._n_before = max(len(self._stops_before), 1)
+        self._n_after = max(len(self._stops_after), 1)
+        self._delay_columns = {
+            "dates": delay_data["Date"].to_numpy(),
+            "seconds": delay_data["Time"].to_numpy(),
+            "weekdays": delay_data["Weekday"].to_numpy(),
+            "delays": delay_data["Min Delay"].to_numpy(),
+            "before_codes": delay_data["closest_stop_before"].cat.codes.to_numpy(),
+            "after_codes": delay_data["closest_stop_after"].cat.codes.to_numpy(),
+        }
+
+        if arrays is None:
+            arrays = self.build_arrays(delay_data)
+        self._first_day, self._n_days = arrays["days"].tolist()
+        self._pair_keys = arrays["pair_keys"]
+        self._pair_lines, pair_stops = np.divmod(self._pair_keys, self._n_before * self._n_after)
+        self._pair_stops_before, self._pair_stops_after = np.divmod(pair_stops, self._n_after)
+        self._cell_keys = arrays["cell_keys"]
+        self._cumulative = {name: arrays[f"cumulative_{name}"] for name in CUMULATIVE_VALUES}
+        self._raw_order = arrays["raw_order"]
+        self._raw_starts = arrays["raw_starts"]
+
+    @staticmethod
+    def _pair_key(
+        line_codes: np.ndarray,
+        before_codes: np.ndarray,
+        after_codes: np.ndarray,
+        n_before: int,
+        n_after: int,
+    ) -> np.ndarray:
+        """Combined key of line and pair of closest stops before and after; stop pairs are
+        numbered in order of these keys
+        """
+        return (line_codes.astype(np.int64) * n_before + before_codes) * n_after + after_codes
+
+    @staticmethod
+    def _values(delays: np.ndarray) -> Dict[str, np.ndarray]:
+        """Values of incidents with the given delay minutes that are totaled by the cube"""
+        return {
+            "rows": np.ones(len(delays), dtype=np.int64),
+            "count": (~np.isnan(delays)).astype(np.int64),
+            "sum": np.nan_to_num(delays),
+        }
+
+    @classmethod
+    def build_arrays(cls, delay_data: pd.DataFrame) -> Dict[str, np.ndarray]:
+        """Arrays of the cube for the delay data: the first day and number of days, the keys of
+        all stop pairs, the keys and running totals of all cells and the positions of all rows
+        with a line and stop pair, sorted by line, hour and date, with the start of every line and
+        hour
+        """
+        n_lines = len(delay_data["Line"].cat.categories)
+        n_before = max(len(delay_data["closest_stop_before"].cat.categories), 1)
+        n_after = max(len(delay_data["closest_stop_after"].cat.categories), 1)
+
+        line_codes = delay_data["Line"].cat.codes.to_numpy()
+        before_codes = delay_data["closest_stop_before"].cat.codes.to_numpy()
+        after_codes = delay_data["closest_stop_after"].cat.codes.to_numpy()
+        rows = np.flatnonzero((line_codes >= 0) & (before_codes >= 0) & (after_codes >= 0))
+
+        line_codes = line_codes[rows].astype(np.int64)
+        pair_keys = cls._pair_key(
+            line_codes, before_codes[rows], after_codes[rows], n_before, n_after
+        )
+        unique_pair_keys, pairs = np.unique(pair_keys, return_inverse=True)
+
+        days = delay_data["Date"].to_numpy()[rows].astype("datetime64[D]").astype(np.int64)
+        first_day = int(days.min()) if len(days) else 0
+        n_days = int(days.max()) - first_day + 1 if len(days) else 1
+        days -= first_day
+
+        hours = delay_data["Time"].to_numpy()[rows].astype(np.int64) // SECONDS_PER_HOUR
+        weekdays = delay_data["Weekday"].to_numpy()[rows].astype(np.int64)
+        values = cls._values(delay_data["Min Delay"].to_numpy()[rows])
+
+        # running totals per cell of stop pair, weekday, hour and date
+        cell_keys = (cls._group_keys(pairs, weekdays, hours) * n_days + days).astype(np.int64)
+        order = np.argsort(cell_keys, kind="stable")
+        unique_cell_keys, starts = np.unique(cell_keys[order], return_index=True)
+        arrays = {
+            "days": np.array([first_day, n_days], dtype=np.int64),
+            "pair_keys": unique_pair_keys,
+            "cell_keys": unique_cell_keys,
+        }
+        for name in CUMULATIVE_VALUES:
+            value = values[name]
+            arrays[f"cumulative_{name}"] = np.concatenate(
+                [[0], np.cumsum(np.add.reduceat(value[order], starts) if len(starts) else [])]
+            ).astype(value.dtype)
+
+        # rows sorted by line, hour and date for aggregating partially covered hours
+        order = np.lexsort((days, hours, line_codes))
+        raw_keys = (line_codes * HOURS_PER_DAY + hours)[order]
+        arrays["raw_order"] = rows[order].astype(position_dtype(len(delay_data)))
+        arrays["raw_starts"] = np.searchsorted(raw_keys, np.arange(n_lines * HOURS_PER_DAY + 1))
+
+        return arrays
+
+    @staticmethod
+    def _group_keys(pairs: np.ndarray, weekdays: np.ndarray, hours: np.ndarray) -> np.ndarray:
+        """Combined key of stop pair, weekday and hour of day"""
+        return (pairs * DAYS_PER_WEEK + weekdays) * HOURS_PER_DAY + hours
+
+    def _day(self, date: Union[datetime.date, None], default: int) -> int:
+        """Day relative to the first day in the cube"""
+        if date is None:
+            return default
+        return int(np.datetime64(date, "D").astype(np.int64)) - self._first_day
+
+    def _columns(self, pairs: np.ndarray, totals: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """Columns of aggregates for the given stop pairs and their totals"""
+        return {
+            "closest_stop_before": self._stops_before.take(
+                self._pair_stops_before[pairs]
+            ).to_numpy(dtype=object),
+            "closest_stop_after": self._stops_after.take(self._pair_stops_after[pairs]).to_numpy(
+                dtype=object
+            ),
+            "Min Delay_sum": totals["sum"].astype(np.float64),
+            "Min Delay_count": totals["count"],
+        }
+
+    def aggregate_columns(
+        self,
+        line: str,
+        date_from: Union[datetime.date, None] = None,
+        date_until: Union[datetime.date, None] = None,
+        time_from: Union[int, None] = None,
+        time_until: Union[int, None] = None,
+        weekday: Union[int, None] = None,
+    ) -> Dict[str, np.ndarray]:
+        """Returns the sum and count of delay minutes per pair of closest stops before and after
+        for the given streetcar line and filters as arrays; times are given as seconds since
+        midnight. The result has the same rows as grouping the filtered incidents by stop pair.
+        """
+        no_pairs = np.array([], dtype=np.int64)
+        no_totals = {
+            name: np.array([], dtype=value.dtype) for name, value in self._cumulative.items()
+        }
+        if line not in self._lines:
+            return self._columns(no_pairs, no_totals)
+        line_code = self._lines.get_loc(line)
+        first_pair, last_pair = np.searchsorted(self._pair_lines, [line_code, line_code + 1])
+        pairs = np.arange(first_pair, last_pair)
+
+        first_day = max(self._day(date_from, 0), 0)
+        last_day = min(self._day(date_until, self._n_days - 1), self._n_days - 1)
+        if first_day > last_day:
+            return self._columns(no_pairs, no_totals)
+
+        weekdays = np.arange(DAYS_PER_WEEK) if weekday is None else np.array([weekday])
+        window = time_window(time_from, time_until)
+
+        hour_starts = np.arange(HOURS_PER_DAY) * SECONDS_PER_HOUR
+        covered_seconds = sum(
+            np.clip(
+                np.minimum(end, hour_starts + SECONDS_PER_HOUR - 1)
+                - np.maximum(start, hour_starts)
+                + 1,
+                0,
+                None,
+            )
+            for start, end in window
+        )
+        full_hours = np.flatnonzero(covered_seconds == SECONDS_PER_HOUR)
+        partial_hours = np.flatnonzero(
+            (covered_seconds > 0) & (covered_seconds < SECONDS_PER_HOUR)
+        )
+
+        totals = {
+            name: np.zeros(len(pairs), dtype=cumulative.dtype)
+            for name, cumulative in self._cumulative.items()
+        }
+
+        if len(full_hours) and len(pairs):
+            group_keys = self._group_keys(
+                pairs[:, np.newaxis, np.newaxis],
+                weekdays[np.newaxis, :, np.newaxis],
+                full_hours[np.newaxis, np.newaxis, :],
+            ).ravel()
+            starts = np.searchsorted(self._cell_keys, group_keys * self._n_days + first_day)
+            ends = np.searchsorted(
+                self._cell_keys, group_keys * self._n_days + last_day, side="right"
+            )
+            for name, cumulative in self._cumulative.items():
+                totals[name] += (
+                    (cumulative[ends] - cumulative[starts]).reshape(len(pairs), -1).sum(axis=1)
+                )
+
+        columns = self._delay_columns
+        dates = columns["dates"].__getitem__
+        first_date, end_date = (
+            np.datetime64(self._first_day + day, "D").astype(columns["dates"].dtype)
+            for day in (first_day, last_day + 1)
+        )
+        for hour in partial_hours:
+            group = line_code * HOURS_PER_DAY + hour
+            rows = self._raw_order[self._raw_starts[group] : self._raw_starts[group + 1]]
+            # binary search over the dates of the sorted rows, without gathering these dates
+            first = bisect_left(rows, first_date, key=dates)
+            rows = rows[first : bisect_left(rows, end_date, lo=first, key=dates)]
+            seconds = columns["seconds"][rows]
+            in_window = np.any([(seconds >= s) & (seconds <= e) for s, e in window], axis=0)
+            if weekday is not None:
+                in_window &= columns["weekdays"][rows] == weekday
+            rows = rows[in_window]
+
+            pair_keys = self._pair_key(
+                np.full(len(rows), line_code),
+                columns["before_codes"][rows],
+                columns["after_codes"][rows],
+                self._n_before,
+                self._n_after,
+            )
+            pair_indices = np.searchsorted(self._pair_keys, pair_keys) - first_pair
+            values = self._values(columns["delays"][rows])
+            for name in totals:
+                totals[name] += np.bincount(
+                    pair_indices, weights=values[name], minlength=len(pairs)
+                ).astype(totals[name].dtype)
+
+        present = totals["rows"] > 0
+        return self._columns(
+            pairs[present], {name: total[present] for name, total in totals.items()}
+        )
+
+    def aggregate(self, line: str, **filters) -> List[Dict[str, Any]]:
+        """Returns the records of aggregate_columns for the given streetcar line and filters"""
+        columns = self.aggregate_columns(line, **filters)
+        return [
+            dict(zip(columns, values))
+            for values in zip(*(column.tolist() for column in columns.values()))
+        ]
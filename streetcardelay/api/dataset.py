@@ -0,0 +1,209 @@
+import hashlib
+import logging
+from importlib import metadata
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from streetcardelay import config
+from streetcardelay.api.cube import DelayCube
+from streetcardelay.api.index import DelayIndex
+from streetcardelay.graphics import SVGMapCache
+from streetcardelay.processing import DataKraken
+from streetcardelay.processing.snapshot import (
+    compact_delay_data,
+    read_arrays,
+    read_snapshot,
+    source_hash,
+    write_arrays,
+)
+
+logger = logging.getLogger(__name__)
+
+DELAY_DATA_COLUMNS = [
+    "Date",
+    "Time",
+    "Weekday",
+    "Line",
+    "Location",
+    "Incident",
+    "Min Delay",
+    "closest_stop_before",
+    "closest_stop_after",
+]
+
+
+def prepare_data(
+    snapshot_hash: str,
+) -> Tuple[Dict[str, Any], pd.DataFrame, Union[Path, None]]:
+    """Read streetcar stop and delay data in compact form from the snapshot with the given hash of
+    the source files on disk. The snapshot is memory-mapped, so that all worker processes share its
+    data. If there is no such snapshot, read and preprocess the source files and write one. Returns
+    the data and the snapshot directory, which is None if the snapshot could not be written.
+    """
+    snapshot_directory = config.SNAPSHOT_DIRECTORY / snapshot_hash
+    snapshot = read_snapshot(
+        config.SNAPSHOT_DIRECTORY, snapshot_hash, DELAY_DATA_COLUMNS, compact=True
+    )
+    if snapshot is not None:
+        return (*snapshot, snapshot_directory)
+
+    logger.warning("No up to date snapshot found, preprocessing source data")
+    data_kraken = DataKraken()
+    data_kraken.read_all_data(
+        config.DELAY_DATA_FILE, config.DELAY_COORDINATES_FILE, config.STREETCAR_STOPS_DIRECTORY
+    )
+    if data_kraken.delay_data is None or data_kraken.stops is None:
+        raise ValueError
+
+    try:
+        data_kraken.write_snapshot(config.SNAPSHOT_DIRECTORY, snapshot_hash)
+    except OSError:
+        logger.exception("Could not write snapshot to %s", config.SNAPSHOT_DIRECTORY)
+        return (
+            data_kraken.stops,
+            compact_delay_data(data_kraken.delay_data, DELAY_DATA_COLUMNS),
+            None,
+        )
+
+    snapshot = read_snapshot(
+        config.SNAPSHOT_DIRECTORY, snapshot_hash, DELAY_DATA_COLUMNS, compact=True
+    )
+    if snapshot is None:
+        raise ValueError
+
+    return (*snapshot, snapshot_directory)
+
+
+def snapshot_arrays(
+    snapshot: Union[Path, None], name: str, build: Callable[[], Dict[str, np.ndarray]]
+) -> Dict[str, np.ndarray]:
+    """Arrays derived from the delay data, like indexes, memory-mapped from the subdirectory of the
+    snapshot with the given name, so that all worker processes share them. Arrays that are not in
+    the snapshot yet are built and written to it; they are only kept in memory if there is no
+    snapshot or they cannot be written to it.
+    """
+    if snapshot is None:
+        return build()
+
+    arrays = read_arrays(snapshot, name)
+    if arrays is not None:
+        return arrays
+
+    arrays = build()
+    try:
+        write_arrays(snapshot, name, arrays)
+    except OSError:
+        logger.exception("Could not write %s to snapshot %s", name, snapshot)
+        return arrays
+
+    return read_arrays(snapshot, name) or arrays
+
+
+def _package_version() -> str:
+    """Version of the installed streetcardelay package"""
+    try:
+        return metadata.version("streetcardelay")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def _source_files() -> List[Path]:
+    """Source files of the served data"""
+    return [
+        config.DELAY_DATA_FILE,
+        config.DELAY_COORDINATES_FILE,
+        config.STREETCAR_STOPS_DIRECTORY,
+        config.HELPFILE,
+    ]
+
+
+def source_signature() -> Tuple[Tuple[str, int, int], ...]:
+    """Cheap signature of the source files of the served data, made of the paths, modification
+    times and sizes of all files; changes whenever a source file is replaced or modified
+    """
+    signature = []
+    for source in _source_files():
+        files = sorted(source.rglob("*")) if source.is_dir() else [source]
+        for fp in files:
+            try:
+                stat = fp.stat()
+            except FileNotFoundError:
+                continue
+            if fp.is_file():
+                signature.append((str(fp), stat.st_mtime_ns, stat.st_size))
+
+    return tuple(signature)
+
+
+def dataset_version(snapshot_hash: str) -> str:
+    """Version of the served data, derived from the hash of the source files of the delay
+    and stop data, the help file and the package version
+    """
+    help_hash = source_hash(config.HELPFILE) if config.HELPFILE.exists() else ""
+    return hashlib.sha256(
+        f"{snapshot_hash} {help_hash} {_package_version()}".encode()
+    ).hexdigest()[:32]
+
+
+class Dataset:
+    """Streetcar stop and delay data served by the API, together with the indexes built from it.
+    A dataset is not modified once it has been built, so that it can be replaced by a newer one
+    while requests that started earlier keep using it. The indexes are stored in the snapshot
+    directory of the data if there is one, see snapshot_arrays.
+
+    Attributes:
+        streetcar_stops: streetcar line information by line
+        delay_data: compact delay incident data with the columns DELAY_DATA_COLUMNS
+        index: index of delay_data by line, stop and date
+        cube: pre-aggregated delay statistics of delay_data
+        maps: cache of rendered svg maps of the streetcar lines
+        version: version of the data, see dataset_version
+    """
+
+    streetcar_stops: Dict[str, Any]
+    delay_data: pd.DataFrame
+    index: DelayIndex
+    cube: DelayCube
+    maps: SVGMapCache
+    version: str
+
+    def __init__(
+        self,
+        streetcar_stops: Dict[str, Any],
+        delay_data: pd.DataFrame,
+        version: str,
+        snapshot: Union[Path, None] = None,
+    ):
+        self.streetcar_stops = streetcar_stops
+        self.delay_data = delay_data
+        self.index = DelayIndex(
+            delay_data,
+            snapshot_arrays(snapshot, "index", lambda: DelayIndex.build_arrays(delay_data)),
+        )
+        self.cube = DelayCube(
+            delay_data,
+            snapshot_arrays(snapshot, "cube", lambda: DelayCube.build_arrays(delay_data)),
+        )
+        self.maps = SVGMapCache(streetcar_stops)
+        self.version = version
+
+
+def current_snapshot_hash() -> str:
+    """Hash of the source files of the delay and stop data, which identifies their snapshot"""
+    return source_hash(
+        config.DELAY_DATA_FILE, config.DELAY_COORDINATES_FILE, config.STREETCAR_STOPS_DIRECTORY
+    )
+
+
+def load_dataset(snapshot_hash: Union[str, None] = None) -> Dataset:
+    """Read streetcar stop and delay data from the snapshot with the given hash of the source
+    files, or from the source files themselves, and build the indexes used by the endpoints
+    """
+    if snapshot_hash is None:
+        snapshot_hash = current_snapshot_hash()
+    streetcar_stops, delay_data, snapshot = prepare_data(snapshot_hash)
+
+    return Dataset(streetcar_stops, delay_data, dataset_version(snapshot_hash), snapshot)
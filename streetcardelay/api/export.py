@@ -0,0 +1,78 @@
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+from streetcardelay.api.serialization import DELAY_FIELDS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+MEDIA_TYPES = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def export_available() -> bool:
+    """Whether pyarrow is installed, which is required for exporting tables"""
+    return pa is not None
+
+
+def _categorical_array(column: pd.Series) -> "pa.DictionaryArray":
+    codes = column.cat.codes.to_numpy()
+    return pa.DictionaryArray.from_arrays(
+        pa.array(codes, mask=codes < 0),
+        pa.array(column.cat.categories.to_numpy(dtype=object), type=pa.string()),
+    )
+
+
+def delay_table(delay_data: pd.DataFrame) -> "pa.Table":
+    """Arrow table of compact delay data with the fields of the StreetCarDelay model. Categorical
+    columns become dictionary arrays that share the codes, the other columns are wrapped without
+    conversion where their types allow it.
+    """
+    arrays = {}
+    for field, column_name in DELAY_FIELDS.items():
+        column = delay_data[column_name]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            arrays[field] = _categorical_array(column)
+        elif column_name == "Date":
+            days = column.to_numpy().astype("datetime64[D]").astype(np.int32)
+            arrays[field] = pa.array(days).cast(pa.date32())
+        elif column_name == "Time":
+            arrays[field] = pa.array(column.to_numpy().astype(np.int32)).cast(pa.time32("s"))
+        else:
+            arrays[field] = pa.array(column.to_numpy(), from_pandas=True)
+
+    return pa.table(arrays)
+
+
+def aggregate_table(aggregates: Dict[str, np.ndarray]) -> "pa.Table":
+    """Arrow table of aggregate columns of a DelayCube with the fields of the
+    StreetCarDelayAggregate model
+    """
+    return pa.table(
+        {
+            "closestStopBefore": pa.array(aggregates["closest_stop_before"], type=pa.string()),
+            "closestStopAfter": pa.array(aggregates["closest_stop_after"], type=pa.string()),
+            "totalCount": pa.array(aggregates["Min Delay_count"], type=pa.int64()),
+            "totalDelay": pa.array(aggregates["Min Delay_sum"], type=pa.float64()),
+        }
+    )
+
+
+def table_bytes(table: "pa.Table", format: str) -> bytes:
+    """Serialize an arrow table as arrow IPC stream or as parquet file"""
+    sink = pa.BufferOutputStream()
+    if format == "arrow":
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        pq.write_table(table, sink)
+
+    return sink.getvalue().to_pybytes()
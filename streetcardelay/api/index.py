@@ -0,0 +1,129 @@
+import datetime
+from bisect import bisect_left, bisect_right
+from typing import Dict, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+
+def position_dtype(rows: int) -> np.dtype:
+    """Smallest integer type for the positions of the given number of rows"""
+    return np.dtype(np.int32 if rows <= np.iinfo(np.int32).max else np.int64)
+
+
+class DelayIndex:
+    """Index of compact delay incident data that partitions rows by streetcar line and by pairs of
+    streetcar line and closest stop before. Rows of every partition are sorted by date, so that
+    date ranges are resolved with binary search instead of scanning all rows.
+
+    The sorted row positions are the only arrays of the index. They are built by build_arrays
+    unless they are given, e.g. memory-mapped from a snapshot, so that all worker processes share
+    them like the delay data. Dates are read through them instead of being copied.
+
+    Attributes:
+        delay_data: indexed delay incident data, with categorical Line and closest_stop_before
+                    columns
+    """
+
+    delay_data: pd.DataFrame
+    _dates: np.ndarray
+    _by_date: np.ndarray
+    _by_line: np.ndarray
+    _by_line_and_stop: np.ndarray
+    _line_partitions: Dict[str, Tuple[int, int]]
+    _stop_partitions: Dict[Tuple[str, str], Tuple[int, int]]
+
+    def __init__(
+        self, delay_data: pd.DataFrame, arrays: Union[Dict[str, np.ndarray], None] = None
+    ):
+        self.delay_data = delay_data
+        self._dates = delay_data["Date"].to_numpy()
+        if arrays is None:
+            arrays = self.build_arrays(delay_data)
+        self._by_date = arrays["by_date"]
+        self._by_line = arrays["by_line"]
+        self._by_line_and_stop = arrays["by_line_and_stop"]
+
+        line_codes = delay_data["Line"].cat.codes.to_numpy()
+        stop_codes = delay_data["closest_stop_before"].cat.codes.to_numpy()
+        lines = delay_data["Line"].cat.categories
+        stops = delay_data["closest_stop_before"].cat.categories
+        self._line_partitions = {
+            lines[line_code]: partition
+            for (line_code,), partition in self._partitions(line_codes[self._by_line])
+            if line_code >= 0
+        }
+        self._stop_partitions = {
+            (lines[line_code], stops[stop_code]): partition
+            for (line_code, stop_code), partition in self._partitions(
+                line_codes[self._by_line_and_stop], stop_codes[self._by_line_and_stop]
+            )
+            if line_code >= 0 and stop_code >= 0
+        }
+
+    @staticmethod
+    def build_arrays(delay_data: pd.DataFrame) -> Dict[str, np.ndarray]:
+        """Positions of all rows of the delay data sorted by date, by line and date and by line,
+        closest stop before and date
+        """
+        dates = delay_data["Date"].to_numpy()
+        line_codes = delay_data["Line"].cat.codes.to_numpy()
+        stop_codes = delay_data["closest_stop_before"].cat.codes.to_numpy()
+        dtype = position_dtype(len(delay_data))
+
+        return {
+            "by_date": np.argsort(dates, kind="stable").astype(dtype),
+            "by_line": np.lexsort((dates, line_codes)).astype(dtype),
+            "by_line_and_stop": np.lexsort((dates, stop_codes, line_codes)).astype(dtype),
+        }
+
+    @staticmethod
+    def _partitions(*sorted_codes: np.ndarray):
+        """Yield the codes and start and end positions of runs of equal codes in sorted arrays"""
+        if not len(sorted_codes[0]):
+            return
+        changes = np.flatnonzero(np.any([np.diff(codes) != 0 for codes in sorted_codes], axis=0))
+        starts = np.concatenate([[0], changes + 1])
+        ends = np.concatenate([changes + 1, [len(sorted_codes[0])]])
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            yield tuple(int(codes[start]) for codes in sorted_codes), (start, end)
+
+    def rows(
+        self,
+        line: Union[str, None] = None,
+        stop_before: Union[str, None] = None,
+        date_from: Union[datetime.date, None] = None,
+        date_until: Union[datetime.date, None] = None,
+    ) -> np.ndarray:
+        """Returns the positions of all rows for the given streetcar line and closest stop before
+        with dates in the given range, in ascending order
+        """
+        if stop_before is not None and line is None:
+            raise ValueError("Filtering by closest stop before requires a streetcar line")
+
+        if stop_before is not None:
+            start, end = self._stop_partitions.get((line, stop_before), (0, 0))
+            positions = self._by_line_and_stop[start:end]
+        elif line is not None:
+            start, end = self._line_partitions.get(line, (0, 0))
+            positions = self._by_line[start:end]
+        else:
+            positions = self._by_date
+
+        # binary search over the dates of the sorted positions, without gathering these dates
+        first = 0
+        last = len(positions)
+        if date_from is not None:
+            first = bisect_left(
+                positions,
+                np.datetime64(date_from).astype(self._dates.dtype),
+                key=self._dates.__getitem__,
+            )
+        if date_until is not None:
+            last = bisect_right(
+                positions,
+                np.datetime64(date_until).astype(self._dates.dtype),
+                key=self._dates.__getitem__,
+            )
+
+        return np.sort(positions[first:last])
@@ -1,5 +1,5 @@
 import datetime
-from typing import List, Union
+from typing import Dict, List, Union
 
 from pydantic import BaseModel, ConfigDict, Field
 
@@ -41,3 +41,42 @@ class MetaData(BaseModel):
 
     earliestDate: datetime.date
     latestDate: datetime.date
+
+
+class CacheStatistics(BaseModel):
+    """Model for statistics about the response cache"""
+
+    hits: int
+    misses: int
+    size: int
+    maxSize: int
+    bytes: int
+    maxBytes: Union[int, None]
+
+
+class DelayFilter(BaseModel):
+    """Model for criteria that delay incidents are filtered by"""
+
+    dateFrom: Union[datetime.date, None] = None
+    dateUntil: Union[datetime.date, None] = None
+    timeFrom: Union[datetime.time, None] = None
+    timeUntil: Union[datetime.time, None] = None
+    weekday: Union[int, None] = Field(
+        default=None, ge=0, le=6, description="Day of the week, with Monday being 0 and Sunday 6"
+    )
+
+
+class BatchAggregateRequest(DelayFilter):
+    """Model for a request of aggregated delay incident statistics for several streetcar lines;
+    the filter criteria apply to all lines that have no filter criteria of their own
+    """
+
+    lines: List[str]
+    lineFilters: Dict[str, DelayFilter] = {}
+
+
+class ReloadStatus(BaseModel):
+    """Model for the result of reloading the served dataset"""
+
+    reloaded: bool
+    version: str
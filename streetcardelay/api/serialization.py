@@ -0,0 +1,141 @@
+import json
+from typing import Callable, Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+# field names of the StreetCarDelay model, with the delay data columns they are taken from
+DELAY_FIELDS = {
+    "date": "Date",
+    "time": "Time",
+    "line": "Line",
+    "locationDescription": "Location",
+    "delayMinutes": "Min Delay",
+    "closestStopBefore": "closest_stop_before",
+    "closestStopAfter": "closest_stop_after",
+}
+
+
+def _encode_distinct(values: np.ndarray, encode) -> np.ndarray:
+    """Serialize an array of values, encoding every distinct value only once"""
+    distinct, inverse = np.unique(values, return_inverse=True)
+    return np.array([encode(value) for value in distinct.tolist()], dtype=object)[inverse]
+
+
+def _encode_float(value: float) -> str:
+    """Serialize a float for json or csv; nan is serialized as empty string"""
+    return "" if value != value else json.dumps(value)
+
+
+def _encode_time(seconds: int) -> str:
+    """Time of day given as seconds since midnight in ISO format"""
+    return f"{seconds // 3600:02}:{seconds // 60 % 60:02}:{seconds % 60:02}"
+
+
+def _encode_json_text(text: str) -> str:
+    return json.dumps(text, ensure_ascii=False)
+
+
+def _encode_csv_text(text: str) -> str:
+    if any(character in text for character in ',"\r\n'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+
+def _fragments(
+    delay_data: pd.DataFrame, encode_text: Callable[[str], str], null: str
+) -> Dict[str, np.ndarray]:
+    """Arrays of serialized values for every field of the StreetCarDelay model. The distinct
+    values of every column are encoded only once and gathered into per-row fragments with numpy,
+    so that no Python object is created per row.
+    """
+    fragments = {}
+    for field, column_name in DELAY_FIELDS.items():
+        column = delay_data[column_name]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            categories = np.array(
+                [encode_text(category) for category in column.cat.categories] + [null],
+                dtype=object,
+            )
+            fragments[field] = categories[column.cat.codes.to_numpy()]
+        elif column_name == "Date":
+            fragments[field] = _encode_distinct(
+                column.to_numpy().astype("datetime64[D]"),
+                lambda date: encode_text(date.isoformat()),
+            )
+        elif column_name == "Time":
+            fragments[field] = _encode_distinct(
+                column.to_numpy(), lambda seconds: encode_text(_encode_time(seconds))
+            )
+        else:
+            fragments[field] = _encode_distinct(
+                column.to_numpy(), lambda value: _encode_float(value) or null
+            )
+
+    return fragments
+
+
+def json_fragments(delay_data: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """Arrays of json values for every field of the StreetCarDelay model"""
+    return _fragments(delay_data, _encode_json_text, "null")
+
+
+def _json_rows(delay_data: pd.DataFrame) -> List[str]:
+    """Json objects with the fields of the StreetCarDelay model for every row"""
+    rows = np.full(len(delay_data), "{", dtype=object)
+    for i, (field, fragments) in enumerate(json_fragments(delay_data).items()):
+        rows += ("," if i else "") + f'"{field}":'
+        rows += fragments
+    rows += "}"
+
+    return rows.tolist()
+
+
+def _join(parts: Iterable[str]) -> bytes:
+    return "".join(parts).encode()
+
+
+def records_json(delay_data: pd.DataFrame) -> bytes:
+    """Serialize delay data as json list of objects with the fields of the StreetCarDelay model"""
+    return _join(["[", ",".join(_json_rows(delay_data)), "]"])
+
+
+def columns_json(delay_data: pd.DataFrame) -> bytes:
+    """Serialize delay data as json object that maps the fields of the StreetCarDelay model to
+    lists with the values of all rows
+    """
+    return _join(
+        [
+            "{",
+            ",".join(
+                f'"{field}":[' + ",".join(fragments.tolist()) + "]"
+                for field, fragments in json_fragments(delay_data).items()
+            ),
+            "}",
+        ]
+    )
+
+
+def ndjson_lines(delay_data: pd.DataFrame) -> bytes:
+    """Serialize delay data as newline delimited json objects with the fields of the
+    StreetCarDelay model
+    """
+    return _join(row + "\n" for row in _json_rows(delay_data))
+
+
+def csv_header() -> bytes:
+    """Header line for delay data serialized by csv_lines"""
+    return (",".join(DELAY_FIELDS) + "\r\n").encode()
+
+
+def csv_lines(delay_data: pd.DataFrame) -> bytes:
+    """Serialize delay data as csv lines with the fields of the StreetCarDelay model; missing
+    values are empty
+    """
+    fragments = list(_fragments(delay_data, _encode_csv_text, "").values())
+    rows = fragments[0].copy()
+    for field_fragments in fragments[1:]:
+        rows += ","
+        rows += field_fragments
+
+    return _join(row + "\r\n" for row in rows.tolist())
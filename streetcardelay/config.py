@@ -5,9 +5,15 @@ from pathlib import Path
 
 GOOGLE_MAPS_API_KEY = os.environ.get("GOOGLE_MAPS_API_KEY")
 GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+# maximum number of geocoding requests per second
+GEOCODE_RATE = float(os.environ.get("GEOCODE_RATE", 40))
 
 TORONTO_BOUNDING_BOX = "43.5810245,-79.639219|43.8554579,-79.1168971"
 
+GEOCODE_CACHE_FILE = Path(os.environ.get("GEOCODE_CACHE_FILE", "data/geocode_cache.sqlite"))
+# time in seconds after which descriptions that could not be geocoded are queried again
+GEOCODE_NEGATIVE_TTL = float(os.environ.get("GEOCODE_NEGATIVE_TTL", 30 * 24 * 3600))
+
 DELAY_DATA_FILE = Path(os.environ.get("DELAY_DATA_FILE", "data/delays/source_delay_data.csv"))
 DELAY_COORDINATES_FILE = Path(
     os.environ.get("DELAY_COORDINATES_FILE", "data/delays/geocoded_delay_locations.csv")
@@ -16,4 +22,27 @@ STREETCAR_STOPS_DIRECTORY = Path(
     os.environ.get("STREETCAR_STOPS_DIRECTORY", "data/streetcar_stops")
 )
 
+# directory for downloaded delay data files and their parsed columns
+DOWNLOAD_CACHE_DIRECTORY = Path(os.environ.get("DOWNLOAD_CACHE_DIRECTORY", "data/downloads"))
+
+INGEST_MANIFEST_FILE = Path(
+    os.environ.get("INGEST_MANIFEST_FILE", "data/delays/ingest_manifest.json")
+)
+
+SNAPSHOT_DIRECTORY = Path(os.environ.get("SNAPSHOT_DIRECTORY", "data/snapshot"))
+
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+# maximum total size in bytes of cached responses
+RESPONSE_CACHE_BYTES = int(os.environ.get("RESPONSE_CACHE_BYTES", 64 * 1024 * 1024))
+RESPONSE_CACHE_TTL = (
+    float(os.environ["RESPONSE_CACHE_TTL"]) if "RESPONSE_CACHE_TTL" in os.environ else None
+)
+
+CACHE_CONTROL = os.environ.get("CACHE_CONTROL", "public, max-age=3600")
+
+# token that authorizes requests to admin endpoints, which are disabled if it is not set
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+# interval in seconds for checking the source files for changes and reloading the served data
+RELOAD_INTERVAL = float(os.environ["RELOAD_INTERVAL"]) if "RELOAD_INTERVAL" in os.environ else None
+
 HELPFILE = Path(os.environ.get("STREETCAR_DELAY_HELPFILE", "data/help.md"))
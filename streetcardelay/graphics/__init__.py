@@ -1 +1,2 @@
-from .svg_generator import SVGGenerator
+from .map_cache import SVGMapCache
+from .svg_generator import NetworkSVGGenerator, SVGGenerator
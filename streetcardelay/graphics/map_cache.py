@@ -0,0 +1,138 @@
+import gzip
+import hashlib
+import threading
+from typing import Any, Dict, Iterable, List, Tuple
+
+from streetcardelay.graphics.svg_generator import NetworkSVGGenerator, SVGGenerator, SVGStyle
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# content encodings in order of preference
+ENCODINGS = ["br", "gzip", "identity"]
+
+
+def accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    """Parse an Accept-Encoding header into a mapping of content codings to quality values"""
+    accepted = {}
+    for coding in accept_encoding.split(","):
+        name, *parameters = (part.strip() for part in coding.split(";"))
+        if not name:
+            continue
+        quality = 1.0
+        for parameter in parameters:
+            key, _, value = parameter.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.lower()] = quality
+
+    return accepted
+
+
+class RenderedMap:
+    """Rendered SVG map in every supported content encoding, each with its own entity tag
+
+    Attributes:
+        variants: mapping of content encodings to encoded map and entity tag
+    """
+
+    variants: Dict[str, Tuple[bytes, str]]
+
+    def __init__(self, content: bytes):
+        digest = hashlib.sha256(content).hexdigest()[:32]
+        self.variants = {
+            "identity": (content, f'"{digest}"'),
+            "gzip": (gzip.compress(content, mtime=0), f'"{digest}-gzip"'),
+        }
+        if brotli is not None:
+            self.variants["br"] = (brotli.compress(content), f'"{digest}-br"')
+
+    def negotiate(self, accept_encoding: str) -> str:
+        """Returns the preferred available content encoding for an Accept-Encoding header"""
+        accepted = accepted_encodings(accept_encoding)
+        candidates: List[Tuple[float, int, str]] = []
+        for preference, encoding in enumerate(ENCODINGS):
+            if encoding not in self.variants:
+                continue
+            quality = accepted.get(
+                encoding, accepted.get("*", 1.0 if encoding == "identity" else 0)
+            )
+            if quality > 0:
+                candidates.append((-quality, preference, encoding))
+
+        return min(candidates)[2] if candidates else "identity"
+
+
+class SVGMapCache:
+    """Cache of rendered SVG maps of streetcar lines in one style, which are rendered lazily or
+    all at once by render_all
+
+    Attributes:
+        streetcar_stops: streetcar line information by line
+        style: SVGStyle object that determines the styling of the maps
+    """
+
+    streetcar_stops: Dict[str, Dict[str, Any]]
+    style: SVGStyle
+    _generators: Dict[str, SVGGenerator]
+    _maps: Dict[Tuple[str, bool], RenderedMap]
+    _network_maps: Dict[Tuple[Tuple[str, ...], bool], RenderedMap]
+
+    def __init__(self, streetcar_stops: Dict[str, Dict[str, Any]], style: SVGStyle = SVGStyle()):
+        self.streetcar_stops = streetcar_stops
+        self.style = style
+        self._generators = {}
+        self._maps = {}
+        self._network_maps = {}
+        self._lock = threading.Lock()
+
+    def generator(self, line: str) -> SVGGenerator:
+        """Returns the SVG generator of the given streetcar line"""
+        generator = self._generators.get(line)
+        if generator is None:
+            generator = SVGGenerator(self.streetcar_stops[line], self.style)
+            self._generators[line] = generator
+
+        return generator
+
+    def get(self, line: str, draw_stop_names: bool = False) -> RenderedMap:
+        """Returns the rendered map of the given streetcar line, rendering it if necessary"""
+        key = (line, draw_stop_names)
+        rendered = self._maps.get(key)
+        if rendered is None:
+            with self._lock:
+                rendered = self._maps.get(key)
+                if rendered is None:
+                    rendered = RenderedMap(self.generator(line).render(draw_stop_names))
+                    self._maps[key] = rendered
+
+        return rendered
+
+    def get_network(self, lines: Iterable[str], draw_stop_names: bool = False) -> RenderedMap:
+        """Returns the rendered map of the given streetcar lines on a common canvas, rendering it
+        if necessary
+        """
+        key = (tuple(sorted(set(lines))), draw_stop_names)
+        rendered = self._network_maps.get(key)
+        if rendered is None:
+            with self._lock:
+                rendered = self._network_maps.get(key)
+                if rendered is None:
+                    generator = NetworkSVGGenerator(
+                        {line: self.streetcar_stops[line] for line in key[0]}, self.style
+                    )
+                    rendered = RenderedMap(generator.render(draw_stop_names))
+                    self._network_maps[key] = rendered
+
+        return rendered
+
+    def render_all(self):
+        """Render the maps of all streetcar lines, with and without stop names"""
+        for line in self.streetcar_stops:
+            for draw_stop_names in (False, True):
+                self.get(line, draw_stop_names)
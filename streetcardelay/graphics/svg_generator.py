@@ -1,9 +1,10 @@
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Tuple, Union
 
+import numpy as np
 import svg
 from pydantic import BaseModel
 
-from streetcardelay.processing.spatial import mercator_project
+from streetcardelay.processing.spatial import mercator_project_array
 
 
 class SVGStyle(BaseModel):
@@ -18,6 +19,11 @@ class SVGStyle(BaseModel):
     id: str = "lineMap"
 
 
+def heat_color(ratio: float) -> str:
+    """Color for a value relative to the maximum value on a heatmap, from light to dark red"""
+    return f"hsl(0,100%,{90 - 50 * ratio:g}%)"
+
+
 class SVGGenerator:
     """Generates SVG representation of streetcar lines
 
@@ -27,65 +33,61 @@ class SVGGenerator:
         style: SVGStyle object that determines the styling of the generated map
     """
 
-    _transformed_coordinates: List[Tuple[float, float]]
+    _transformed_coordinates: np.ndarray
     _line_info: Dict[str, Any]
+    _rendered: Dict[bool, bytes]
 
     def __init__(self, line_info, style: SVGStyle = SVGStyle()):
         self.style = style
         self._line_info = line_info
+        self._rendered = {}
 
-        # project, shift and pad stop coordinates
-        self._transformed_coordinates = self._pad_upper_left(
-            self._scale(
-                self._shift_mirror_y(
-                    [mercator_project(*coord) for coord in line_info["coordinates"]]
-                )
-            )
-        )
+        self._transformed_coordinates = self._transform(line_info["coordinates"])
 
-    def _scale(self, coordinates: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
-        """Scale stop coordinates to canvas width, preserving aspect ratio"""
-        x_range = (
-            max(coordinates, key=lambda coord: coord[0])[0]
-            - min(coordinates, key=lambda coord: coord[0])[0]
+    def _transform(self, coordinates: List[Tuple[float, float]]) -> np.ndarray:
+        """Project, shift, mirror, scale and pad lattitude-longitude pairs to canvas coordinates
+        with shape (n, 2)
+        """
+        return self._pad_upper_left(
+            self._scale(self._shift_mirror_y(mercator_project_array(coordinates)))
         )
 
-        scale_factor = self.style.canvas_width / x_range
+    def _scale(self, coordinates: np.ndarray) -> np.ndarray:
+        """Scale stop coordinates to canvas width, preserving aspect ratio"""
+        x_range = coordinates[:, 0].max() - coordinates[:, 0].min()
 
-        return [
-            (
-                coord[0] * scale_factor,
-                coord[1] * scale_factor,
-            )
-            for coord in coordinates
-        ]
+        return coordinates * (self.style.canvas_width / x_range)
 
-    def _pad_upper_left(self, coordinates: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    def _pad_upper_left(self, coordinates: np.ndarray) -> np.ndarray:
         """Pad stop coordinates on the upper left, so that stop circles are fully visible on the
         map
         """
-        return [
-            (coord[0] + self.style.padding, coord[1] + self.style.padding) for coord in coordinates
-        ]
+        return coordinates + self.style.padding
 
     @staticmethod
-    def _shift_mirror_y(coordinates: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    def _shift_mirror_y(coordinates: np.ndarray) -> np.ndarray:
         """Shift and mirror y coordinates, so that positive positive y coordinates are on the lower
         half of the grid
         """
-        min_x = min(coordinates, key=lambda coord: coord[0])[0]
-        min_y = min(coordinates, key=lambda coord: coord[1])[1]
-        max_y = max(coordinates, key=lambda coord: coord[1])[1]
-
-        shifted = ((coord[0] - min_x, coord[1] - min_y) for coord in coordinates)
-        mirrored_shifted = [(coord[0], max_y - min_y - coord[1]) for coord in shifted]
-
-        return mirrored_shifted
-
-    def make_svg(self, draw_stop_names: bool = False) -> svg.SVG:
-        """Produce SVG map; if draw_stop_names is True, draw the stop names on the map as part of
-        the SVG
+        min_x, min_y = coordinates.min(axis=0)
+        max_y = coordinates[:, 1].max()
+
+        shifted = coordinates - [min_x, min_y]
+        shifted[:, 1] = (max_y - min_y) - shifted[:, 1]
+
+        return shifted
+
+    def _line_elements(
+        self,
+        coordinates: np.ndarray,
+        stop_names: List[str],
+        draw_stop_names: bool,
+        line_colors: Union[Dict[str, str], None] = None,
+    ) -> List[svg.Element]:
+        """SVG elements for the stops of a streetcar line at the given canvas coordinates; the
+        line from every stop to the next one is colored by line_colors if given
         """
+        coordinates = coordinates.tolist()
         stops: List[svg.Element] = [
             svg.Circle(
                 cx=coord[0],
@@ -95,7 +97,7 @@ class SVGGenerator:
                 fill=self.style.stop_color,
                 stroke_width=0,
             )
-            for coord, name in zip(self._transformed_coordinates, self._line_info["stops"])
+            for coord, name in zip(coordinates, stop_names)
         ]
 
         lines: List[svg.Element] = [
@@ -105,35 +107,125 @@ class SVGGenerator:
                 x2=end[0],
                 y2=end[1],
                 id=f"line:{name_before}",
-                stroke=self.style.line_color,
+                stroke=self.style.line_color if line_colors is None else line_colors[name_before],
                 stroke_width=self.style.line_width,
                 stroke_linecap="round",
             )
-            for start, end, name_before in zip(
-                self._transformed_coordinates,
-                self._transformed_coordinates[1:],
-                self._line_info["stops"],
-            )
+            for start, end, name_before in zip(coordinates, coordinates[1:], stop_names)
         ]
 
         elements = lines + stops
 
         if draw_stop_names:
             stop_texts: List[svg.Element] = [
+                # offset by the stop radius through dx and dy, which may be a relative length
                 svg.Text(
-                    x=coord[0] + self.style.stop_radius + 2,
-                    y=coord[1] + self.style.stop_radius + 2,
+                    x=coord[0] + 2,
+                    y=coord[1] + 2,
+                    dx=self.style.stop_radius,
+                    dy=self.style.stop_radius,
                     text=txt,
                 )
-                for coord, txt in zip(self._transformed_coordinates, self._line_info["stops"])
+                for coord, txt in zip(coordinates, stop_names)
             ]
             elements += stop_texts
 
-        width = max(coord[0] for coord in self._transformed_coordinates) + self.style.padding
-        height = max(coord[1] for coord in self._transformed_coordinates) + self.style.padding
+        return elements
+
+    def _svg(self, elements: List[svg.Element], coordinates: np.ndarray) -> svg.SVG:
+        """SVG map with the given elements, sized to fit the given canvas coordinates"""
+        width, height = (coordinates.max(axis=0) + self.style.padding).tolist()
 
         return svg.SVG(
             id=self.style.id,
             viewBox=svg.ViewBoxSpec(0, 0, width, height),
             elements=elements,
         )
+
+    def make_svg(self, draw_stop_names: bool = False) -> svg.SVG:
+        """Produce SVG map; if draw_stop_names is True, draw the stop names on the map as part of
+        the SVG
+        """
+        return self._svg(
+            self._line_elements(
+                self._transformed_coordinates, self._line_info["stops"], draw_stop_names
+            ),
+            self._transformed_coordinates,
+        )
+
+    def make_heatmap_svg(self, values: Dict[str, float], draw_stop_names: bool = False) -> svg.SVG:
+        """Produce SVG map with the line from every stop to the next one colored by the value of
+        the stop relative to the maximum value; stops without value are colored like a value of
+        zero. If draw_stop_names is True, draw the stop names on the map as part of the SVG
+        """
+        max_value = max(values.values(), default=0)
+        line_colors = {
+            stop: heat_color(values.get(stop, 0) / max_value if max_value > 0 else 0)
+            for stop in self._line_info["stops"]
+        }
+
+        return self._svg(
+            self._line_elements(
+                self._transformed_coordinates,
+                self._line_info["stops"],
+                draw_stop_names,
+                line_colors,
+            ),
+            self._transformed_coordinates,
+        )
+
+    def render(self, draw_stop_names: bool = False) -> bytes:
+        """Returns the utf-8 encoded SVG map produced by make_svg; the map is only rendered once
+        per value of draw_stop_names
+        """
+        if draw_stop_names not in self._rendered:
+            self._rendered[draw_stop_names] = str(self.make_svg(draw_stop_names)).encode("utf-8")
+        return self._rendered[draw_stop_names]
+
+
+class NetworkSVGGenerator(SVGGenerator):
+    """Generates a single SVG map of several streetcar lines on a common canvas; the stops of
+    every line are drawn in a group with the id "streetcarLine:<line>"
+
+    Attributes:
+        lines: dictionary with streetcar line information by line for the lines that should be
+               drawn on the map
+        style: SVGStyle object that determines the styling of the generated map
+    """
+
+    _lines: Dict[str, Dict[str, Any]]
+    _line_slices: Dict[str, slice]
+
+    def __init__(self, lines: Dict[str, Dict[str, Any]], style: SVGStyle = SVGStyle()):
+        self.style = style
+        self._lines = lines
+        self._rendered = {}
+
+        # transform the stops of all lines at once, so that they share the canvas
+        self._line_slices = {}
+        coordinates: List[Tuple[float, float]] = []
+        for line, line_info in lines.items():
+            self._line_slices[line] = slice(
+                len(coordinates), len(coordinates) + len(line_info["coordinates"])
+            )
+            coordinates.extend(line_info["coordinates"])
+        self._transformed_coordinates = self._transform(coordinates)
+
+    def make_svg(self, draw_stop_names: bool = False) -> svg.SVG:
+        """Produce SVG map of all lines; if draw_stop_names is True, draw the stop names on the
+        map as part of the SVG
+        """
+        return self._svg(
+            [
+                svg.G(
+                    id=f"streetcarLine:{line}",
+                    elements=self._line_elements(
+                        self._transformed_coordinates[line_slice],
+                        self._lines[line]["stops"],
+                        draw_stop_names,
+                    ),
+                )
+                for line, line_slice in self._line_slices.items()
+            ],
+            self._transformed_coordinates,
+        )
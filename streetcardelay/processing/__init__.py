@@ -1,16 +1,35 @@
-import datetime
 import logging
+import os
 import re
+import tempfile
+from io import StringIO
 from itertools import chain
 from pathlib import Path
-from typing import Dict, List, Tuple, Union
+from typing import Callable, Dict, List, Tuple, Type, Union
 
 import numpy as np
 import pandas as pd
 
-from streetcardelay.processing.delay_data_downloader import DelayDataDownloader
-from streetcardelay.processing.geocode import geocode_all_locations
-from streetcardelay.processing.spatial import find_closest_stop_pair
+from streetcardelay import config
+from streetcardelay.processing.delay_data_downloader import SOURCE_SCHEMA, DelayDataDownloader
+from streetcardelay.processing.geocode import (
+    default_cache,
+    geocode_all_locations,
+    join_geocoded_locations,
+)
+from streetcardelay.processing.geocode_cache import GeocodeCache
+from streetcardelay.processing.ingest import (
+    RESOURCE_COLUMN,
+    fetch_changed_resources,
+    read_manifest,
+    write_manifest,
+)
+from streetcardelay.processing.snapshot import SnapshotWriter, read_snapshot, write_snapshot
+from streetcardelay.processing.spatial import (
+    StopSegmentIndex,
+    find_closest_stop_pairs,
+    project_onto_line,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -24,100 +43,304 @@ class DataKraken:
                     read_delay_data to read a csv file
         stops: holds streetcar stop data; can be populated by calling the method read_stops_data,
                which reads csv files with stop names and locations
+        stop_indexes: holds a spatial index of the segments between adjacent stops for every
+                      streetcar line; populated by calling the method build_stop_indexes
     """
 
     delay_data: Union[pd.DataFrame, None]
     stops: Union[Dict[str, Dict[str, List]], None]
+    stop_indexes: Dict[str, StopSegmentIndex]
 
-    expected_source_columns = {
-        "Date": str,
-        "Line": str,
-        "Time": str,
-        "Day": str,
-        "Location": str,
-        "Incident": str,
-        "Min Delay": np.float64,
-        "Min Gap": np.float64,
-        "Bound": str,
-        "Vehicle": str,
-    }
+    expected_source_columns = SOURCE_SCHEMA
     float_tuple_regexp = re.compile(r"\((-?\d+\.\d+), (-?\d+\.\d+)\)")
 
     def __init__(self) -> None:
         self.delay_data = None
         self.stops = None
+        self.stop_indexes = {}
 
     def download_delay_data(self):
         """Downloads streetcar delay incident data from TTC sources"""
         self.delay_data = DelayDataDownloader.get_all_data()
 
-    def read_delay_data(self, fp: Path):
-        """Reads streetcat delay incident data from specified csv file"""
-        self.delay_data = pd.read_csv(fp, sep="|")
+    def read_all_data(
+        self, delay_data_file: Path, delay_coordinates_file: Path, stops_directory: Path
+    ):
+        """Reads delay incident data, geocoded delay locations and streetcar stop data from the
+        specified files and adds the nearest stop locations to all delay incidents
+        """
+        self.read_delay_data(delay_data_file)
+        self.add_geocoded_delay_locations_from_file(delay_coordinates_file)
+        self.read_stops_data(stops_directory)
+        self.add_nearest_stop_locations()
+
+    def ingest_delay_data(
+        self,
+        delay_data_file: Path,
+        manifest_file: Path,
+        delay_coordinates_file: Path,
+        downloader: Type[DelayDataDownloader] = DelayDataDownloader,
+        reader: Callable[[Path], pd.DataFrame] = pd.read_excel,
+        cache_directory: Path = config.DOWNLOAD_CACHE_DIRECTORY,
+    ) -> int:
+        """Incrementally ingest streetcar delay incident datasets from TTC sources into the
+        specified delay data file. Only datasets that are new or have changed since the previous
+        ingestion, as recorded in the manifest file, are downloaded and parsed; their incidents
+        replace the ones previously ingested from the same dataset. See
+        streetcardelay.processing.ingest.fetch_changed_resources for downloader, reader and cache
+        directory.
+
+        If delay_data holds the preprocessed incidents of the previous contents of the delay data
+        file, only the new incidents are geocoded and assigned the nearest stop locations and
+        appended to it; otherwise, the whole delay data file is read and preprocessed. Returns
+        the number of ingested incidents.
+        """
+        if self.stops is None:
+            raise ValueError("No streetcar stop data found")
+
+        changed, manifest = fetch_changed_resources(
+            read_manifest(manifest_file), downloader, reader, cache_directory
+        )
+        unchanged = set(manifest) - set(changed)
+
+        if delay_data_file.exists():
+            source_data = pd.read_csv(delay_data_file, sep="|", index_col=0)
+        else:
+            source_data = pd.DataFrame()
+        if RESOURCE_COLUMN in source_data.columns:
+            keep = source_data[RESOURCE_COLUMN].isin(unchanged).to_numpy()
+        else:
+            keep = np.zeros(len(source_data), dtype=bool)
 
-        if not set(self.expected_source_columns) <= set(self.delay_data.columns):
+        # new incidents are numbered after all previous ones, like rows appended to the file
+        first_row = int(source_data.index.max()) + 1 if len(source_data) else 0
+        new_data = pd.concat(
+            [data.assign(**{RESOURCE_COLUMN: id}) for id, data in changed.items()]
+            or [pd.DataFrame()],
+            ignore_index=True,
+        )
+        new_data.index += first_row
+
+        if changed or not keep.all():
+            staging = tempfile.NamedTemporaryFile(
+                "w", dir=delay_data_file.parent, prefix=f".{delay_data_file.name}-", delete=False
+            )
+            with staging:
+                pd.concat([source_data[keep], new_data]).to_csv(staging, sep="|")
+            os.replace(staging.name, delay_data_file)
+        write_manifest(manifest_file, manifest)
+
+        if self.delay_data is None or RESOURCE_COLUMN not in self.delay_data.columns:
+            self.read_delay_data(delay_data_file)
+            self.add_geocoded_delay_locations_from_file(delay_coordinates_file)
+            self.add_nearest_stop_locations()
+            return len(new_data)
+
+        preprocessed = [
+            self.delay_data[self.delay_data[RESOURCE_COLUMN].isin(unchanged).to_numpy()]
+        ]
+        if len(new_data):
+            new_kraken = DataKraken()
+            new_kraken.read_delay_data(StringIO(new_data.to_csv(sep="|")))
+            new_kraken.add_geocoded_delay_locations_from_file(delay_coordinates_file)
+            new_kraken.stops = self.stops
+            new_kraken.stop_indexes = self.stop_indexes
+            new_kraken.add_nearest_stop_locations()
+            preprocessed.append(new_kraken.delay_data)
+
+        self.delay_data = pd.concat(preprocessed, ignore_index=True)
+        return len(new_data)
+
+    def read_delay_data(self, fp: Union[Path, StringIO]):
+        """Reads streetcat delay incident data from specified csv file; times of day are stored as
+        seconds since midnight and a Weekday column is added, with Monday being 0
+        """
+        self.delay_data = self._convert_source_data(pd.read_csv(fp, sep="|"))
+
+    @classmethod
+    def _convert_source_data(cls, delay_data: pd.DataFrame) -> pd.DataFrame:
+        """Coerce source delay data to the expected types, parse dates and times and add the
+        Weekday column, see read_delay_data
+        """
+        if not set(cls.expected_source_columns) <= set(delay_data.columns):
             logger.warn(
                 "Missing columns in provided data: %s",
-                set(self.expected_source_columns) - set(self.delay_data.columns),
+                set(cls.expected_source_columns) - set(delay_data.columns),
+            )
+
+        delay_data = delay_data.astype(dtype=cls.expected_source_columns)
+        delay_data["Date"] = pd.to_datetime(delay_data["Date"])
+        delay_data["Time"] = cls._seconds_since_midnight(delay_data["Time"])
+        delay_data["Weekday"] = delay_data["Date"].dt.weekday.astype(np.int8)
+
+        return delay_data
+
+    def preprocess_delay_data_in_chunks(
+        self,
+        delay_data_file: Path,
+        delay_coordinates_file: Path,
+        directory: Path,
+        snapshot_hash: str,
+        chunk_size: int = 100_000,
+    ) -> Path:
+        """Read, geocode and assign the nearest stop locations to the delay incident data in the
+        specified file in chunks of chunk_size incidents and write the preprocessed data to a
+        snapshot in the specified directory, like read_all_data followed by write_snapshot, but
+        with memory use bounded by the chunk size. Requires stop data; delay_data is not set.
+        """
+        if self.stops is None:
+            raise ValueError("No streetcar stop data found")
+
+        geocoded_delay_locations = self.read_geocoded_delay_locations(delay_coordinates_file)
+        writer = SnapshotWriter(directory, snapshot_hash)
+        try:
+            chunks = pd.read_csv(
+                delay_data_file,
+                sep="|",
+                dtype=self.expected_source_columns,
+                chunksize=chunk_size,
+            )
+            for chunk in chunks:
+                chunk_kraken = DataKraken()
+                chunk_kraken.delay_data = self._convert_source_data(chunk)
+                chunk_kraken.add_geocoded_delay_locations(geocoded_delay_locations)
+                chunk_kraken.stops = self.stops
+                chunk_kraken.stop_indexes = self.stop_indexes
+                chunk_kraken.add_nearest_stop_locations()
+                writer.append(chunk_kraken.delay_data)
+        except BaseException:
+            writer.abort()
+            raise
+
+        return writer.finish(self.stops)
+
+    @classmethod
+    def read_geocoded_delay_locations(cls, fp: Path) -> pd.DataFrame:
+        """Read a csv file with delay location names and their coordinates as lat and lon
+        columns; files with a single coordinates column of "(lat, lon)" strings are converted
+        """
+        geocoded_delay_locations = pd.read_csv(
+            fp, sep="|", dtype={"lat": np.float64, "lon": np.float64}
+        )
+        if "coordinates" in geocoded_delay_locations.columns:
+            coordinates = geocoded_delay_locations.pop("coordinates").str.extract(
+                cls.float_tuple_regexp
             )
+            geocoded_delay_locations["lat"] = coordinates[0].astype(np.float64)
+            geocoded_delay_locations["lon"] = coordinates[1].astype(np.float64)
 
-        self.delay_data = self.delay_data.astype(dtype=self.expected_source_columns)
-        self.delay_data["Date"] = pd.to_datetime(self.delay_data["Date"])
-        self.delay_data["Time"] = self.delay_data["Time"].map(datetime.time.fromisoformat)
+        return geocoded_delay_locations
 
     def add_geocoded_delay_locations_from_file(self, fp: Path):
         """Add coordindates to delay incident data using a csv file with location names and
         coordinates
         """
+        self.add_geocoded_delay_locations(self.read_geocoded_delay_locations(fp))
+
+    def add_geocoded_delay_locations(self, geocoded_delay_locations: pd.DataFrame):
+        """Add coordindates to delay incident data as lat and lon columns using delay location
+        names and coordinates, see read_geocoded_delay_locations; locations are matched
+        regardless of case
+        """
         if self.delay_data is None:
             raise ValueError("No delay data found")
 
-        geocoded_delay_locations = pd.read_csv(fp, sep="|")
-        geocoded_delay_locations.coordinates = geocoded_delay_locations.coordinates.map(
-            self._tuple_parser
-        )
-
-        self.delay_data = self.delay_data.merge(
-            geocoded_delay_locations,
-            how="left",
-            left_on=self.delay_data.Location.str.upper(),
-            right_on=geocoded_delay_locations.delay_location.str.upper(),
-        ).drop("delay_location", axis=1)
+        lat, lon = join_geocoded_locations(self.delay_data.Location, geocoded_delay_locations)
+        self.delay_data = self.delay_data.assign(lat=lat, lon=lon)
 
-        self.delay_data.loc[self.delay_data.coordinates.isna(), "coordinates"] = None
-
-    def geocode_delay_data(self):
+    def geocode_delay_data(self, cache: Union[GeocodeCache, None] = None):
         """Use the Google Maps geocoding API to obtain coordinates for the specified locations
-        in the delay incident data
+        in the delay incident data, see DelayDataDownloader.geocode_locations
         """
         if self.delay_data is None:
             raise ValueError("No delay data found")
-        self.delay_data = DelayDataDownloader.geocode_locations(self.delay_data)
+        self.delay_data = DelayDataDownloader.geocode_locations(self.delay_data, cache=cache)
 
-    def add_nearest_stop_locations(self):
+    def build_stop_indexes(self):
+        """Build a spatial index of the segments between adjacent stops for every streetcar line
+        with coordinates of at least two stops
+        """
+        if self.stops is None:
+            raise ValueError("No streetcar stop data found")
+
+        self.stop_indexes = {
+            line_name: StopSegmentIndex(line["coordinates"])
+            for line_name, line in self.stops.items()
+            if len(line["coordinates"]) >= 2
+        }
+
+    def add_nearest_stop_locations(self, method: str = "stops"):
         """For all delay incidents, add the closest streetcar stop before and after the incident
-        location
+        location. The method determines how the closest pair of adjacent stops is found:
+            stops: pair of adjacent stops with the closest stop, see find_closest_stop_pair
+            segments: segment with the closest midpoint, using the stop indexes
+            projection: segment with the smallest point-to-segment distance; also adds the
+                        fractional position of the incident between the two stops as column
+                        segment_position, see project_onto_line
         """
         if self.delay_data is None:
             raise ValueError("No delay data found")
         if self.stops is None:
             raise ValueError("No streetcar stop data found")
+        if method not in ("stops", "segments", "projection"):
+            raise ValueError(f"Unknown method {method} for finding the nearest stops")
 
-        self.delay_data["closest_stop_before"] = None
-        self.delay_data["closest_stop_after"] = None
-        for row in self.delay_data.itertuples():
-            if (row.coordinates is None) or (row.Line not in self.stops):
+        closest_stops_before = np.full(len(self.delay_data), None, dtype=object)
+        closest_stops_after = np.full(len(self.delay_data), None, dtype=object)
+        segment_positions = np.full(len(self.delay_data), np.nan)
+
+        delay_points = self.delay_data[["lat", "lon"]].to_numpy(np.float64)
+        has_coordinates = ~np.isnan(delay_points).any(axis=1)
+        for line_name, line in self.stops.items():
+            rows = np.flatnonzero(has_coordinates & (self.delay_data.Line == line_name).to_numpy())
+            if not len(rows):
                 continue
-            line = self.stops[row.Line]
-            closest_stop_pair_before_index = find_closest_stop_pair(
-                line["coordinates"], row.coordinates
+
+            line_points = delay_points[rows]
+            if method == "segments":
+                if line_name not in self.stop_indexes:
+                    self.stop_indexes[line_name] = StopSegmentIndex(line["coordinates"])
+                closest_stop_pair_before_indices = self.stop_indexes[line_name].nearest_segments(
+                    line_points
+                )
+            elif method == "projection":
+                closest_stop_pair_before_indices, segment_positions[rows] = project_onto_line(
+                    line["coordinates"], line_points
+                )
+            else:
+                closest_stop_pair_before_indices = find_closest_stop_pairs(
+                    line["coordinates"], line_points
+                )
+            stop_names = np.array(line["stops"], dtype=object)
+            closest_stops_before[rows] = stop_names[closest_stop_pair_before_indices]
+            closest_stops_after[rows] = stop_names[closest_stop_pair_before_indices + 1]
+
+        self.delay_data = self.delay_data.assign(
+            closest_stop_before=pd.Series(
+                closest_stops_before, index=self.delay_data.index, dtype=object
+            ),
+            closest_stop_after=pd.Series(
+                closest_stops_after, index=self.delay_data.index, dtype=object
+            ),
+        )
+        if method == "projection":
+            self.delay_data["segment_position"] = segment_positions
+
+    @staticmethod
+    def _seconds_since_midnight(times: pd.Series) -> pd.Series:
+        """Parse times of day in HH:MM:SS or HH:MM format to integer seconds since midnight;
+        raises ValueError for missing times or times without minutes
+        """
+        time_parts = times.str.split(":", expand=True).reindex(columns=range(3))
+        incomplete = time_parts[[0, 1]].isna().any(axis=1).to_numpy()
+        if incomplete.any():
+            raise ValueError(
+                f"Missing or incomplete times of day: {times[incomplete].head().to_list()}"
             )
-            self.delay_data.loc[row[0], "closest_stop_before"] = line["stops"][
-                closest_stop_pair_before_index
-            ]
-            self.delay_data.loc[row[0], "closest_stop_after"] = line["stops"][
-                closest_stop_pair_before_index + 1
-            ]
+        hours, minutes = (time_parts[i].astype(np.int32) for i in range(2))
+        seconds = time_parts[2].fillna("0").astype(np.int32)
+
+        return hours * 3600 + minutes * 60 + seconds
 
     @classmethod
     def _tuple_parser(cls, tuple_string: str) -> Union[None, Tuple[float, float]]:
@@ -150,18 +373,48 @@ class DataKraken:
                 logger.warn("File %s does not contain coordinates of streetcar stops", fp)
 
         self.stops = stops_coordinates
+        self.stop_indexes = {}
 
-    def geocode_stop_locations(self):
-        """Use the Google Maps geocoding API to obtain coordinates for all stop locations"""
+    def geocode_stop_locations(self, cache: Union[GeocodeCache, None] = None):
+        """Use the Google Maps geocoding API to obtain coordinates for all stop locations; stop
+        locations are looked up in the cache, which defaults to the configured geocode cache,
+        before querying the API
+        """
         if not self.stops:
             raise ValueError("No stop data found")
 
         stop_descriptions = set(chain.from_iterable(val["stops"] for val in self.stops.values()))
 
         logger.info("Geocoding %s streetcar stop descriptions", len(stop_descriptions))
-        geocoded = geocode_all_locations(stop_descriptions)
+        geocoded = geocode_all_locations(
+            stop_descriptions, cache=default_cache() if cache is None else cache
+        )
 
         for line, data in self.stops.items():
             self.stops[line]["coordinates"] = [
                 geocoded[description] for description in data["stops"]
             ]
+        self.stop_indexes = {}
+
+    def write_snapshot(self, directory: Path, snapshot_hash: str) -> Path:
+        """Write preprocessed delay and stop data to a binary snapshot in the specified directory,
+        see streetcardelay.processing.snapshot
+        """
+        if self.delay_data is None:
+            raise ValueError("No delay data found")
+        if self.stops is None:
+            raise ValueError("No streetcar stop data found")
+
+        return write_snapshot(self.delay_data, self.stops, directory, snapshot_hash)
+
+    def read_snapshot(self, directory: Path, snapshot_hash: str) -> bool:
+        """Read preprocessed delay and stop data from the snapshot with the given hash in the
+        specified directory; returns False if there is no such snapshot
+        """
+        snapshot = read_snapshot(directory, snapshot_hash)
+        if snapshot is None:
+            return False
+
+        self.stops, self.delay_data = snapshot
+        self.stop_indexes = {}
+        return True
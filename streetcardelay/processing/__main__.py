@@ -0,0 +1,83 @@
+"""Command line interface for building a binary snapshot of the preprocessed delay data, which the
+API reads at startup instead of preprocessing the source csv files
+"""
+
+import argparse
+import logging
+import shutil
+from pathlib import Path
+
+from streetcardelay import config
+from streetcardelay.processing import DataKraken
+from streetcardelay.processing.snapshot import source_hash, stale_snapshots
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--delay-data-file", type=Path, default=config.DELAY_DATA_FILE)
+    parser.add_argument(
+        "--delay-coordinates-file", type=Path, default=config.DELAY_COORDINATES_FILE
+    )
+    parser.add_argument("--stops-directory", type=Path, default=config.STREETCAR_STOPS_DIRECTORY)
+    parser.add_argument("--snapshot-directory", type=Path, default=config.SNAPSHOT_DIRECTORY)
+    parser.add_argument(
+        "--prune", action="store_true", help="remove snapshots built from other source files"
+    )
+    parser.add_argument(
+        "--ingest",
+        action="store_true",
+        help="first download new or changed delay data from TTC sources into the delay data file",
+    )
+    parser.add_argument("--manifest-file", type=Path, default=config.INGEST_MANIFEST_FILE)
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        help="preprocess the delay data in chunks of this many incidents to bound memory use",
+    )
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO)
+    snapshot_hash = source_hash(
+        args.delay_data_file, args.delay_coordinates_file, args.stops_directory
+    )
+
+    data_kraken = DataKraken()
+    if args.ingest:
+        # start from the previous snapshot, so that only new incidents are preprocessed
+        if not data_kraken.read_snapshot(args.snapshot_directory, snapshot_hash):
+            data_kraken.read_stops_data(args.stops_directory)
+        ingested = data_kraken.ingest_delay_data(
+            args.delay_data_file, args.manifest_file, args.delay_coordinates_file
+        )
+        logger.info("Ingested %s delay incidents", ingested)
+        snapshot_hash = source_hash(
+            args.delay_data_file, args.delay_coordinates_file, args.stops_directory
+        )
+        snapshot = data_kraken.write_snapshot(args.snapshot_directory, snapshot_hash)
+    elif args.chunk_size:
+        data_kraken.read_stops_data(args.stops_directory)
+        snapshot = data_kraken.preprocess_delay_data_in_chunks(
+            args.delay_data_file,
+            args.delay_coordinates_file,
+            args.snapshot_directory,
+            snapshot_hash,
+            args.chunk_size,
+        )
+    else:
+        data_kraken.read_all_data(
+            args.delay_data_file, args.delay_coordinates_file, args.stops_directory
+        )
+        snapshot = data_kraken.write_snapshot(args.snapshot_directory, snapshot_hash)
+
+    logger.info("Wrote snapshot %s", snapshot)
+
+    if args.prune:
+        for stale_snapshot in stale_snapshots(args.snapshot_directory, snapshot_hash):
+            logger.info("Removing stale snapshot %s", stale_snapshot)
+            shutil.rmtree(stale_snapshot)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,146 @@
+import hashlib
+import json
 import logging
-from multiprocessing import Pool
-from typing import Dict, Tuple, Union
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple, Union
 
+import numpy as np
 import pandas as pd
 import requests
+from pandas.api.types import union_categoricals
 
-from streetcardelay.processing.geocode import geocode_all_locations
+from streetcardelay import config
+from streetcardelay.processing.geocode import (
+    LocalGeocoder,
+    default_cache,
+    default_local_geocoder,
+    geocode_all_locations,
+    join_geocoded_locations,
+)
+from streetcardelay.processing.geocode_cache import GeocodeCache
+from streetcardelay.processing.snapshot import read_columns, write_columns
 
 logger = logging.getLogger(__name__)
 
+# older data has different column names
+SOURCE_COLUMN_NAMES = {
+    "Report Date": "Date",
+    "Route": "Line",
+    "Delay": "Min Delay",
+    "Gap": "Min Gap",
+    "Direction": "Bound",
+}
+
+# types of the columns of the source delay data
+SOURCE_SCHEMA = {
+    "Date": str,
+    "Line": str,
+    "Time": str,
+    "Day": str,
+    "Location": str,
+    "Incident": str,
+    "Min Delay": np.float64,
+    "Min Gap": np.float64,
+    "Bound": str,
+    "Vehicle": str,
+}
+
+SHARD_FORMAT_VERSION = 1
+SHARD_COLUMNS_FILE = "columns.json"
+
+
+def normalize_source_data(data: pd.DataFrame) -> pd.DataFrame:
+    """Rename the columns of older delay data and coerce all columns to SOURCE_SCHEMA; missing
+    columns are added without values
+    """
+    data = data.rename(SOURCE_COLUMN_NAMES, axis=1)
+    if missing := [column for column in SOURCE_SCHEMA if column not in data.columns]:
+        logger.warning("Missing columns in provided data: %s", missing)
+        data = data.assign(**{column: np.nan for column in missing})
+
+    return data.astype(SOURCE_SCHEMA)
+
+
+def parse_source_file(
+    fp: Path, reader: Callable[[Path], pd.DataFrame] = pd.read_excel
+) -> Tuple[Path, int]:
+    """Parse a downloaded delay data file with the reader, normalize it and write its columns to
+    a shard directory next to it, so that they can be memory-mapped; the shard of an earlier call
+    is reused. Returns the shard directory and the number of rows. Runs in worker processes.
+    """
+    shard = fp.with_name(f"{fp.name}.shard")
+    try:
+        with open(shard / SHARD_COLUMNS_FILE) as columns_file:
+            shard_info = json.load(columns_file)
+        if shard_info["format_version"] == SHARD_FORMAT_VERSION:
+            return shard, shard_info["rows"]
+    except FileNotFoundError:
+        pass
+
+    data = normalize_source_data(reader(fp))
+    staging = Path(tempfile.mkdtemp(prefix=f".{shard.name}.", dir=fp.parent))
+    try:
+        shard_info = {
+            "format_version": SHARD_FORMAT_VERSION,
+            "rows": len(data),
+            "columns": write_columns(data, staging),
+        }
+        with open(staging / SHARD_COLUMNS_FILE, "w") as columns_file:
+            json.dump(shard_info, columns_file)
+        shutil.rmtree(shard, ignore_errors=True)
+        os.rename(staging, shard)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    return shard, len(data)
+
+
+def combine_shards(shards: List[Tuple[Path, int]]) -> pd.DataFrame:
+    """Concatenate the memory-mapped columns of the given shards with their numbers of rows into
+    a single data frame, so that the combined columns are the only copy of the data in memory;
+    string columns are combined as categoricals
+    """
+    frames = []
+    for shard, rows in shards:
+        with open(shard / SHARD_COLUMNS_FILE) as columns_file:
+            specs = json.load(columns_file)["columns"]
+        frames.append((read_columns(shard, specs, compact=True), rows))
+
+    columns = list(dict.fromkeys(name for frame, _ in frames for name in frame.columns))
+    combined = {}
+    for name in columns:
+        parts = [frame[name] if name in frame.columns else None for frame, _ in frames]
+        if all(part is None or isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            # categoricals without values, including missing columns, take the categories of
+            # another part, as union_categoricals requires categories of the same type
+            dtype = next(
+                (part.dtype for part in parts if part is not None and len(part.cat.categories)),
+                pd.CategoricalDtype([]),
+            )
+            combined[name] = union_categoricals(
+                [
+                    (
+                        pd.Categorical.from_codes(np.full(rows, -1, dtype=np.int8), dtype=dtype)
+                        if part is None or not len(part.cat.categories)
+                        else part.array
+                    )
+                    for part, (_, rows) in zip(parts, frames)
+                ]
+            )
+        else:
+            combined[name] = np.concatenate(
+                [
+                    np.full(rows, np.nan) if part is None else part.to_numpy()
+                    for part, (_, rows) in zip(parts, frames)
+                ]
+            )
+
+    return pd.DataFrame(combined, copy=False)
+
 
 class DelayDataDownloader:
     """Helper class to download TTC streetcar delay incident data"""
@@ -21,6 +153,15 @@ class DelayDataDownloader:
         """Download metadata package for streetcar delay incident data"""
         return requests.get(cls.base_url, params=cls.params).json()
 
+    @classmethod
+    def get_resources(cls) -> List[Dict[str, Any]]:
+        """Download metadata of all streetcar delay incident datasets, excluding readme files"""
+        return [
+            resource
+            for resource in cls.get_package()["result"]["resources"]
+            if "readme" not in resource["name"]
+        ]
+
     @classmethod
     def get_latest_dataset(cls) -> pd.DataFrame:
         """Download last uploaded streetcar delay incident dataset"""
@@ -33,45 +174,96 @@ class DelayDataDownloader:
         return pd.read_excel(latest_dataset["url"])
 
     @classmethod
-    def get_all_data(cls) -> pd.DataFrame:
-        """Download and combine all available streetcar delay incident datasets"""
-        delay_datasets = cls.get_package()["result"]["resources"]
-        urls = [dset["url"] for dset in delay_datasets if "readme" not in dset["name"]]
+    def download_resource_file(cls, resource: Dict[str, Any], directory: Path) -> Path:
+        """Download the file of a streetcar delay incident dataset to the specified directory,
+        streaming it to disk; the file name contains the resource id and a hash of its last
+        modification time, so that a file that was downloaded before is not downloaded again
+        """
+        last_modified = str(resource.get("last_modified") or resource.get("created"))
+        suffix = Path(resource["url"].split("?")[0]).suffix
+        fp = directory / (
+            f"{resource['id']}-{hashlib.sha1(last_modified.encode()).hexdigest()[:12]}{suffix}"
+        )
+        if fp.exists():
+            return fp
 
-        with Pool(5) as p:
-            dfs = p.map(pd.read_excel, urls)
+        with requests.get(resource["url"], stream=True) as response:
+            response.raise_for_status()
+            with tempfile.NamedTemporaryFile(
+                "wb", dir=directory, prefix=f".{fp.name}-", delete=False
+            ) as download:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    download.write(chunk)
+        os.replace(download.name, fp)
 
-        for df in dfs:  # Older data has different column names
-            df.rename(
-                {
-                    "Report Date": "Date",
-                    "Route": "Line",
-                    "Delay": "Min Delay",
-                    "Gap": "Min Gap",
-                    "Direction": "Bound",
-                },
-                axis=1,
-                inplace=True,
+        return fp
+
+    @classmethod
+    def get_all_data(
+        cls,
+        cache_directory: Path = config.DOWNLOAD_CACHE_DIRECTORY,
+        processes: int = 5,
+        reader: Callable[[Path], pd.DataFrame] = pd.read_excel,
+    ) -> pd.DataFrame:
+        """Download and combine all available streetcar delay incident datasets. The files are
+        downloaded concurrently to the cache directory and parsed and normalized in a process
+        pool, see parse_source_file; the parsed columns are memory-mapped and combined, see
+        combine_shards. Files and shards from earlier calls are reused.
+        """
+        resources = cls.get_resources()
+        cache_directory.mkdir(parents=True, exist_ok=True)
+
+        with ThreadPoolExecutor(processes) as executor:
+            files = list(
+                executor.map(
+                    lambda resource: cls.download_resource_file(resource, cache_directory),
+                    resources,
+                )
             )
+        with ProcessPoolExecutor(processes) as executor:
+            shards = list(executor.map(parse_source_file, files, [reader] * len(files)))
 
-        return pd.concat(dfs).reset_index(drop=True)
+        return combine_shards(shards)
 
     @classmethod
     def geocode_locations(
         cls,
         delay_data: pd.DataFrame,
         geocoded_locations: Union[Dict[str, Tuple[float, float]], None] = None,
+        cache: Union[GeocodeCache, None] = None,
+        local: Union[LocalGeocoder, None] = None,
     ) -> pd.DataFrame:
-        """Add coordinates to delay locations
+        """Add coordinates to delay locations as lat and lon columns; locations are resolved
+        offline by the local geocoder, which defaults to one built from the configured stops
+        directory, and looked up in the cache, which defaults to the configured geocode cache,
+        before querying the geocoding API
         TODO: move this method to an appropriate place in the package
         """
         if geocoded_locations is None:
             unique_locations = delay_data.Location.str.upper().unique()
             logger.info("Geocoding %s location descriptions", len(unique_locations))
-            geocoded_locations = geocode_all_locations(unique_locations)
+            geocoded_locations = geocode_all_locations(
+                unique_locations,
+                cache=default_cache() if cache is None else cache,
+                local=default_local_geocoder() if local is None else local,
+            )
 
-        coordinates = delay_data.Location.str.upper().apply(
-            lambda location: geocoded_locations.get(location)
+        coordinates = np.array(
+            [
+                (np.nan, np.nan) if coords is None else coords
+                for coords in geocoded_locations.values()
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+        lat, lon = join_geocoded_locations(
+            delay_data.Location,
+            pd.DataFrame(
+                {
+                    "delay_location": pd.Series(list(geocoded_locations), dtype=object),
+                    "lat": coordinates[:, 0],
+                    "lon": coordinates[:, 1],
+                }
+            ),
         )
 
-        return delay_data.assign(coordinates=coordinates)
+        return delay_data.assign(lat=lat, lon=lon)
@@ -1,70 +1,451 @@
+import difflib
+import logging
+import random
+import re
+import threading
 from concurrent.futures import ThreadPoolExecutor
-from time import sleep, time
-from typing import Dict, Iterable, Tuple
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Dict, FrozenSet, Iterable, List, Tuple, Union
 
+import numpy as np
+import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 
+from streetcardelay import config
 from streetcardelay.config import GEOCODE_URL, GOOGLE_MAPS_API_KEY, TORONTO_BOUNDING_BOX
+from streetcardelay.processing.geocode_cache import GeocodeCache, normalize_description
 
+logger = logging.getLogger(__name__)
 
-def geocode_location_gmaps(
-    location_description: str, bounding_box=TORONTO_BOUNDING_BOX
-) -> Tuple[float, float]:
-    """Turn a location description into a lattitude-longitude coordinate pair using the
-    Google Maps geocoding API
+# geocoding API statuses of responses with a result, which may be that the location is unknown
+RESULT_STATUSES = {"OK", "ZERO_RESULTS"}
+# geocoding API statuses of responses that should be retried, as they are caused by load; all
+# other statuses indicate a problem with the request, the API key or the billing account
+RETRY_STATUSES = {"OVER_QUERY_LIMIT", "UNKNOWN_ERROR"}
+
+# separators between the streets of an intersection
+STREET_SEPARATORS = re.compile(r"\s*(?:/|&|@|\bAND\b|\bAT\b)\s*")
+STREET_ABBREVIATIONS = {
+    "STREET": "ST",
+    "AVENUE": "AVE",
+    "AV": "AVE",
+    "BOULEVARD": "BLVD",
+    "ROAD": "RD",
+    "DRIVE": "DR",
+    "CRESCENT": "CRES",
+    "STN": "STATION",
+    "EAST": "E",
+    "WEST": "W",
+    "NORTH": "N",
+    "SOUTH": "S",
+}
+STREET_DIRECTIONS = {"E", "W", "N", "S"}
+# street types and directions that are omitted at the end of street names
+STREET_SUFFIXES = {"ST", "AVE", "BLVD", "RD", "DR", "CRES"} | STREET_DIRECTIONS
+COORDINATES_REGEXP = re.compile(r"\((-?\d+\.\d+), (-?\d+\.\d+)\)")
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter. The rate is halved whenever the server signals
+    that it is overloaded, and recovers gradually towards the maximum rate with every successful
+    request.
+
+    Attributes:
+        max_rate: maximum number of requests per second
+        rate: current number of requests per second
+        capacity: maximum number of requests that may be sent at once after an idle period
+    """
+
+    max_rate: float
+    rate: float
+    capacity: float
+
+    def __init__(self, max_rate: float, capacity: Union[float, None] = None):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.capacity = max(1.0, max_rate if capacity is None else capacity)
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._slowed_down = -float("inf")
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request may be sent"""
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+    def slow_down(self):
+        """Halve the rate, but keep at least one request per ten seconds; the rate is only
+        halved once per second, so that concurrent requests that failed together count once
+        """
+        with self._lock:
+            now = monotonic()
+            if now - self._slowed_down < 1:
+                return
+            self._slowed_down = now
+            self.rate = max(self.rate / 2, min(0.1, self.max_rate))
+            self._tokens = min(self._tokens, 0)
+
+    def speed_up(self):
+        """Increase the rate by a twentieth of the maximum rate, up to the maximum rate"""
+        with self._lock:
+            self.rate = min(self.rate + self.max_rate / 20, self.max_rate)
+
+
+def street_key(street: str) -> str:
+    """Normalize the name of a single street: upper case without punctuation, with abbreviated
+    street types and directions, and without trailing street types and directions, so that
+    "King St. West" and "KING" have the same key
+    """
+    tokens = [
+        STREET_ABBREVIATIONS.get(token, token)
+        for token in re.sub(r"[.,]", " ", street.upper().replace("'", "")).split()
+    ]
+    while len(tokens) > 1 and tokens[-1] in STREET_SUFFIXES:
+        tokens.pop()
+    return " ".join(tokens)
+
+
+def _street_signature(street: str) -> Tuple[Tuple[Tuple[str, ...], Tuple[str, ...]], str]:
+    """Split a street key into its house numbers and directions, which must match exactly in
+    a fuzzy match, and its remaining words
+    """
+    tokens = street.split()
+    numbers = tuple(token for token in tokens if any(char.isdigit() for char in token))
+    directions = tuple(token for token in tokens if token in STREET_DIRECTIONS)
+    words = " ".join(
+        token for token in tokens if token not in numbers and token not in STREET_DIRECTIONS
+    )
+    return (numbers, directions), words
+
+
+def intersection_key(description: str) -> FrozenSet[str]:
+    """Normalize a location description to the set of keys of the streets that it consists of,
+    see street_key; the streets of an intersection may be separated by "/", "&", "@", "and" or
+    "at"
+    """
+    streets = STREET_SEPARATORS.split(description.upper())
+    return frozenset(key for key in map(street_key, streets) if key)
+
+
+class LocalGeocoder:
+    """Offline geocoder that resolves location descriptions to the coordinates of streetcar stops
+    at the same intersection or station. Descriptions are matched by the set of their normalized
+    street names, so that the order of the streets, the separator between them, abbreviations and
+    directions do not matter; street names that are not known are replaced by the closest known
+    street name if it is similar enough. A fuzzy match only compares words: house numbers and
+    directions within a street name must match exactly, so that "1059 Lake Shore" does not match
+    "2155 Lake Shore" and "Dundas Station" does not match "Dundas West Station".
+
+    Attributes:
+        cutoff: minimum similarity ratio of a fuzzy street name match, between 0 and 1
+        max_spread: maximum difference in degrees between the coordinates of stops with the same
+                    key, beyond which the key is ambiguous and not resolved
+    """
+
+    cutoff: float
+    max_spread: float
+    _index: Dict[FrozenSet[str], Tuple[float, float]]
+    _streets_by_signature: Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], Dict[str, str]]
+    _closest_streets: Dict[str, str]
+
+    def __init__(
+        self,
+        stop_coordinates: Dict[str, Tuple[float, float]],
+        cutoff: float = 0.85,
+        max_spread: float = 0.005,
+    ):
+        self.cutoff = cutoff
+        self.max_spread = max_spread
+
+        coordinates_by_key: Dict[FrozenSet[str], List[Tuple[float, float]]] = {}
+        for stop, coordinates in stop_coordinates.items():
+            coordinates_by_key.setdefault(intersection_key(stop), []).append(coordinates)
+
+        # stops of both directions at an intersection share a key, use their center
+        self._index = {}
+        for key, coordinates in coordinates_by_key.items():
+            points = np.array(coordinates)
+            if (np.ptp(points, axis=0) <= self.max_spread).all():
+                self._index[key] = tuple(points.mean(axis=0).tolist())
+        streets = sorted(set().union(*self._index))
+        self._streets_by_signature = {}
+        for street in streets:
+            signature, words = _street_signature(street)
+            self._streets_by_signature.setdefault(signature, {})[words] = street
+        # known street names map to themselves, fuzzy matches are added on first use
+        self._closest_streets = {street: street for street in streets}
+
+    @classmethod
+    def from_directory(cls, directory: Path, glob: str = "*coordinates.csv", **kwargs):
+        """Build a local geocoder from the stop coordinates in the csv files in the specified
+        directory
+        """
+        stop_coordinates = {}
+        for fp in sorted(directory.glob(glob)):
+            stops = pd.read_csv(fp, sep="|")
+            for stop, coordinates in zip(stops["stop"], stops["coordinates"].astype(str)):
+                if match := COORDINATES_REGEXP.match(coordinates):
+                    stop_coordinates[stop] = (float(match[1]), float(match[2]))
+
+        return cls(stop_coordinates, **kwargs)
+
+    def _closest_street(self, street: str) -> str:
+        """Closest known street name, or the street name itself if no name is similar enough"""
+        if street not in self._closest_streets:
+            signature, words = _street_signature(street)
+            candidates = self._streets_by_signature.get(signature, {})
+            matches = (
+                difflib.get_close_matches(words, list(candidates), n=1, cutoff=self.cutoff)
+                if words
+                else []
+            )
+            self._closest_streets[street] = candidates[matches[0]] if matches else street
+        return self._closest_streets[street]
+
+    def geocode(self, location_description: str) -> Union[Tuple[float, float], None]:
+        """Coordinates of the stop at the described location, or None if it cannot be resolved"""
+        key = intersection_key(location_description)
+        if key in self._index:
+            return self._index[key]
+
+        return self._index.get(frozenset(self._closest_street(street) for street in key))
+
+    def resolve(self, descriptions: Iterable[str]) -> Dict[str, Tuple[float, float]]:
+        """Coordinates of the location descriptions that can be resolved"""
+        resolved = {}
+        for description in descriptions:
+            if (coordinates := self.geocode(description)) is not None:
+                resolved[description] = coordinates
+        return resolved
+
+
+def join_geocoded_locations(
+    locations: pd.Series, geocoded_locations: pd.DataFrame
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Latitudes and longitudes of location descriptions, looked up by upper case description in
+    a table of geocoded locations with the columns delay_location, lat and lon; descriptions
+    that are missing or not in the table get nan coordinates. Only the unique descriptions are
+    normalized and looked up, the incidents are mapped to them through integer codes.
+    """
+    keys = geocoded_locations.delay_location.str.upper()
+    unique_keys = ~keys.duplicated().to_numpy()
+    table_index = pd.Index(keys[unique_keys])
+
+    codes, unique_locations = pd.factorize(locations)
+    table_rows = table_index.get_indexer(pd.Index(unique_locations).str.upper())
+    # the appended -1 and nan are selected by missing descriptions, which have code -1
+    rows = np.append(table_rows, -1)[codes]
+    lat = np.append(geocoded_locations.lat.to_numpy(np.float64)[unique_keys], np.nan)
+    lon = np.append(geocoded_locations.lon.to_numpy(np.float64)[unique_keys], np.nan)
+
+    return lat[rows], lon[rows]
+
+
+class GeocodingClient:
+    """Client for the Google Maps geocoding API that reuses connections from a pool, limits the
+    request rate with a token bucket and retries requests that failed because of load or
+    connection problems with exponential backoff
+
+    Attributes:
+        url: url of the geocoding API
+        key: API key
+        limiter: rate limiter shared by all requests of the client
+        pool_size: number of pooled connections, which is also the number of concurrent requests
+                   of geocode_all_locations
+        max_retries: maximum number of retries of a request
+        backoff: base delay in seconds before the first retry, which doubles with every retry
+        timeout: timeout of a request in seconds
     """
 
-    geocode = requests.get(
-        GEOCODE_URL,
-        params={
+    url: str
+    key: Union[str, None]
+    limiter: TokenBucket
+    pool_size: int
+    max_retries: int
+    backoff: float
+    timeout: float
+
+    def __init__(
+        self,
+        url: str = GEOCODE_URL,
+        key: Union[str, None] = GOOGLE_MAPS_API_KEY,
+        rate: float = config.GEOCODE_RATE,
+        pool_size: int = 10,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        timeout: float = 10.0,
+    ):
+        self.url = url
+        self.key = key
+        self.limiter = TokenBucket(rate)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _retry_delay(self, attempt: int, response: Union[requests.Response, None]) -> float:
+        """Delay before the given retry, as requested by the Retry-After header of the response
+        if present, otherwise exponential backoff with jitter
+        """
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * 2**attempt * random.uniform(0.5, 1.0)
+
+    def geocode(
+        self, location_description: str, bounding_box=TORONTO_BOUNDING_BOX
+    ) -> Tuple[float, float]:
+        """Turn a location description into a lattitude-longitude coordinate pair; returns
+        (nan, nan) if the location could not be found
+        """
+        params = {
             "address": location_description.replace("/", "&").replace("@", "at"),
             "bounds": bounding_box,
-            "key": GOOGLE_MAPS_API_KEY,
-        },
-    )
+            "key": self.key,
+        }
+
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            response = None
+            try:
+                response = self.session.get(self.url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+            else:
+                if response.status_code == 429 or response.status_code >= 500:
+                    self.limiter.slow_down()
+                    if attempt == self.max_retries:
+                        response.raise_for_status()
+                else:
+                    response.raise_for_status()
+                    geocode = response.json()
+                    status = geocode.get("status")
+                    if status in RESULT_STATUSES:
+                        self.limiter.speed_up()
+                        if not geocode["results"]:
+                            return float("nan"), float("nan")
+                        coords = geocode["results"][0]["geometry"]["location"]
+                        return coords["lat"], coords["lng"]
+                    # any other status, e.g. OVER_DAILY_LIMIT, must not be taken for a missing
+                    # location, as it would be cached as negative result
+                    if status not in RETRY_STATUSES or attempt == self.max_retries:
+                        raise ValueError(
+                            f"Geocoding {location_description} failed with status {status}: "
+                            f"{geocode.get('error_message', '')}"
+                        )
+                    self.limiter.slow_down()
 
-    geocode.raise_for_status()
-    if not geocode.json()["results"]:
-        return float("nan"), float("nan")
+            delay = self._retry_delay(attempt, response)
+            logger.debug("Retrying geocoding of %s in %.1fs", location_description, delay)
+            sleep(delay)
+            attempt += 1
 
-    coords = geocode.json()["results"][0]["geometry"]["location"]
 
-    return coords["lat"], coords["lng"]
+_DEFAULT_CLIENT: Union[GeocodingClient, None] = None
+_DEFAULT_CLIENT_LOCK = threading.Lock()
+
+
+def default_client() -> GeocodingClient:
+    """Geocoding client for the configured API, shared by all geocoding that is not given a client
+    of its own, so that all requests keep to a single rate limit and reuse the same connections;
+    it is created on first use
+    """
+    global _DEFAULT_CLIENT
+
+    with _DEFAULT_CLIENT_LOCK:
+        if _DEFAULT_CLIENT is None:
+            _DEFAULT_CLIENT = GeocodingClient()
+        return _DEFAULT_CLIENT
+
+
+def geocode_location_gmaps(
+    location_description: str, bounding_box=TORONTO_BOUNDING_BOX
+) -> Tuple[float, float]:
+    """Turn a location description into a lattitude-longitude coordinate pair using the
+    Google Maps geocoding API through the default client
+    """
+    return default_client().geocode(location_description, bounding_box)
 
 
 def geocode_all_locations(
     descriptions: Iterable[str],
     bounding_box=TORONTO_BOUNDING_BOX,
     query_batch_size: int = 1000,
-    cooldown_period: int = 30,
+    cache: Union[GeocodeCache, None] = None,
+    client: Union[GeocodingClient, None] = None,
+    local: Union[LocalGeocoder, None] = None,
 ) -> Dict[str, Tuple[float, float]]:
     """Turn an iterable of location descriptions into a dictionary of descriptions to
-    lattitude-longitude coordinates. Uses a thread pool to query the Google Maps geocoding API and
-    tries to avoid hitting rate limits.
+    lattitude-longitude coordinates. Uses a thread pool to query the Google Maps geocoding API
+    through the client, which defaults to default_client and keeps to the rate limit.
+    Descriptions are normalized, so that descriptions that only differ in case or whitespace are
+    queried once. If a local geocoder is given, descriptions that it resolves are not queried; if
+    a cache is given, only descriptions without cached result are queried and their results are
+    added to the cache after every query_batch_size queries.
     """
-    descriptions = list(descriptions)
-    chunks = [
-        descriptions[(i * query_batch_size) : (i + 1) * query_batch_size]
-        for i in range((len(descriptions) // query_batch_size) + 1)
+    client = default_client() if client is None else client
+
+    normalized = {description: normalize_description(description) for description in descriptions}
+    unique_descriptions = list(dict.fromkeys(normalized.values()))
+    resolved = local.resolve(unique_descriptions) if local is not None else {}
+    if resolved:
+        logger.info(
+            "Resolved %s of %s location descriptions locally", len(resolved), len(normalized)
+        )
+    unresolved = [
+        description for description in unique_descriptions if description not in resolved
     ]
+    cached = cache.get_many(unresolved, bounding_box) if cache is not None else {}
+    uncached = [description for description in unresolved if description not in cached]
+    if cached:
+        logger.info("Found %s of %s location descriptions in cache", len(cached), len(normalized))
 
     all_results = {}
-    execution_start = time()
-    for i, chunk in enumerate(chunks):
-        with ThreadPoolExecutor() as executor:
-            futures = [
-                executor.submit(geocode_location_gmaps, description, bounding_box)
-                for description in chunk
-            ]
-            chunk_results = {
-                description: future.result() for description, future in zip(chunk, futures)
-            }
-        all_results.update(chunk_results)
-
-        execution_end = time()
-        if (duration := (execution_end - execution_start)) < cooldown_period:
-            if i < len(chunks) - 1:  # Don't cool down after last chunk
-                sleep(cooldown_period - duration)
-        execution_start = execution_end
-
-    return all_results
+    with ThreadPoolExecutor(client.pool_size) as executor:
+        for i in range(0, len(uncached), query_batch_size):
+            chunk = uncached[i : i + query_batch_size]
+            chunk_results = dict(
+                zip(
+                    chunk,
+                    executor.map(
+                        lambda description: client.geocode(description, bounding_box), chunk
+                    ),
+                )
+            )
+            all_results.update(chunk_results)
+            if cache is not None:
+                # store every chunk, so that results are kept if a later query fails
+                cache.put_many(chunk_results, bounding_box)
+            logger.info("Geocoded %s of %s location descriptions", len(all_results), len(uncached))
+
+    all_results.update(cached)
+    all_results.update(resolved)
+    return {description: all_results[key] for description, key in normalized.items()}
+
+
+def default_cache() -> GeocodeCache:
+    """Geocode cache at the configured location"""
+    return GeocodeCache(config.GEOCODE_CACHE_FILE, config.GEOCODE_NEGATIVE_TTL)
+
+
+def default_local_geocoder() -> LocalGeocoder:
+    """Local geocoder built from the stop coordinates in the configured stops directory"""
+    return LocalGeocoder.from_directory(config.STREETCAR_STOPS_DIRECTORY)
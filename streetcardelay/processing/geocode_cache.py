@@ -0,0 +1,104 @@
+"""Module for a persistent cache of geocoded location descriptions in an SQLite database. Results
+are keyed by the normalized description and the bounding box of the query; descriptions that
+could not be geocoded are cached as well, but only for a limited time, after which they are
+queried again.
+"""
+
+import math
+import re
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from time import time
+from typing import Dict, Iterable, Tuple, Union
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS geocodes (
+    description TEXT NOT NULL,
+    bounding_box TEXT NOT NULL,
+    lat REAL,
+    lng REAL,
+    geocoded_at REAL NOT NULL,
+    PRIMARY KEY (description, bounding_box)
+)
+"""
+
+# maximum number of descriptions per lookup query, below the SQLite limit of host parameters
+LOOKUP_BATCH_SIZE = 500
+
+
+def normalize_description(description: str) -> str:
+    """Normalize a location description for use as cache key: upper case with surrounding
+    whitespace removed and inner whitespace collapsed to single spaces
+    """
+    return re.sub(r"\s+", " ", description.strip().upper())
+
+
+def _nan_to_none(coordinates: Tuple[float, float]) -> Tuple[Union[float, None], ...]:
+    """Coordinates as stored in the cache, with None for a negative result"""
+    if coordinates is None or any(math.isnan(coord) for coord in coordinates):
+        return None, None
+    return tuple(coordinates)
+
+
+class GeocodeCache:
+    """Persistent cache of the coordinates of location descriptions
+
+    Attributes:
+        path: path of the SQLite database file, which is created if it does not exist
+        negative_ttl: time in seconds for which a description that could not be geocoded is not
+                      queried again; None to never query it again
+    """
+
+    path: Path
+    negative_ttl: Union[float, None]
+
+    def __init__(self, path: Path, negative_ttl: Union[float, None] = None):
+        self.path = path
+        self.negative_ttl = negative_ttl
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as connection, connection:
+            connection.execute(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_many(
+        self, descriptions: Iterable[str], bounding_box: str
+    ) -> Dict[str, Tuple[float, float]]:
+        """Cached coordinates of the given normalized descriptions within the bounding box;
+        descriptions that could not be geocoded map to (nan, nan) until their negative result
+        expires. Descriptions without valid cache entry are omitted.
+        """
+        descriptions = list(dict.fromkeys(descriptions))
+        negative_since = -math.inf if self.negative_ttl is None else time() - self.negative_ttl
+
+        cached = {}
+        with closing(self._connect()) as connection:
+            for i in range(0, len(descriptions), LOOKUP_BATCH_SIZE):
+                batch = descriptions[i : i + LOOKUP_BATCH_SIZE]
+                rows = connection.execute(
+                    "SELECT description, lat, lng, geocoded_at FROM geocodes "
+                    f"WHERE bounding_box = ? AND description IN ({','.join('?' * len(batch))})",
+                    [bounding_box, *batch],
+                )
+                for description, lat, lng, geocoded_at in rows:
+                    if lat is not None and lng is not None:
+                        cached[description] = (lat, lng)
+                    elif geocoded_at >= negative_since:
+                        cached[description] = (float("nan"), float("nan"))
+
+        return cached
+
+    def put_many(self, coordinates: Dict[str, Tuple[float, float]], bounding_box: str):
+        """Store the coordinates of normalized descriptions within the bounding box; coordinates
+        containing nan are stored as negative result
+        """
+        geocoded_at = time()
+        rows = [
+            (description, bounding_box, *_nan_to_none(coords), geocoded_at)
+            for description, coords in coordinates.items()
+        ]
+        with closing(self._connect()) as connection, connection:
+            connection.executemany("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?)", rows)
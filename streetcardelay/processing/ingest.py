@@ -0,0 +1,140 @@
+"""Module for incremental ingestion of streetcar delay incident datasets. A manifest records the
+id, last modification time and content hash of every ingested CKAN resource, so that only new or
+changed resources are downloaded and parsed on a refresh.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Tuple, Type
+
+import pandas as pd
+
+from streetcardelay import config
+from streetcardelay.processing.delay_data_downloader import (
+    DelayDataDownloader,
+    combine_shards,
+    parse_source_file,
+)
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+# column of the delay data with the id of the resource that a delay incident was ingested from
+RESOURCE_COLUMN = "Resource"
+
+
+def content_hash(fp: Path) -> str:
+    """Hash of the content of a downloaded resource file"""
+    digest = hashlib.sha256()
+    with open(fp, "rb") as resource_file:
+        for chunk in iter(lambda: resource_file.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(fp: Path) -> Dict[str, Dict[str, Any]]:
+    """Read the manifest of ingested resources, which maps resource ids to their last
+    modification time and content hash; returns an empty manifest if the file does not exist or
+    has another version
+    """
+    try:
+        with open(fp) as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        return {}
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        logger.warning("Ignoring manifest %s with unsupported version", fp)
+        return {}
+    return manifest["resources"]
+
+
+def write_manifest(fp: Path, resources: Dict[str, Dict[str, Any]]):
+    """Atomically write the manifest of ingested resources"""
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        "w", dir=fp.parent, prefix=f".{fp.name}-", delete=False
+    ) as manifest_file:
+        json.dump({"version": MANIFEST_VERSION, "resources": resources}, manifest_file, indent=2)
+    os.replace(manifest_file.name, fp)
+
+
+def fetch_changed_resources(
+    manifest: Dict[str, Dict[str, Any]],
+    downloader: Type[DelayDataDownloader] = DelayDataDownloader,
+    reader: Callable[[Path], pd.DataFrame] = pd.read_excel,
+    cache_directory: Path = config.DOWNLOAD_CACHE_DIRECTORY,
+    processes: int = 5,
+) -> Tuple[Dict[str, pd.DataFrame], Dict[str, Dict[str, Any]]]:
+    """Download and parse the resources of the delay incident package that are not in the
+    manifest, or whose last modification time and content hash have changed. Returns the parsed
+    resources by resource id and the updated manifest, which only contains resources that are
+    still part of the package.
+
+    Like DelayDataDownloader.get_all_data, the resources are downloaded concurrently to the cache
+    directory and parsed and normalized in a process pool, see parse_source_file.
+
+    Arguments:
+        manifest: manifest of previously ingested resources
+        downloader: class that obtains the package metadata and the resource files
+        reader: function that parses a downloaded resource file
+        cache_directory: directory for the downloaded resource files and their parsed columns
+        processes: number of concurrent downloads and of processes that parse resources
+    """
+    resources = downloader.get_resources()
+    last_modified = {
+        resource["id"]: resource.get("last_modified") or resource.get("created")
+        for resource in resources
+    }
+    outdated = [
+        resource
+        for resource in resources
+        if resource["id"] not in manifest
+        or manifest[resource["id"]]["last_modified"] != last_modified[resource["id"]]
+    ]
+
+    cache_directory.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(processes) as executor:
+        files = list(
+            executor.map(
+                lambda resource: downloader.download_resource_file(resource, cache_directory),
+                outdated,
+            )
+        )
+    downloaded = {resource["id"]: (resource, fp) for resource, fp in zip(outdated, files)}
+
+    changed_files = {}
+    updated_manifest = {}
+    for resource in resources:
+        if resource["id"] not in downloaded:
+            updated_manifest[resource["id"]] = manifest[resource["id"]]
+            continue
+
+        fp = downloaded[resource["id"]][1]
+        resource_hash = content_hash(fp)
+        updated_manifest[resource["id"]] = {
+            "name": resource["name"],
+            "last_modified": last_modified[resource["id"]],
+            "hash": resource_hash,
+        }
+        entry = manifest.get(resource["id"])
+        if entry is not None and entry["hash"] == resource_hash:
+            continue
+
+        logger.info("Ingesting resource %s", resource["name"])
+        changed_files[resource["id"]] = fp
+
+    with ProcessPoolExecutor(processes) as executor:
+        shards = list(
+            executor.map(parse_source_file, changed_files.values(), [reader] * len(changed_files))
+        )
+
+    return {
+        resource_id: combine_shards([shard]) for resource_id, shard in zip(changed_files, shards)
+    }, updated_manifest
@@ -0,0 +1,438 @@
+"""Module for persisting preprocessed delay and stop data as a binary columnar snapshot.
+
+A snapshot is a directory named after a hash of the source files it was built from. It contains a
+manifest, the streetcar stop data as json and one .npy file per column of the delay data, so that
+columns can be memory-mapped when the snapshot is read. Arrays derived from the delay data, like
+indexes, are stored in subdirectories of the snapshot, so that they can be memory-mapped, too.
+
+Snapshots can be read in compact form, where string columns become categoricals. Compact columns
+are backed directly by the memory-mapped files, so all processes reading the same snapshot share a
+single copy of the data.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from itertools import chain
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT_VERSION = 3
+MANIFEST_FILE = "manifest.json"
+STOPS_FILE = "stops.json"
+ARRAYS_FILE = "arrays.json"
+
+
+def source_hash(*sources: Path) -> str:
+    """Compute a hash over the names and contents of the given source files; directories are
+    hashed by all files they contain
+    """
+    digest = hashlib.sha256(f"snapshot format {SNAPSHOT_FORMAT_VERSION}".encode())
+    for source in sources:
+        files = (
+            sorted(fp for fp in source.rglob("*") if fp.is_file()) if source.is_dir() else [source]
+        )
+        for fp in files:
+            digest.update(fp.name.encode())
+            digest.update(fp.read_bytes())
+
+    return digest.hexdigest()
+
+
+def _column_file(name: str) -> str:
+    """File name for storing the column with the given name"""
+    return hashlib.sha1(name.encode()).hexdigest()[:16] + ".npy"
+
+
+def _encode_column(column: pd.Series) -> Tuple[Dict[str, Any], np.ndarray]:
+    """Encode a column as numpy array together with the information needed to decode it"""
+    if column.dtype.kind in "biufcmM":
+        return {"kind": "array", "dtype": str(column.dtype)}, column.to_numpy()
+
+    values = column.dropna()
+    if len(values) and all(isinstance(value, tuple) for value in values):
+        coordinates = np.full((len(column), 2), np.nan)
+        has_value = column.notna().to_numpy()
+        coordinates[has_value] = np.array(values.to_list(), dtype=np.float64)
+        return {"kind": "coordinates", "dtype": str(column.dtype)}, coordinates
+
+    # pd.Categorical chooses the smallest sufficient integer type for its codes, so that compact
+    # categoricals can later be created from the memory-mapped codes without copying them
+    categorical = pd.Categorical(column)
+    return {
+        "kind": "categorical",
+        "dtype": str(column.dtype),
+        "categories": categorical.categories.to_list(),
+        "missing_is_none": bool(column.isna().any() and column[column.isna()].iloc[0] is None),
+    }, categorical.codes
+
+
+def _decode_column(
+    spec: Dict[str, Any], array: np.ndarray, compact: bool = False
+) -> Union[np.ndarray, pd.Series, pd.Categorical]:
+    """Inverse of _encode_column; if compact is True, string columns are decoded as categoricals
+    without copying the encoded array
+    """
+    if spec["kind"] == "array":
+        return array
+
+    if compact and spec["kind"] == "categorical":
+        return pd.Categorical.from_codes(
+            array, dtype=pd.CategoricalDtype(spec["categories"]), validate=False
+        )
+
+    if spec["kind"] == "coordinates":
+        coordinates = np.full(len(array), None, dtype=object)
+        has_value = np.flatnonzero(~np.isnan(array).any(axis=1))
+        for i, coord in zip(has_value.tolist(), array[has_value].tolist()):
+            coordinates[i] = tuple(coord)
+        return pd.Series(coordinates, dtype=object)
+
+    categories = np.array(
+        spec["categories"] + [None if spec["missing_is_none"] else np.nan], dtype=object
+    )
+    return pd.Series(categories[array], dtype=spec["dtype"])
+
+
+def write_columns(data: pd.DataFrame, directory: Path) -> List[Dict[str, Any]]:
+    """Write every column of the data to a .npy file in the specified directory; returns the
+    specifications of the columns needed to read them with read_columns
+    """
+    columns = []
+    for name in data.columns:
+        spec, array = _encode_column(data[name])
+        spec.update(name=name, file=_column_file(name))
+        np.save(directory / spec["file"], array, allow_pickle=False)
+        columns.append(spec)
+
+    return columns
+
+
+def read_columns(
+    directory: Path,
+    specs: List[Dict[str, Any]],
+    columns: Union[List[str], None] = None,
+    compact: bool = False,
+) -> pd.DataFrame:
+    """Read columns written by write_columns from the specified directory, memory-mapping the
+    column files; if columns is given, only these columns are read. See read_snapshot for compact.
+    """
+    specs_by_name = {spec["name"]: spec for spec in specs}
+    if columns is None:
+        columns = list(specs_by_name)
+
+    return pd.DataFrame(
+        {
+            name: _decode_column(
+                specs_by_name[name],
+                np.load(directory / specs_by_name[name]["file"], mmap_mode="r"),
+                compact,
+            )
+            for name in columns
+        },
+        copy=False,
+    )
+
+
+def write_snapshot(
+    delay_data: pd.DataFrame,
+    stops: Dict[str, Dict[str, List]],
+    directory: Path,
+    snapshot_hash: str,
+) -> Path:
+    """Write delay and stop data to a snapshot in a subdirectory of the specified directory, named
+    after the snapshot hash. The snapshot is written to a temporary directory first and then moved
+    into place, so that readers never see a partially written snapshot.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    target = directory / snapshot_hash
+    staging = Path(tempfile.mkdtemp(prefix=f".{snapshot_hash}.", dir=directory))
+
+    try:
+        columns = write_columns(delay_data, staging)
+
+        with open(staging / STOPS_FILE, "w") as stops_file:
+            json.dump(stops, stops_file)
+
+        manifest = {
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "source_hash": snapshot_hash,
+            "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "rows": len(delay_data),
+            "columns": columns,
+        }
+        with open(staging / MANIFEST_FILE, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+        os.rename(staging, target)
+    except OSError:
+        if not (target / MANIFEST_FILE).exists():
+            raise
+        logger.info("Snapshot %s already exists", target)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    return target
+
+
+def _codes_dtype(categories: int) -> np.dtype:
+    """Smallest integer type for the codes of a categorical with the given number of categories,
+    as chosen by pd.Categorical
+    """
+    for dtype in (np.int8, np.int16, np.int32):
+        if categories < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _merge_column(
+    name: str, parts: List[Tuple[Path, Dict[str, Any], int]], directory: Path
+) -> Dict[str, Any]:
+    """Merge the encoded chunks of a column, given as chunk directory, column specification and
+    number of rows, into a single column file in the specified directory; the column file is
+    filled through a memory map, one chunk at a time. Returns the specification of the merged
+    column.
+    """
+    # chunks with only missing values of a column are encoded as categoricals without categories
+    missing = [spec["kind"] == "categorical" and not spec["categories"] for _, spec, _ in parts]
+    kinds = {spec["kind"] for (_, spec, _), is_missing in zip(parts, missing) if not is_missing}
+    if len(kinds) > 1:
+        raise ValueError(f"Column {name} has different types in different chunks")
+    kind = kinds.pop() if kinds else "categorical"
+    if kind == "array" and any(missing):
+        raise ValueError(f"Column {name} has no values in some chunks")
+
+    dtypes = [part["dtype"] for (_, part, _), is_missing in zip(parts, missing) if not is_missing]
+    spec: Dict[str, Any] = {"kind": kind, "dtype": dtypes[0] if dtypes else parts[0][1]["dtype"]}
+    rows = sum(part_rows for _, _, part_rows in parts)
+    if kind == "categorical":
+        categories = sorted(set(chain.from_iterable(part["categories"] for _, part, _ in parts)))
+        spec.update(
+            categories=categories,
+            missing_is_none=any(part["missing_is_none"] for _, part, _ in parts),
+        )
+        dtype, shape = _codes_dtype(len(categories)), (rows,)
+    elif kind == "coordinates":
+        dtype, shape = np.dtype(np.float64), (rows, 2)
+    else:
+        dtype = np.result_type(
+            *(np.load(chunk / part["file"], mmap_mode="r").dtype for chunk, part, _ in parts)
+        )
+        shape = (rows,)
+
+    spec.update(name=name, file=_column_file(name))
+    merged = np.lib.format.open_memmap(directory / spec["file"], "w+", dtype, shape)
+    start = 0
+    for (chunk, part, part_rows), is_missing in zip(parts, missing):
+        stop = start + part_rows
+        array = np.load(chunk / part["file"], mmap_mode="r")
+        if kind == "categorical":
+            indexer = pd.Index(categories).get_indexer(part["categories"]).astype(dtype)
+            merged[start:stop] = np.where(array >= 0, indexer[array], -1) if len(indexer) else -1
+        elif is_missing:
+            merged[start:stop] = np.nan
+        else:
+            merged[start:stop] = array
+        start = stop
+    merged.flush()
+    del merged
+
+    return spec
+
+
+class SnapshotWriter:
+    """Writes a snapshot from delay data that is appended in chunks, so that delay data that does
+    not fit into memory can be written. Every chunk is encoded to a temporary directory; when the
+    snapshot is finished, the chunks of every column are merged into a single column file, so
+    that the snapshot is the same as one written by write_snapshot. Only one chunk of a column
+    is held in memory at a time.
+
+    Attributes:
+        directory: directory of the snapshot
+        snapshot_hash: hash of the source files, which names the snapshot
+    """
+
+    directory: Path
+    snapshot_hash: str
+    _staging: Path
+    _chunks: List[Tuple[Path, List[Dict[str, Any]], int]]
+
+    def __init__(self, directory: Path, snapshot_hash: str):
+        self.directory = directory
+        self.snapshot_hash = snapshot_hash
+
+        directory.mkdir(parents=True, exist_ok=True)
+        self._staging = Path(tempfile.mkdtemp(prefix=f".{snapshot_hash}.", dir=directory))
+        self._chunks = []
+
+    def append(self, delay_data: pd.DataFrame):
+        """Append a chunk of delay data; all chunks must have the same columns"""
+        if self._chunks and list(delay_data.columns) != [
+            spec["name"] for spec in self._chunks[0][1]
+        ]:
+            raise ValueError("Chunk has different columns than previous chunks")
+
+        chunk = self._staging / f"chunk-{len(self._chunks)}"
+        chunk.mkdir()
+        self._chunks.append((chunk, write_columns(delay_data, chunk), len(delay_data)))
+
+    def finish(self, stops: Dict[str, Dict[str, List]]) -> Path:
+        """Merge the appended chunks and move the snapshot with the given stop data into place;
+        see write_snapshot
+        """
+        target = self.directory / self.snapshot_hash
+        try:
+            names = [spec["name"] for spec in self._chunks[0][1]] if self._chunks else []
+            columns = [
+                _merge_column(
+                    name,
+                    [(chunk, specs[i], rows) for chunk, specs, rows in self._chunks],
+                    self._staging,
+                )
+                for i, name in enumerate(names)
+            ]
+            for chunk, _, _ in self._chunks:
+                shutil.rmtree(chunk)
+
+            with open(self._staging / STOPS_FILE, "w") as stops_file:
+                json.dump(stops, stops_file)
+
+            manifest = {
+                "format_version": SNAPSHOT_FORMAT_VERSION,
+                "source_hash": self.snapshot_hash,
+                "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "rows": sum(rows for _, _, rows in self._chunks),
+                "columns": columns,
+            }
+            with open(self._staging / MANIFEST_FILE, "w") as manifest_file:
+                json.dump(manifest, manifest_file, indent=2)
+
+            os.rename(self._staging, target)
+        except OSError:
+            if not (target / MANIFEST_FILE).exists():
+                raise
+            logger.info("Snapshot %s already exists", target)
+        finally:
+            self.abort()
+
+        return target
+
+    def abort(self):
+        """Remove the temporary directory of the snapshot"""
+        shutil.rmtree(self._staging, ignore_errors=True)
+
+
+def read_snapshot(
+    directory: Path,
+    snapshot_hash: str,
+    columns: Union[List[str], None] = None,
+    compact: bool = False,
+) -> Union[Tuple[Dict[str, Dict[str, List]], pd.DataFrame], None]:
+    """Read stop and delay data from the snapshot with the given hash in the specified directory,
+    memory-mapping the column files; returns None if no such snapshot exists. If columns is given,
+    only these columns of the delay data are read; if compact is True, the delay data is returned
+    in compact form, see compact_delay_data
+    """
+    snapshot = directory / snapshot_hash
+    try:
+        with open(snapshot / MANIFEST_FILE) as manifest_file:
+            manifest = json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+    if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+        return None
+
+    with open(snapshot / STOPS_FILE) as stops_file:
+        stops = json.load(stops_file)
+    for line in stops.values():
+        line["coordinates"] = [
+            None if coord is None else tuple(coord) for coord in line["coordinates"]
+        ]
+
+    return stops, read_columns(snapshot, manifest["columns"], columns, compact)
+
+
+def write_arrays(snapshot: Path, name: str, arrays: Dict[str, np.ndarray]) -> Path:
+    """Write arrays derived from the delay data of a snapshot to the subdirectory of the snapshot
+    with the given name, one .npy file per array. The arrays are written to a temporary directory
+    first and then moved into place; if another process has written them in the meantime, its
+    arrays are kept.
+    """
+    target = snapshot / name
+    staging = Path(tempfile.mkdtemp(prefix=f".{name}.", dir=snapshot))
+
+    try:
+        files = {}
+        for array_name, array in arrays.items():
+            files[array_name] = _column_file(array_name)
+            np.save(staging / files[array_name], array, allow_pickle=False)
+
+        with open(staging / ARRAYS_FILE, "w") as arrays_file:
+            json.dump(files, arrays_file, indent=2)
+
+        os.rename(staging, target)
+    except OSError:
+        if not (target / ARRAYS_FILE).exists():
+            raise
+        logger.info("Arrays %s already exist", target)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    return target
+
+
+def read_arrays(snapshot: Path, name: str) -> Union[Dict[str, np.ndarray], None]:
+    """Read the arrays written by write_arrays to the subdirectory of the snapshot with the given
+    name, memory-mapping their files; returns None if there are no such arrays
+    """
+    try:
+        with open(snapshot / name / ARRAYS_FILE) as arrays_file:
+            files = json.load(arrays_file)
+    except FileNotFoundError:
+        return None
+
+    return {
+        array_name: np.load(snapshot / name / file, mmap_mode="r")
+        for array_name, file in files.items()
+    }
+
+
+def compact_delay_data(
+    delay_data: pd.DataFrame, columns: Union[List[str], None] = None
+) -> pd.DataFrame:
+    """Convert delay data to the compact form used when reading a snapshot with compact=True,
+    i.e. string columns become categoricals; if columns is given, only these columns are kept
+    """
+    if columns is None:
+        columns = list(delay_data.columns)
+
+    return pd.DataFrame(
+        {
+            name: _decode_column(*_encode_column(delay_data[name]), compact=True)
+            for name in columns
+        },
+        index=delay_data.index,
+    )
+
+
+def stale_snapshots(directory: Path, snapshot_hash: str) -> Iterable[Path]:
+    """Yield all snapshots in the specified directory that do not match the given hash"""
+    if not directory.is_dir():
+        return
+    for snapshot in directory.iterdir():
+        if (
+            snapshot.is_dir()
+            and snapshot.name != snapshot_hash
+            and not snapshot.name.startswith(".")
+        ):
+            yield snapshot
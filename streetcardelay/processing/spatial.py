@@ -1,5 +1,7 @@
 from math import asin, cos, log, pi, radians, sin, sqrt, tan
-from typing import List, Tuple
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
 
 
 def haversine(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
@@ -18,6 +20,22 @@ def haversine(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
     return c * r
 
 
+def haversine_array(
+    lon1: np.ndarray, lat1: np.ndarray, lon2: np.ndarray, lat2: np.ndarray
+) -> np.ndarray:
+    """Vectorized version of haversine; accepts arrays of decimal degrees that are broadcast
+    against each other and returns the great circle distances in kilometers
+    """
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    c = 2 * np.arcsin(np.sqrt(a))
+    r = 6371  # Radius of earth in kilometers
+    return c * r
+
+
 def find_closest_stop_pair(
     streetcar_stops: List[Tuple[float, float]], delay_point: Tuple[float, float]
 ) -> int:
@@ -53,6 +71,190 @@ def find_closest_stop_pair(
         return nearest
 
 
+def find_closest_stop_pairs(
+    streetcar_stops: List[Tuple[float, float]], delay_points: np.ndarray
+) -> np.ndarray:
+    """Vectorized version of find_closest_stop_pair for an array of reference points with shape
+    (n, 2); returns an integer array with the index of the first stop of the closest pair of
+    adjacent stops for every reference point
+    """
+    if len(streetcar_stops) < 2:
+        raise ValueError("Must pass coordinates of at least two streetcar stops")
+
+    stops = np.asarray(streetcar_stops, dtype=np.float64)
+    points = np.asarray(delay_points, dtype=np.float64).reshape(-1, 2)
+
+    # distance matrix with one row per reference point and one column per stop
+    distances = haversine_array(
+        stops[np.newaxis, :, 0],
+        stops[np.newaxis, :, 1],
+        points[:, 0, np.newaxis],
+        points[:, 1, np.newaxis],
+    )
+
+    # argmin returns the first of several equidistant stops, just like the stable sort in
+    # find_closest_stop_pair
+    nearest = distances.argmin(axis=1)
+    rows = np.arange(len(points))
+    inner = np.clip(nearest, 1, len(stops) - 2)
+    before_is_closer = distances[rows, inner - 1] <= distances[rows, inner + 1]
+
+    return np.where(
+        nearest == 0,
+        0,
+        np.where(
+            nearest == len(stops) - 1,
+            nearest - 1,
+            np.where(before_is_closer, nearest - 1, nearest),
+        ),
+    )
+
+
 def mercator_project(lat: float, lon: float) -> Tuple[float, float]:
     """Project a lattitude-longitude pair using the Mercator projection"""
     return radians(lon), log(tan((pi / 4) + (radians(lat) / 2)))
+
+
+def mercator_project_array(coordinates: np.ndarray) -> np.ndarray:
+    """Vectorized version of mercator_project for an array of lattitude-longitude pairs with shape
+    (n, 2); returns an array of projected x-y pairs with the same shape
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    return np.column_stack(
+        [
+            np.radians(coordinates[:, 1]),
+            np.log(np.tan((np.pi / 4) + (np.radians(coordinates[:, 0]) / 2))),
+        ]
+    )
+
+
+def project_onto_line(
+    streetcar_stops: List[Tuple[float, float]], delay_points: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Projects an array of lattitude-longitude pairs with shape (n, 2) onto the polyline through
+    a list of stop coordinates. Distances are measured between Mercator projected points and the
+    segments between adjacent stops. Returns two arrays: the index of the closest segment for every
+    point, where segment i connects stop i and stop i + 1, and the fractional position of the
+    projected point along that segment, between 0 (at stop i) and 1 (at stop i + 1)
+    """
+    if len(streetcar_stops) < 2:
+        raise ValueError("Must pass coordinates of at least two streetcar stops")
+
+    stops = mercator_project_array(streetcar_stops)
+    points = mercator_project_array(delay_points)
+
+    starts = stops[np.newaxis, :-1]
+    directions = stops[np.newaxis, 1:] - starts
+    squared_lengths = (directions**2).sum(axis=2)
+    offsets = points[:, np.newaxis] - starts
+
+    # fraction of the orthogonal projection onto each segment, clipped to the segment's ends
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fractions = (offsets * directions).sum(axis=2) / squared_lengths
+    fractions = np.clip(np.nan_to_num(fractions, nan=0.0, posinf=0.0, neginf=0.0), 0, 1)
+
+    squared_distances = ((offsets - fractions[:, :, np.newaxis] * directions) ** 2).sum(axis=2)
+    segments = squared_distances.argmin(axis=1)
+
+    return segments, fractions[np.arange(len(points)), segments]
+
+
+class StopSegmentIndex:
+    """Uniform grid index over the midpoints of the segments between adjacent streetcar stops of a
+    line. Midpoints are computed on Mercator projected stop coordinates, see mercator_project.
+
+    For every grid cell, the index lazily determines the (usually small) set of segments whose
+    midpoint can be the nearest one to any point in the cell, so that a query only needs to compare
+    against these candidates. Points outside of the grid are compared against all segments.
+
+    Attributes:
+        cell_size: edge length of a grid cell in projected units
+    """
+
+    cell_size: float
+    _midpoints: np.ndarray
+    _origin: np.ndarray
+    _shape: np.ndarray
+    _candidates: Dict[int, np.ndarray]
+
+    def __init__(
+        self, streetcar_stops: List[Tuple[float, float]], cell_size: Union[float, None] = None
+    ):
+        if len(streetcar_stops) < 2:
+            raise ValueError("Must pass coordinates of at least two streetcar stops")
+
+        projected = mercator_project_array(streetcar_stops)
+        self._midpoints = (projected[:-1] + projected[1:]) / 2
+
+        if cell_size is None:
+            segment_lengths = np.hypot(*(projected[1:] - projected[:-1]).T)
+            segment_lengths = segment_lengths[segment_lengths > 0]
+            cell_size = float(np.median(segment_lengths)) if len(segment_lengths) else 1.0
+        if cell_size <= 0:
+            raise ValueError("Cell size must be positive")
+        self.cell_size = cell_size
+
+        self._origin = self._midpoints.min(axis=0)
+        self._shape = (
+            np.floor((self._midpoints.max(axis=0) - self._origin) / self.cell_size).astype(
+                np.int64
+            )
+            + 1
+        )
+        self._candidates = {}
+
+    def __len__(self) -> int:
+        return len(self._midpoints)
+
+    def _cell_candidates(self, cell: int) -> np.ndarray:
+        """Indices of the segments whose midpoint may be nearest to a point in the given cell"""
+        if cell not in self._candidates:
+            column, row = divmod(cell, self._shape[1])
+            center = self._origin + (np.array([column, row]) + 0.5) * self.cell_size
+            center_distances = np.hypot(*(self._midpoints - center).T)
+
+            # any point in the cell is at most half a cell diagonal away from its center, so no
+            # midpoint further away than the nearest one plus a full diagonal can be nearest
+            max_distance = center_distances.min() + self.cell_size * sqrt(2)
+            self._candidates[cell] = np.flatnonzero(center_distances <= max_distance)
+
+        return self._candidates[cell]
+
+    def _nearest_among(self, candidates: np.ndarray, projected_points: np.ndarray) -> np.ndarray:
+        """Index of the nearest segment midpoint among candidates for every projected point"""
+        distances = np.hypot(
+            self._midpoints[np.newaxis, candidates, 0] - projected_points[:, 0, np.newaxis],
+            self._midpoints[np.newaxis, candidates, 1] - projected_points[:, 1, np.newaxis],
+        )
+        return candidates[distances.argmin(axis=1)]
+
+    def nearest_segment(self, point: Tuple[float, float]) -> int:
+        """Returns the index of the segment whose midpoint is closest to the given
+        lattitude-longitude pair; segment i connects stop i and stop i + 1
+        """
+        return int(self.nearest_segments(np.array([point]))[0])
+
+    def nearest_segments(self, points: np.ndarray) -> np.ndarray:
+        """Vectorized version of nearest_segment for an array of lattitude-longitude pairs with
+        shape (n, 2)
+        """
+        projected_points = mercator_project_array(points)
+        cells = np.floor((projected_points - self._origin) / self.cell_size).astype(np.int64)
+        in_grid = np.all((cells >= 0) & (cells < self._shape), axis=1)
+
+        result = np.empty(len(projected_points), dtype=np.int64)
+        if not in_grid.all():
+            result[~in_grid] = self._nearest_among(
+                np.arange(len(self._midpoints)), projected_points[~in_grid]
+            )
+
+        in_grid_rows = np.flatnonzero(in_grid)
+        cell_ids = cells[in_grid_rows, 0] * self._shape[1] + cells[in_grid_rows, 1]
+        order = np.argsort(cell_ids, kind="stable")
+        unique_cells, starts = np.unique(cell_ids[order], return_index=True)
+        for cell, rows in zip(unique_cells, np.split(in_grid_rows[order], starts[1:])):
+            result[rows] = self._nearest_among(
+                self._cell_candidates(int(cell)), projected_points[rows]
+            )
+
+        return result
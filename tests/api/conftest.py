@@ -1,3 +1,6 @@
 import os
+import tempfile
 
 os.environ["DELAY_DATA_FILE"] = "tests/api/test_delay_data.csv"
+os.environ["SNAPSHOT_DIRECTORY"] = tempfile.mkdtemp()
+os.environ["ADMIN_TOKEN"] = "test-admin-token"
@@ -0,0 +1,68 @@
+import gzip
+
+from streetcardelay.graphics import NetworkSVGGenerator, SVGGenerator
+from streetcardelay.graphics.map_cache import RenderedMap, SVGMapCache, accepted_encodings
+
+LINE_INFO = {
+    "stops": ["First St", "Second St", "Third St"],
+    "coordinates": [(43.64, -79.40), (43.65, -79.38), (43.66, -79.37)],
+}
+
+
+def test_accepted_encodings():
+    assert accepted_encodings("gzip, deflate;q=0.5, br;q=0") == {
+        "gzip": 1.0,
+        "deflate": 0.5,
+        "br": 0.0,
+    }
+    assert accepted_encodings("") == {}
+
+
+def test_negotiate():
+    rendered = RenderedMap(b"<svg></svg>")
+
+    assert rendered.negotiate("") == "identity"
+    assert rendered.negotiate("gzip, deflate") == "gzip"
+    assert rendered.negotiate("gzip;q=0, identity") == "identity"
+    assert rendered.negotiate("*") in {"br", "gzip"}
+    assert gzip.decompress(rendered.variants["gzip"][0]) == b"<svg></svg>"
+    assert len({etag for _, etag in rendered.variants.values()}) == len(rendered.variants)
+
+
+def test_svg_map_cache():
+    cache = SVGMapCache({"501": LINE_INFO})
+    plain = cache.get("501")
+
+    assert cache.get("501") is plain
+    assert b"Second St</text>" not in plain.variants["identity"][0]
+    assert b"Second St</text>" in cache.get("501", draw_stop_names=True).variants["identity"][0]
+
+
+def test_network_svg_generator():
+    other_line = {
+        "stops": ["Fourth St", "Fifth St"],
+        "coordinates": [(43.60, -79.50), (43.62, -79.45)],
+    }
+    single = SVGGenerator(LINE_INFO)
+    network = NetworkSVGGenerator({"501": LINE_INFO, "504": other_line})
+
+    assert NetworkSVGGenerator({"501": LINE_INFO}).make_svg().elements[0].elements == (
+        single.make_svg().elements
+    )
+    assert [group.id for group in network.make_svg().elements] == [
+        "streetcarLine:501",
+        "streetcarLine:504",
+    ]
+    assert (
+        SVGMapCache({"501": LINE_INFO, "504": other_line})
+        .get_network(["504", "501", "504"])
+        .variants["identity"][0]
+        == network.render()
+    )
+
+
+def test_heatmap_svg():
+    lines = SVGGenerator(LINE_INFO).make_heatmap_svg({"First St": 4.0, "Second St": 2.0}).elements
+
+    assert [line.stroke for line in lines[:2]] == ["hsl(0,100%,40%)", "hsl(0,100%,65%)"]
+    assert SVGGenerator(LINE_INFO).make_heatmap_svg({}).elements[0].stroke == "hsl(0,100%,90%)"
@@ -1,15 +1,229 @@
+import json
+import math
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
 from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
 from uuid import uuid4
 
-from streetcardelay.processing.geocode import geocode_all_locations
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+
+from streetcardelay.config import TORONTO_BOUNDING_BOX
+from streetcardelay.processing import DataKraken
+from streetcardelay.processing.geocode import (
+    GeocodingClient,
+    LocalGeocoder,
+    TokenBucket,
+    default_client,
+    geocode_all_locations,
+    geocode_location_gmaps,
+    join_geocoded_locations,
+)
+from streetcardelay.processing.geocode_cache import GeocodeCache
+
+
+class FakeGeocoder:
+    """Stand-in for the Google Maps geocoding API that answers the first requests for every
+    address with the given failures
+    """
+
+    def __init__(self, failures=()):
+        self.requests = Counter()
+        self.failures = list(failures)
+        geocoder = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                address = parse_qs(urlparse(self.path).query)["address"][0]
+                attempt = geocoder.requests[address]
+                geocoder.requests[address] += 1
+
+                status, body = 200, {"status": "OK", "results": []}
+                if attempt < len(geocoder.failures):
+                    failure = geocoder.failures[attempt]
+                    if isinstance(failure, int):
+                        status = failure
+                    else:
+                        body = {"status": failure, "results": []}
+                elif "SHAW" not in address:
+                    body["results"] = [{"geometry": {"location": {"lat": 43.6, "lng": -79.4}}}]
+
+                self.send_response(status)
+                self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(json.dumps(body).encode())
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/geocode/json"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def client(self, **kwargs) -> GeocodingClient:
+        return GeocodingClient(self.url, "key", **kwargs)
+
+
+@pytest.fixture
+def geocoder():
+    geocoder = FakeGeocoder()
+    yield geocoder
+    geocoder.server.shutdown()
 
 
 @patch(
-    "streetcardelay.processing.geocode.geocode_location_gmaps",
-    new=lambda x, y=None: (1, 2),
+    "streetcardelay.processing.geocode.GeocodingClient.geocode",
+    new=lambda self, x, y=None: (1, 2),
 )
 def test_geocode_all_locations():
     descriptions = [str(uuid4()) for _ in range(567)]
-    result = geocode_all_locations(descriptions, query_batch_size=31, cooldown_period=0)
+    result = geocode_all_locations(descriptions, query_batch_size=31)
 
     assert len(result) == len(descriptions)
+
+
+def test_default_client():
+    clients = []
+
+    def geocode(self, description, bounding_box=None):
+        clients.append(self)
+        return 43.6, -79.4
+
+    # all geocoding without a client of its own shares one rate limit and connection pool
+    with patch("streetcardelay.processing.geocode.GeocodingClient.geocode", new=geocode):
+        geocode_location_gmaps("King and Bathurst")
+        geocode_location_gmaps("Queen and Broadview")
+        geocode_all_locations(["King and Shaw"])
+
+    assert len(clients) == 3
+    assert all(client is default_client() for client in clients)
+
+
+def test_geocode_all_locations_client(geocoder: FakeGeocoder):
+    geocoder.failures = [429, 503, "OVER_QUERY_LIMIT"]
+    descriptions = ["King and Bathurst", "KING AND  BATHURST ", "King and Shaw", "Queen @ Spadina"]
+    result = geocode_all_locations(descriptions, client=geocoder.client(rate=1000, backoff=0))
+
+    assert result["King and Bathurst"] == result["KING AND  BATHURST "] == (43.6, -79.4)
+    assert math.isnan(result["King and Shaw"][0])
+    # every normalized description is only queried until it succeeds
+    assert geocoder.requests == {
+        "KING AND BATHURST": 4,
+        "KING AND SHAW": 4,
+        "QUEEN at SPADINA": 4,
+    }
+
+
+def test_geocoding_client_errors(geocoder: FakeGeocoder):
+    geocoder.failures = [500, 500, 500]
+    with pytest.raises(requests.HTTPError):
+        geocoder.client(max_retries=2, backoff=0).geocode("King and Bathurst")
+
+    geocoder.failures = ["REQUEST_DENIED"]
+    with pytest.raises(ValueError):
+        geocoder.client(backoff=0).geocode("Queen and Broadview")
+    assert geocoder.requests["Queen and Broadview"] == 1
+
+
+def test_geocoding_client_errors_not_cached(geocoder: FakeGeocoder, tmp_path: Path):
+    # a billing or key problem is no negative result and must not block descriptions in the cache
+    geocoder.failures = ["OVER_DAILY_LIMIT"]
+    cache = GeocodeCache(tmp_path / "geocode.sqlite", negative_ttl=3600)
+    with pytest.raises(ValueError):
+        geocode_all_locations(
+            ["King and Bathurst"], cache=cache, client=geocoder.client(backoff=0)
+        )
+
+    assert geocoder.requests["KING AND BATHURST"] == 1
+    assert not cache.get_many(["KING AND BATHURST"], TORONTO_BOUNDING_BOX)
+
+
+def test_token_bucket():
+    limiter = TokenBucket(10)
+    limiter.slow_down()
+    limiter.slow_down()
+    assert limiter.rate == 5
+    limiter._slowed_down -= 1
+    limiter.slow_down()
+    assert limiter.rate == 2.5
+    for _ in range(20):
+        limiter.speed_up()
+    assert limiter.rate == 10
+
+
+def test_geocode_all_locations_cache(tmp_path):
+    queried = []
+
+    def geocode(self, description, bounding_box=None):
+        queried.append(description)
+        return (float("nan"), float("nan")) if "SHAW" in description else (43.6, -79.4)
+
+    cache = GeocodeCache(tmp_path / "geocode.sqlite", negative_ttl=3600)
+    descriptions = ["King and Bathurst", "KING AND  BATHURST ", "King and Shaw"]
+    with patch("streetcardelay.processing.geocode.GeocodingClient.geocode", new=geocode):
+        result = geocode_all_locations(descriptions, cache=cache)
+        assert sorted(queried) == ["KING AND BATHURST", "KING AND SHAW"]
+        assert result["KING AND  BATHURST "] == (43.6, -79.4)
+        assert math.isnan(result["King and Shaw"][0])
+
+        # results persist across cache instances, negative results until they expire
+        queried.clear()
+        cache = GeocodeCache(tmp_path / "geocode.sqlite", negative_ttl=3600)
+        assert geocode_all_locations(descriptions, cache=cache).keys() == set(descriptions)
+        assert not queried
+
+        cache.negative_ttl = 0
+        geocode_all_locations(descriptions + ["Queen and Broadview"], cache=cache)
+        assert sorted(queried) == ["KING AND SHAW", "QUEEN AND BROADVIEW"]
+
+
+def test_local_geocoder(geocoder: FakeGeocoder):
+    local = LocalGeocoder.from_directory(Path("data/streetcar_stops"))
+    descriptions = [
+        "DUNDAS AND RONCESVALLES",
+        "RONCESVALLES AVE. @ DUNDAS ST. WEST",
+        "RONCESVALES & DUNDAS",
+        "ST. CLAIR WEST STN",
+        "KING AND SHAW",
+        "QUEEN'S QUAY AND REES",
+        "CXOWELL AND LOWER GERR",
+        # house numbers and directions are not changed by a fuzzy match
+        "1059 LAKE SHORE BLVD E",
+        "2081 LAKE SHORE BLVD W",
+        "DUNDAS STATION",
+    ]
+    unresolved = descriptions[-4:]
+    resolved = local.resolve(descriptions)
+
+    assert resolved["DUNDAS AND RONCESVALLES"] == pytest.approx((43.655, -79.452), abs=0.002)
+    assert resolved["RONCESVALLES AVE. @ DUNDAS ST. WEST"] == resolved["DUNDAS AND RONCESVALLES"]
+    assert resolved["RONCESVALES & DUNDAS"] == resolved["DUNDAS AND RONCESVALLES"]
+    assert "ST. CLAIR WEST STN" in resolved and "KING AND SHAW" in resolved
+    assert "QUEEN'S QUAY AND REES" in resolved
+    assert resolved.keys().isdisjoint(unresolved)
+
+    # only descriptions that cannot be resolved locally are sent to the geocoding API
+    result = geocode_all_locations(descriptions, client=geocoder.client(), local=local)
+    assert result.keys() == set(descriptions)
+    assert sorted(geocoder.requests) == sorted(unresolved)
+
+
+def test_join_geocoded_locations(tmp_path: Path):
+    legacy_file = tmp_path / "geocoded.csv"
+    legacy_file.write_text(
+        "delay_location|coordinates\n"
+        "DUNDAS AND RONCESVALLES|(43.6538732, -79.451805)\n"
+        "KING AND SHAW|(nan, nan)\n"
+    )
+    geocoded = DataKraken.read_geocoded_delay_locations(legacy_file)
+    assert geocoded.lat.dtype == geocoded.lon.dtype == np.float64
+
+    locations = pd.Series(["Dundas and Roncesvalles", "King and Shaw", None, "Unknown"])
+    lat, lon = join_geocoded_locations(locations, geocoded)
+    assert (lat[0], lon[0]) == (43.6538732, -79.451805)
+    assert np.isnan(lat[1:]).all() and np.isnan(lon[1:]).all()
@@ -0,0 +1,155 @@
+import json
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from streetcardelay.processing import DataKraken
+from streetcardelay.processing.delay_data_downloader import (
+    DelayDataDownloader,
+    normalize_source_data,
+)
+from streetcardelay.processing.ingest import read_manifest
+
+DELAY_DATA_FILE = Path("tests/api/test_delay_data.csv")
+DELAY_COORDINATES_FILE = Path("data/delays/geocoded_delay_locations.csv")
+STREETCAR_STOPS_DIRECTORY = Path("data/streetcar_stops")
+
+
+class LocalCKAN:
+    """Stand-in for the CKAN package_show endpoint and the resource files it lists"""
+
+    def __init__(self):
+        self.resources = {}
+        self.downloads = []
+        ckan = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith("/api/3/action/package_show"):
+                    body = json.dumps({"result": {"resources": ckan.package()}}).encode()
+                else:
+                    resource_id = self.path.strip("/")
+                    ckan.downloads.append(resource_id)
+                    body = ckan.resources[resource_id][1]
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def package(self):
+        return [{"id": "readme", "name": "readme", "url": f"{self.url}/readme"}] + [
+            {"id": id, "name": id, "last_modified": modified, "url": f"{self.url}/{id}"}
+            for id, (modified, _) in self.resources.items()
+        ]
+
+    def publish(self, resource_id: str, last_modified: str, data: pd.DataFrame):
+        self.resources[resource_id] = (last_modified, data.to_csv(sep="|").encode())
+
+
+@pytest.fixture
+def ckan():
+    ckan = LocalCKAN()
+    yield ckan
+    ckan.server.shutdown()
+
+
+def _fully_preprocessed(delay_data_file: Path) -> pd.DataFrame:
+    data_kraken = DataKraken()
+    data_kraken.read_all_data(delay_data_file, DELAY_COORDINATES_FILE, STREETCAR_STOPS_DIRECTORY)
+    return data_kraken.delay_data
+
+
+def test_ingest_delay_data(ckan: LocalCKAN, tmp_path: Path):
+    source_data = pd.read_csv(DELAY_DATA_FILE, sep="|", index_col=0)
+    downloader = type("LocalDownloader", (DelayDataDownloader,), {})
+    downloader.base_url = f"{ckan.url}/api/3/action/package_show"
+    delay_data_file, manifest_file = tmp_path / "delays.csv", tmp_path / "manifest.json"
+    reader = partial(pd.read_csv, sep="|", index_col=0)
+
+    data_kraken = DataKraken()
+    data_kraken.read_stops_data(STREETCAR_STOPS_DIRECTORY)
+
+    def ingest() -> int:
+        return data_kraken.ingest_delay_data(
+            delay_data_file,
+            manifest_file,
+            DELAY_COORDINATES_FILE,
+            downloader,
+            reader,
+            tmp_path / "downloads",
+        )
+
+    ckan.publish("january", "2014-02-01", source_data[:40])
+    ckan.publish("february", "2014-03-01", source_data[40:70])
+    assert ingest() == 70
+    assert set(read_manifest(manifest_file)) == {"january", "february"}
+    pd.testing.assert_frame_equal(data_kraken.delay_data, _fully_preprocessed(delay_data_file))
+
+    # a new and a changed resource are ingested, the unchanged one is not downloaded again
+    # older datasets are normalized like by get_all_data
+    ckan.downloads.clear()
+    ckan.publish(
+        "march",
+        "2014-04-01",
+        source_data[70:].rename({"Line": "Route", "Min Delay": "Delay"}, axis=1),
+    )
+    ckan.publish("january", "2014-02-15", source_data[:30])
+    assert ingest() == 59
+    assert "Route" not in pd.read_csv(delay_data_file, sep="|").columns
+    assert sorted(ckan.downloads) == ["january", "march"]
+    assert len(data_kraken.delay_data) == 89
+    pd.testing.assert_frame_equal(data_kraken.delay_data, _fully_preprocessed(delay_data_file))
+
+    ckan.downloads.clear()
+    assert ingest() == 0
+    assert not ckan.downloads
+
+
+def test_get_all_data(ckan: LocalCKAN, tmp_path: Path):
+    source_data = pd.read_csv(DELAY_DATA_FILE, sep="|", index_col=0)
+    downloader = type("LocalDownloader", (DelayDataDownloader,), {})
+    downloader.base_url = f"{ckan.url}/api/3/action/package_show"
+    reader = partial(pd.read_csv, sep="|", index_col=0)
+
+    ckan.publish("january", "2014-02-01", source_data[:40])
+    # older datasets have other column names and lack some columns
+    ckan.publish(
+        "february",
+        "2014-03-01",
+        source_data[40:]
+        .rename({"Line": "Route", "Min Delay": "Delay"}, axis=1)
+        .drop("Vehicle", axis=1),
+    )
+    data = downloader.get_all_data(tmp_path, processes=2, reader=reader)
+
+    expected = normalize_source_data(source_data.reset_index(drop=True))
+    assert list(data.columns) == list(expected.columns)
+    assert isinstance(data["Location"].dtype, pd.CategoricalDtype)
+    assert data["Vehicle"][40:].isna().all()
+    expected.loc[40:, "Vehicle"] = np.nan
+    pd.testing.assert_frame_equal(data.astype(expected.dtypes.to_dict()), expected)
+
+    # downloaded files and their shards are reused
+    ckan.downloads.clear()
+    pd.testing.assert_frame_equal(downloader.get_all_data(tmp_path, reader=reader), data)
+    assert not ckan.downloads
+
+
+def test_read_delay_data_times():
+    times = DataKraken._seconds_since_midnight(pd.Series(["06:31:00", "7:05", "23:59:59"]))
+    assert times.to_list() == [23460, 25500, 86399]
+
+    # missing times are not turned into midnight
+    with pytest.raises(ValueError):
+        DataKraken._seconds_since_midnight(pd.Series(["06:31:00", None, "7:05"]))
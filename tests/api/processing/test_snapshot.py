@@ -0,0 +1,52 @@
+from pathlib import Path
+
+import pandas as pd
+
+from streetcardelay.processing import DataKraken
+from streetcardelay.processing.snapshot import read_snapshot, source_hash
+
+DELAY_DATA_FILE = Path("tests/api/test_delay_data.csv")
+DELAY_COORDINATES_FILE = Path("data/delays/geocoded_delay_locations.csv")
+STREETCAR_STOPS_DIRECTORY = Path("data/streetcar_stops")
+
+
+def test_snapshot_roundtrip(tmp_path: Path):
+    snapshot_hash = source_hash(DELAY_DATA_FILE, DELAY_COORDINATES_FILE, STREETCAR_STOPS_DIRECTORY)
+    data_kraken = DataKraken()
+    data_kraken.read_all_data(DELAY_DATA_FILE, DELAY_COORDINATES_FILE, STREETCAR_STOPS_DIRECTORY)
+    data_kraken.write_snapshot(tmp_path, snapshot_hash)
+
+    snapshot_kraken = DataKraken()
+    assert snapshot_kraken.read_snapshot(tmp_path, snapshot_hash)
+    assert snapshot_kraken.stops == data_kraken.stops
+    assert snapshot_kraken.delay_data.equals(data_kraken.delay_data)
+    assert snapshot_kraken.delay_data.dtypes.equals(data_kraken.delay_data.dtypes)
+
+
+def test_snapshot_stale(tmp_path: Path):
+    snapshot_hash = source_hash(DELAY_DATA_FILE, DELAY_COORDINATES_FILE, STREETCAR_STOPS_DIRECTORY)
+    data_kraken = DataKraken()
+    data_kraken.read_all_data(DELAY_DATA_FILE, DELAY_COORDINATES_FILE, STREETCAR_STOPS_DIRECTORY)
+    data_kraken.write_snapshot(tmp_path, snapshot_hash)
+
+    assert source_hash(DELAY_DATA_FILE, STREETCAR_STOPS_DIRECTORY) != snapshot_hash
+    assert not DataKraken().read_snapshot(tmp_path, source_hash(DELAY_DATA_FILE))
+
+
+def test_snapshot_in_chunks(tmp_path: Path):
+    snapshot_hash = source_hash(DELAY_DATA_FILE, DELAY_COORDINATES_FILE, STREETCAR_STOPS_DIRECTORY)
+    data_kraken = DataKraken()
+    data_kraken.read_all_data(DELAY_DATA_FILE, DELAY_COORDINATES_FILE, STREETCAR_STOPS_DIRECTORY)
+    data_kraken.write_snapshot(tmp_path / "full", snapshot_hash)
+
+    chunked_kraken = DataKraken()
+    chunked_kraken.read_stops_data(STREETCAR_STOPS_DIRECTORY)
+    chunked_kraken.preprocess_delay_data_in_chunks(
+        DELAY_DATA_FILE, DELAY_COORDINATES_FILE, tmp_path / "chunked", snapshot_hash, chunk_size=7
+    )
+    assert not list((tmp_path / "chunked").glob(".*"))
+
+    for compact in (False, True):
+        _, full = read_snapshot(tmp_path / "full", snapshot_hash, compact=compact)
+        _, chunked = read_snapshot(tmp_path / "chunked", snapshot_hash, compact=compact)
+        pd.testing.assert_frame_equal(chunked, full)
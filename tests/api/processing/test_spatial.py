@@ -1,4 +1,12 @@
-from streetcardelay.processing.spatial import find_closest_stop_pair
+import numpy as np
+
+from streetcardelay.processing.spatial import (
+    StopSegmentIndex,
+    find_closest_stop_pair,
+    find_closest_stop_pairs,
+    mercator_project_array,
+    project_onto_line,
+)
 
 
 def test_find_closest_stop_pair():
@@ -10,3 +18,57 @@ def test_find_closest_stop_pair():
 
     assert find_closest_stop_pair(stops, (43.6517999, -79.4363448)) == 0
     assert find_closest_stop_pair(stops, (43.6529203, -79.4296335)) == 1
+
+
+def test_find_closest_stop_pairs():
+    stops = [
+        (43.6509771, -79.440017),
+        (43.652555, -79.4325456),
+        (43.6536125, -79.4263938),
+        (43.6545512, -79.4203102),
+    ]
+    rng = np.random.default_rng(0)
+    points = np.column_stack(
+        [rng.uniform(43.648, 43.657, 500), rng.uniform(-79.445, -79.415, 500)]
+    )
+
+    result = find_closest_stop_pairs(stops, points)
+
+    assert result.tolist() == [find_closest_stop_pair(stops, tuple(point)) for point in points]
+
+
+def test_stop_segment_index():
+    stops = [
+        (43.6509771, -79.440017),
+        (43.652555, -79.4325456),
+        (43.6536125, -79.4263938),
+        (43.6545512, -79.4203102),
+        (43.6571023, -79.4185671),
+    ]
+    index = StopSegmentIndex(stops)
+    rng = np.random.default_rng(0)
+    points = np.column_stack([rng.uniform(43.64, 43.67, 500), rng.uniform(-79.45, -79.41, 500)])
+
+    midpoints = mercator_project_array(stops)
+    midpoints = (midpoints[:-1] + midpoints[1:]) / 2
+    projected_points = mercator_project_array(points)
+    expected = np.argmin(
+        np.hypot(
+            midpoints[np.newaxis, :, 0] - projected_points[:, 0, np.newaxis],
+            midpoints[np.newaxis, :, 1] - projected_points[:, 1, np.newaxis],
+        ),
+        axis=1,
+    )
+
+    assert index.nearest_segments(points).tolist() == expected.tolist()
+    assert index.nearest_segment(tuple(points[0])) == expected[0]
+
+
+def test_project_onto_line():
+    stops = [(43.65, -79.44), (43.65, -79.43), (43.66, -79.43)]
+    points = np.array([(43.651, -79.4375), (43.6575, -79.431), (43.64, -79.45)])
+
+    segments, fractions = project_onto_line(stops, points)
+
+    assert segments.tolist() == [0, 1, 0]
+    np.testing.assert_allclose(fractions, [0.25, 0.75, 0.0], atol=1e-3)
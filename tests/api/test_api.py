@@ -1,7 +1,11 @@
+import json
+
 import pytest
 from fastapi.testclient import TestClient
 
-from streetcardelay.api import app
+from streetcardelay import config
+from streetcardelay.api import app, export
+from streetcardelay.api.cache import ResponseCache
 
 
 @pytest.fixture(scope="module")
@@ -79,3 +83,252 @@ def test_help(test_client: TestClient):
 
     help_text.raise_for_status()
     assert help_text.text
+
+
+def _total_count(test_client: TestClient, line: str, **params) -> int:
+    aggregate_data = test_client.get(f"/streetcarDelays/{line}/aggregate", params=params)
+    aggregate_data.raise_for_status()
+    return sum(aggregate["totalCount"] for aggregate in aggregate_data.json())
+
+
+def test_streetcarDelays_aggregate_weekday(test_client: TestClient):
+    total = _total_count(test_client, "501")
+
+    assert total
+    assert sum(_total_count(test_client, "501", weekday=weekday) for weekday in range(7)) == total
+    assert test_client.get("/streetcarDelays/501/aggregate", params={"weekday": 7}).is_error
+
+
+def test_streetcarDelays_aggregate_past_midnight(test_client: TestClient):
+    late = _total_count(test_client, "501", timeFrom="15:00")
+    early = _total_count(test_client, "501", timeUntil="08:00")
+
+    assert late and early
+    assert _total_count(test_client, "501", timeFrom="15:00", timeUntil="08:00") == late + early
+
+
+def test_streetcarDelays_fractional_seconds(test_client: TestClient):
+    # fractional seconds are dropped before deciding whether the window wraps past midnight
+    params = {"timeFrom": "06:31:00", "timeUntil": "06:31:00"}
+    fractional = test_client.get(
+        "/streetcarDelays/501", params={**params, "timeFrom": "06:31:00.5"}
+    ).json()
+    rows = test_client.get("/streetcarDelays/501", params=params).json()
+
+    assert len(rows) < 10
+    assert fractional == rows
+
+
+def test_cacheStatistics(test_client: TestClient):
+    params = {"dateFrom": "2014-01-02", "timeFrom": "00:00", "timeUntil": "12:00"}
+    before = test_client.get("/cacheStatistics").json()
+    first = test_client.get("/streetcarDelays/506/aggregate", params=params)
+    second = test_client.get(
+        "/streetcarDelays/506/aggregate",
+        params={"dateFrom": "2014-01-02", "timeUntil": "12:00:00"},
+    )
+    after = test_client.get("/cacheStatistics").json()
+
+    assert first.json() == second.json()
+    assert after["misses"] == before["misses"] + 1
+    assert after["hits"] == before["hits"] + 1
+    assert after["bytes"] >= len(first.content)
+    assert after["maxBytes"] == config.RESPONSE_CACHE_BYTES
+
+
+def test_response_cache_bytes():
+    cache = ResponseCache(max_size=10, max_bytes=10)
+    for key in "abc":
+        cache.put(key, b"1234")
+    assert cache.get("a") is None and cache.get("c") == b"1234"
+    assert len(cache) == 2 and cache.bytes == 8
+
+    # responses that are larger than the cache are not cached
+    cache.put("d", b"12345678901")
+    assert cache.get("d") is None and cache.bytes == 8
+
+    # replacing a response updates the size, and the least recently used responses are evicted
+    cache.put("b", b"12")
+    cache.put("e", b"123456")
+    assert cache.get("c") is None and cache.get("b") == b"12"
+    assert cache.bytes == 8
+
+
+def test_conditional_get(test_client: TestClient):
+    lines = test_client.get("/streetcarLines")
+    etag = lines.headers["ETag"]
+
+    assert lines.headers["Cache-Control"]
+    for url in ["/streetcarLines", "/streetcarDelays/504/aggregate", "/help"]:
+        not_modified = test_client.get(url, headers={"If-None-Match": f'"outdated", {etag}'})
+        assert not_modified.status_code == 304
+        assert not_modified.headers["ETag"] == etag
+        assert not not_modified.content
+
+    assert test_client.get("/streetcarLines", headers={"If-None-Match": '"outdated"'}).json()
+    assert "ETag" not in test_client.get("/cacheStatistics").headers
+
+    # a wildcard does not hide that a request fails
+    any_tag = {"If-None-Match": "*"}
+    assert test_client.get("/streetcarStops?line=999", headers=any_tag).status_code == 400
+    assert test_client.get("/streetcarDelays/504?weekday=9", headers=any_tag).status_code == 422
+    assert test_client.get("/streetcarLines", headers=any_tag).json()
+
+
+def test_streetcarDelays_columns(test_client: TestClient):
+    records = test_client.get("/streetcarDelays/504").json()
+    columns = test_client.get("/streetcarDelays/504", params={"layout": "columns"}).json()
+
+    assert set(columns) == set(records[0])
+    assert [dict(zip(columns, values)) for values in zip(*columns.values())] == records
+
+
+def test_streetcarDelays_pages(test_client: TestClient):
+    params = {"dateFrom": "2014-01-02", "timeFrom": "06:00", "weekday": 3}
+    records = test_client.get("/streetcarDelays/504", params=params).json()
+
+    pages, page_params = [], {**params, "limit": 2}
+    while True:
+        page = test_client.get("/streetcarDelays/504", params=page_params)
+        page.raise_for_status()
+        pages.extend(page.json())
+        if "X-Next-Cursor" not in page.headers:
+            break
+        page_params["cursor"] = page.headers["X-Next-Cursor"]
+
+    assert records
+    assert all(record["time"] >= "06:00:00" for record in records)
+    assert pages == records
+
+    for cursor in ["12", "LTE=", "not a cursor"]:
+        assert (
+            test_client.get("/streetcarDelays/504", params={"cursor": cursor}).status_code == 400
+        )
+
+
+def test_streetcarDelays_streaming(test_client: TestClient):
+    records = test_client.get("/streetcarDelays/501").json()
+    ndjson = test_client.get("/streetcarDelays/501", params={"format": "ndjson"})
+    csv_lines = test_client.get("/streetcarDelays/501", params={"format": "csv"}).text.splitlines()
+
+    assert [json.loads(line) for line in ndjson.text.splitlines()] == records
+    assert csv_lines[0].split(",") == list(records[0])
+    assert len(csv_lines) == len(records) + 1
+
+
+@pytest.mark.skipif(export.export_available(), reason="pyarrow is installed")
+def test_export_unavailable(test_client: TestClient):
+    assert test_client.get("/export/streetcarDelays/504").status_code == 501
+
+
+@pytest.mark.skipif(not export.export_available(), reason="pyarrow is not installed")
+def test_export(test_client: TestClient):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    params = {"dateFrom": "2014-01-02", "timeFrom": "06:00"}
+    records = test_client.get("/streetcarDelays/504", params=params).json()
+    aggregates = test_client.get("/streetcarDelays/504/aggregate", params=params).json()
+
+    arrow = test_client.get("/export/streetcarDelays/504", params=params)
+    table = pa.ipc.open_stream(arrow.content).read_all()
+    assert [
+        {field: getattr(value, "isoformat", lambda: value)() for field, value in row.items()}
+        for row in table.to_pylist()
+    ] == records
+
+    parquet = test_client.get(
+        "/export/streetcarDelays/504/aggregate", params={**params, "format": "parquet"}
+    )
+    assert parquet.headers["Content-Type"] == "application/vnd.apache.parquet"
+    assert pq.read_table(pa.BufferReader(parquet.content)).to_pylist() == aggregates
+
+
+def test_streetcarDelays_aggregate_batch(test_client: TestClient):
+    shared = {"dateFrom": "2014-01-02", "timeFrom": "06:00:00"}
+    per_line = {"dateUntil": "2014-01-07"}
+    batch = test_client.post(
+        "/streetcarDelays/aggregate:batch",
+        json={"lines": ["501", "504", "999"], **shared, "lineFilters": {"504": per_line}},
+    )
+    batch.raise_for_status()
+
+    assert batch.json() == {
+        "501": test_client.get("/streetcarDelays/501/aggregate", params=shared).json(),
+        "504": test_client.get("/streetcarDelays/504/aggregate", params=per_line).json(),
+        "999": [],
+    }
+    assert batch.json()["501"] and batch.json()["504"]
+
+
+def test_maps(test_client: TestClient):
+    plain = test_client.get("/maps", params={"line": "501"}, headers={"Accept-Encoding": ""})
+    compressed = test_client.get(
+        "/maps", params={"line": "501"}, headers={"Accept-Encoding": "gzip"}
+    )
+
+    assert "Content-Encoding" not in plain.headers
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert compressed.text == plain.text
+    assert compressed.headers["ETag"] != plain.headers["ETag"]
+
+    not_modified = test_client.get(
+        "/maps",
+        params={"line": "501"},
+        headers={"Accept-Encoding": "", "If-None-Match": plain.headers["ETag"]},
+    )
+    assert not_modified.status_code == 304
+    assert test_client.get("/maps", params={"line": "501", "drawStopNames": True}).text != (
+        plain.text
+    )
+
+
+def test_maps_network(test_client: TestClient):
+    network = test_client.get("/maps/network", params={"lines": ["501", "504"]})
+    network.raise_for_status()
+
+    assert 'id="streetcarLine:501"' in network.text
+    assert 'id="streetcarLine:504"' in network.text
+    assert 'id="streetcarLine:301"' in test_client.get("/maps/network").text
+    assert test_client.get("/maps/network", params={"lines": ["999"]}).status_code == 400
+
+
+def test_maps_heatmap(test_client: TestClient):
+    params = {"line": "504", "dateFrom": "2014-01-02", "timeFrom": "06:00"}
+    heatmap = test_client.get("/maps/heatmap", params=params)
+    heatmap.raise_for_status()
+
+    assert heatmap.headers["Content-Type"] == "image/svg+xml"
+    assert 'stroke="hsl(0,100%,40%)"' in heatmap.text
+    assert test_client.get("/maps/heatmap", params={**params, "stat": "count"}).text != (
+        heatmap.text
+    )
+    assert test_client.get("/maps/heatmap", params={"line": "999"}).status_code == 400
+
+
+def test_admin_reload(test_client: TestClient, tmp_path, monkeypatch):
+    headers = {"X-Admin-Token": "test-admin-token"}
+    assert test_client.post("/admin/reload").status_code == 403
+    assert test_client.post("/admin/reload", headers=headers).json()["reloaded"] is False
+
+    lines = test_client.get("/streetcarLines")
+    cursor = test_client.get("/streetcarDelays/504", params={"limit": 1}).headers["X-Next-Cursor"]
+    delay_data_file = tmp_path / "delay_data.csv"
+    with open(config.DELAY_DATA_FILE) as source, open(delay_data_file, "w") as target:
+        target.writelines(source.readlines()[:20])
+    monkeypatch.setattr(config, "DELAY_DATA_FILE", delay_data_file)
+
+    try:
+        reload = test_client.post("/admin/reload", headers=headers).json()
+        assert reload["reloaded"]
+        assert f'"{reload["version"]}"' == test_client.get("/streetcarLines").headers["ETag"]
+        assert reload["version"] not in lines.headers["ETag"]
+        assert test_client.get("/metadata").json()["latestDate"] < "2014-01-07"
+        # cursors of the previous dataset point to other rows
+        stale_page = test_client.get("/streetcarDelays/504", params={"limit": 1, "cursor": cursor})
+        assert stale_page.status_code == 410
+    finally:
+        monkeypatch.undo()
+        test_client.post("/admin/reload", headers=headers)
+
+    assert test_client.get("/streetcarLines").headers["ETag"] == lines.headers["ETag"]
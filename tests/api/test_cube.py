@@ -0,0 +1,53 @@
+import datetime
+from pathlib import Path
+
+import numpy as np
+
+from streetcardelay.api import DATASET, _filter_delay_data
+from streetcardelay.api.cube import DelayCube
+from streetcardelay.api.dataset import snapshot_arrays
+
+DELAY_DATA = DATASET.delay_data
+
+
+def _grouped_aggregate(**filters):
+    aggregated = (
+        _filter_delay_data(DATASET, **filters)[
+            ["closest_stop_before", "closest_stop_after", "Min Delay"]
+        ]
+        .groupby(["closest_stop_before", "closest_stop_after"], observed=True)
+        .agg(["sum", "count"])
+    )
+    aggregated.columns = ["_".join(col) for col in aggregated.columns.values]
+    return aggregated.reset_index().to_dict("records")
+
+
+def test_delay_cube_aggregate(tmp_path: Path):
+    # the served cube is shared through the snapshot instead of being built by every process
+    assert isinstance(DATASET.cube._cell_keys, np.memmap)
+    assert isinstance(DATASET.cube._raw_order, np.memmap)
+
+    cube = DelayCube(
+        DELAY_DATA,
+        snapshot_arrays(tmp_path, "cube", lambda: DelayCube.build_arrays(DELAY_DATA)),
+    )
+    filter_combinations = [
+        {},
+        {"date_from": datetime.date(2014, 1, 3), "date_until": datetime.date(2014, 1, 6)},
+        {"time_from": datetime.time(6, 0), "time_until": datetime.time(12, 30, 15)},
+        {"time_from": datetime.time(15, 30), "time_until": datetime.time(8, 0)},
+        {"time_until": datetime.time(14, 22), "weekday": 3},
+        {"date_from": datetime.date(2015, 1, 1)},
+    ]
+
+    for line in ["501", "504", "506", "999"]:
+        for filters in filter_combinations:
+            filters = {
+                name: (
+                    value.hour * 3600 + value.minute * 60 + value.second
+                    if isinstance(value, datetime.time)
+                    else value
+                )
+                for name, value in filters.items()
+            }
+            assert cube.aggregate(line, **filters) == _grouped_aggregate(line=line, **filters)
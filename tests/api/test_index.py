@@ -0,0 +1,64 @@
+import datetime
+from pathlib import Path
+
+import numpy as np
+
+from streetcardelay.api import DATASET
+from streetcardelay.api.dataset import snapshot_arrays
+from streetcardelay.api.index import DelayIndex
+
+DELAY_DATA = DATASET.delay_data
+
+
+def test_delay_index_rows():
+    index = DelayIndex(DELAY_DATA)
+    date_from = datetime.date(2014, 1, 3)
+    date_until = datetime.date(2014, 1, 6)
+    in_range = (DELAY_DATA.Date >= np.datetime64(date_from)) & (
+        DELAY_DATA.Date <= np.datetime64(date_until)
+    )
+
+    for line in ["501", "504", "999"]:
+        is_line = DELAY_DATA.Line == line
+        assert index.rows(line=line).tolist() == np.flatnonzero(is_line).tolist()
+        assert (
+            index.rows(line=line, date_from=date_from, date_until=date_until).tolist()
+            == np.flatnonzero(is_line & in_range).tolist()
+        )
+
+        for stop in DELAY_DATA.closest_stop_before[is_line].dropna().unique():
+            is_stop = is_line & (DELAY_DATA.closest_stop_before == stop)
+            assert (
+                index.rows(line=line, stop_before=stop, date_from=date_from).tolist()
+                == np.flatnonzero(is_stop & (DELAY_DATA.Date >= np.datetime64(date_from))).tolist()
+            )
+
+    assert (
+        index.rows(date_until=date_until).tolist()
+        == np.flatnonzero(DELAY_DATA.Date <= np.datetime64(date_until)).tolist()
+    )
+
+
+def test_delay_index_snapshot(tmp_path: Path):
+    # the served index is shared through the snapshot instead of being built by every process
+    assert all(
+        isinstance(array, np.memmap)
+        for array in (
+            DATASET.index._by_date,
+            DATASET.index._by_line,
+            DATASET.index._by_line_and_stop,
+        )
+    )
+
+    arrays = snapshot_arrays(tmp_path, "index", lambda: DelayIndex.build_arrays(DELAY_DATA))
+    assert arrays["by_line"].dtype == np.int32
+    assert snapshot_arrays(tmp_path, "index", lambda: {}).keys() == arrays.keys()
+
+    index = DelayIndex(DELAY_DATA, arrays)
+    built_index = DelayIndex(DELAY_DATA)
+    date_from = datetime.date(2014, 1, 3)
+    for line, stop in [("504", "King St West / Sudbury St"), ("501", None), (None, None)]:
+        assert (
+            index.rows(line=line, stop_before=stop, date_from=date_from).tolist()
+            == built_index.rows(line=line, stop_before=stop, date_from=date_from).tolist()
+        )